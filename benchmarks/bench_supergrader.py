@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+Benchmarks supergrader against a generated corpus of synthetic submissions,
+reporting throughput in directories per second for each type of validator.
+
+    python3 benchmarks/bench_supergrader.py --directories 500 --jobs 4
+'''
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'supergrader'))
+
+import supergrader  # noqa: E402
+
+WORDS = [
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'grading', 'student', 'html',
+    'function', 'return', 'class', 'style', 'div', 'span', 'value',
+]
+
+# Text that the text validators look for, some of which is sprinkled
+# through the generated files
+PATTERNS = ['<h1>', '<p>', '<div class="card">', 'def ', 'TODO', 'return']
+
+PROFILES = {
+    'ShellValidator': '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['test -f index.html'], name='Has index'),
+    v.shell_validator(command=['grep -qs "<h1>" index.html'], name='Grep h1'),
+    v.shell_validator(command=['exit 0'], name='Noop'),
+]
+''',
+    'BatchShellValidator': r'''
+import validators as v
+
+# Prints a line per directory in the "lines" protocol, eg "dir<TAB>ok"
+REPORT = 'if %s; then printf "$d\tok\n"; else printf "$d\tfail\n"; fi'
+
+VALIDATORS = [
+    v.batch_shell_validator(
+        command=['sh', '-c', 'for d; do %s; done' % (
+            REPORT % 'test -f $d/index.html'), 'sh', '$DIRS'],
+        protocol='lines', name='Has index'),
+    v.batch_shell_validator(
+        command=['sh', '-c', 'for d; do %s; done' % (
+            REPORT % 'grep -qs "<h1>" $d/index.html'), 'sh', '$DIRS'],
+        protocol='lines', name='Grep h1'),
+    v.batch_shell_validator(command=['true', '$DIRS'], name='Noop'),
+]
+''',
+    'FileStructureValidator': '''
+import validators as v
+
+VALIDATORS = [
+    v.file_structure_validator(dir_tree=['index.html', 'README.md'],
+                               name='Top level'),
+    v.file_structure_validator(dir_tree=[('src', ['main.py', 'util.py'])],
+                               name='Sources'),
+    v.file_structure_validator(
+        dir_tree=['*.html', v.FilePattern('src/**/*.py', min_count=2)],
+        name='Patterns'),
+]
+''',
+    'FileTextValidator': '''
+import validators as v
+
+VALIDATORS = [
+    v.file_text_validator(text=text, path='index.html', min_count=1,
+                          name='index.html has %s' % text)
+    for text in PATTERNS
+] + [
+    v.file_text_validator(text='def', path='src/main.py', min_count=2,
+                          whole_word_only=True, name='main.py defs'),
+    v.file_text_validator(text='todo', path='src/util.py', ignore_case=True,
+                          normalize_whitespace=True, name='util.py todo'),
+]
+'''.replace('PATTERNS', repr(PATTERNS)),
+    'representative': '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['exit 0'], name='Success Validator'),
+    v.file_structure_validator(dir_tree=['index.html'], name='Has Index'),
+    v.file_structure_validator(dir_tree=[('src', ['main.py'])],
+                               name='Has main.py'),
+    v.file_text_validator(text='def', min_count=2, max_count=200,
+                          path='src/main.py', name='has def'),
+    v.file_text_validator(text='<p>', min_count=1, path='index.html',
+                          name='has paragraphs'),
+]
+''',
+}
+
+
+def random_text(rng, size, patterns):
+    '''
+    Returns roughly size characters of words, with patterns mixed in
+    '''
+    parts = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.05:
+            part = rng.choice(patterns)
+        else:
+            part = rng.choice(WORDS)
+        parts.append(part)
+        length += len(part) + 1
+        if rng.random() < 0.1:
+            parts.append('\n')
+    return ' '.join(parts)
+
+
+def generate_submission(path, rng, files=5, file_size=2048,
+                        patterns=PATTERNS):
+    '''
+    Creates a single synthetic submission directory with an index.html, a
+    src directory of Python files, and some filler files
+    '''
+    os.makedirs(os.path.join(path, 'src'))
+    files_to_write = {
+        'index.html': random_text(rng, file_size, patterns),
+        'README.md': random_text(rng, file_size // 4, patterns),
+        'src/main.py': random_text(rng, file_size, ['def ', 'return']),
+        'src/util.py': random_text(rng, file_size, ['TODO', 'def ']),
+    }
+    for i in range(max(files - len(files_to_write), 0)):
+        files_to_write['assets/file_%03i.txt' % i] = \
+            random_text(rng, file_size, patterns)
+
+    # Leave a few submissions incomplete, so failure paths are exercised
+    if rng.random() < 0.1:
+        del files_to_write['index.html']
+
+    for relpath, contents in files_to_write.items():
+        full_path = os.path.join(path, relpath)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as fd:
+            fd.write(contents)
+
+
+def generate_corpus(root, directories=100, files=5, file_size=2048,
+                    patterns=PATTERNS, seed=0):
+    '''
+    Generates directories synthetic submissions below root, returning
+    their paths
+    '''
+    rng = random.Random(seed)
+    paths = []
+    for i in range(directories):
+        path = os.path.join(root, 'submission_%05i' % i)
+        generate_submission(path, rng, files, file_size, patterns)
+        paths.append(path)
+    return paths
+
+
+def write_profiles(root):
+    for name, source in PROFILES.items():
+        with open(os.path.join(root, 'bench_%s.py' % name), 'w') as fd:
+            fd.write(source)
+
+
+def run_profile(root, name, paths, extra_args=()):
+    '''
+    Runs supergrader.main over paths with the named profile, returning the
+    elapsed time in seconds
+    '''
+    args = supergrader.parse_args(
+        ['-p', 'bench_%s' % name, '--no-cache', '-f', 'jsonl'] +
+        list(extra_args) + paths)
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        supergrader.main(args)
+    return time.perf_counter() - start
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--directories', type=int, default=200,
+                        help='number of submissions to generate')
+    parser.add_argument('--files', type=int, default=5,
+                        help='number of files in each submission')
+    parser.add_argument('--file-size', type=int, default=2048,
+                        help='approximate size in bytes of each file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profiles', nargs='*', default=sorted(PROFILES),
+                        choices=sorted(PROFILES),
+                        help='which validator types to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per profile, the best is reported')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-c', '--concurrency', type=int, default=0)
+    parser.add_argument('--json', help='file to write results to, as JSON')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated corpus')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    root = tempfile.mkdtemp(prefix='supergrader_bench_')
+    sys.path.insert(0, root)
+    extra_args = ['-j', str(args.jobs), '-c', str(args.concurrency)]
+    try:
+        start = time.perf_counter()
+        paths = generate_corpus(root, args.directories, args.files,
+                                args.file_size, seed=args.seed)
+        write_profiles(root)
+        print('Generated %i submissions in %.2fs (%s)' % (
+            len(paths), time.perf_counter() - start, root))
+
+        results = []
+        for name in args.profiles:
+            elapsed = min(
+                run_profile(root, name, paths, extra_args)
+                for _ in range(args.repeat)
+            )
+            results.append({
+                'profile': name,
+                'directories': len(paths),
+                'seconds': elapsed,
+                'directories_per_second': len(paths) / elapsed,
+            })
+            print('%-24s %8.3fs %10.1f dirs/s' % (
+                name, elapsed, len(paths) / elapsed))
+
+        if args.json:
+            with open(args.json, 'w') as fd:
+                json.dump({'args': vars(args), 'results': results}, fd,
+                          indent=2)
+    finally:
+        sys.path.remove(root)
+        if args.keep:
+            print('Corpus kept in', root)
+        else:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,287 @@
+'''
+Zip and tar archives as submissions. Validators that only look at files
+read them straight out of the archive, listing members from the archive's
+index and reading each member only when needed. Commands need a real
+directory, so the archive is extracted to a temporary workspace the first
+time a command runs against it, which then serves every command for that
+archive until it has been graded.
+'''
+import atexit
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+import dirindex
+
+ARCHIVE_SUFFIXES = (
+    '.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz',
+)
+
+
+def has_archive_suffix(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_archive(path):
+    return has_archive_suffix(path) and os.path.isfile(path)
+
+
+def normalize_member(name):
+    '''
+    Returns the '/' separated relative path of an archive member, or None
+    for members that would end up outside the archive's directory
+    '''
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    if name in ('', '.') or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+class Member:
+    __slots__ = ('info', 'is_dir', 'size')
+
+    def __init__(self, info, is_dir, size=0):
+        self.info = info
+        self.is_dir = is_dir
+        self.size = size
+
+
+class ArchiveView:
+    '''
+    Random access to the files of a zip or tar archive. Zip members are
+    listed from the central directory without reading any file data.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        self.archive = None
+        self.members = None
+        self.listings = None
+        self.extracted = None
+
+    def _load(self):
+        if self.members is not None:
+            return
+        self.members = {}
+        if zipfile.is_zipfile(self.path):
+            self.archive = zipfile.ZipFile(self.path)
+            for info in self.archive.infolist():
+                self._add(info.filename, info, info.is_dir(), info.file_size)
+        else:
+            self.archive = tarfile.open(self.path)
+            for info in self.archive.getmembers():
+                # Links and special files are left out, as if broken
+                if info.isdir() or info.isreg():
+                    self._add(info.name, info, info.isdir(), info.size)
+
+        # Every directory needs a listing, including ones only implied by
+        # the paths of their contents
+        self.listings = {'': {}}
+        for name, member in self.members.items():
+            if member.is_dir:
+                self.listings.setdefault(name, {})
+            path, is_dir = name, member.is_dir
+            while path:
+                parent, base = posixpath.split(path)
+                listing = self.listings.setdefault(parent, {})
+                if base in listing:
+                    break
+                listing[base] = dirindex.Entry(True, is_dir)
+                path, is_dir = parent, True
+
+    def _add(self, name, info, is_dir, size):
+        name = normalize_member(name)
+        if name is not None:
+            self.members[name] = Member(info, is_dir, size)
+
+    def _get_member(self, relpath):
+        self._load()
+        return self.members.get(normalize_member(relpath) or '')
+
+    def listdir(self, relpath=''):
+        '''
+        Returns a dict of name to dirindex.Entry for the directory at
+        relpath, or None if it is not a directory
+        '''
+        self._load()
+        return self.listings.get(normalize_member(relpath) or '')
+
+    def exists(self, relpath):
+        return self._get_member(relpath) is not None or \
+            self.listdir(relpath) is not None
+
+    def getsize(self, relpath):
+        member = self._get_member(relpath)
+        if member is None or member.is_dir:
+            raise FileNotFoundError(os.path.join(self.path, relpath))
+        return member.size
+
+    def open(self, relpath):
+        '''
+        Returns a binary file object for reading a member
+        '''
+        member = self._get_member(relpath)
+        if member is None or member.is_dir:
+            raise FileNotFoundError(os.path.join(self.path, relpath))
+        if isinstance(self.archive, zipfile.ZipFile):
+            return self.archive.open(member.info)
+        return self.archive.extractfile(member.info)
+
+    def extract(self, destination):
+        '''
+        Extracts every file and directory, skipping anything that would end
+        up outside destination
+        '''
+        self._load()
+        for name, member in sorted(self.members.items()):
+            path = os.path.join(destination, *name.split('/'))
+            if member.is_dir:
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self.open(name) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            mode = self._get_mode(member)
+            if mode:
+                os.chmod(path, mode & 0o777)
+
+    def _get_mode(self, member):
+        if isinstance(member.info, tarfile.TarInfo):
+            return member.info.mode
+        return member.info.external_attr >> 16
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+
+class ArchiveIndex(dirindex.DirectoryIndex):
+    '''
+    DirectoryIndex of the files in an archive
+    '''
+    def __init__(self, root, view):
+        super().__init__(root)
+        self.view = view
+
+    def listdir(self, relpath=''):
+        if relpath not in self.listings:
+            self.listings[relpath] = self.view.listdir(relpath)
+        return self.listings[relpath]
+
+    def _fallback_exists(self, relpath):
+        return self.view.exists(relpath)
+
+
+# Archives currently being graded, by path
+_views = {}
+
+# Where archives are extracted for commands, created once per process
+_workspace = None
+
+
+def get_view(root):
+    if root not in _views:
+        _views[root] = ArchiveView(root)
+    return _views[root]
+
+
+def resolve(path):
+    '''
+    Returns (view, member path) if path is an archive or a path inside one,
+    otherwise None. Only path components with an archive suffix are ever
+    checked on disk.
+    '''
+    parts = path.split(os.sep)
+    for i in range(1, len(parts) + 1):
+        prefix = os.sep.join(parts[:i])
+        if not has_archive_suffix(prefix):
+            continue
+        if prefix in _views or os.path.isfile(prefix):
+            return get_view(prefix), '/'.join(parts[i:])
+    return None
+
+
+def get_index(root):
+    '''
+    Like dirindex.get_index, but reads an archive's index if root is one
+    '''
+    if not is_archive(root):
+        return dirindex.get_index(root)
+    return dirindex.get_index(
+        root, lambda root: ArchiveIndex(root, get_view(root)))
+
+
+def exists(path):
+    resolved = resolve(path)
+    if resolved is None:
+        return os.path.exists(path)
+    view, relpath = resolved
+    return view.exists(relpath)
+
+
+def getsize(path):
+    resolved = resolve(path)
+    if resolved is None:
+        return os.path.getsize(path)
+    view, relpath = resolved
+    return view.getsize(relpath)
+
+
+def stat_key(path):
+    '''
+    Returns (mtime in ns, size), which changes whenever the file does
+    '''
+    resolved = resolve(path)
+    if resolved is None:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    view, relpath = resolved
+    return view.mtime_ns, view.getsize(relpath)
+
+
+def open_text(path):
+    resolved = resolve(path)
+    if resolved is None:
+        return open(path)
+    view, relpath = resolved
+    return io.TextIOWrapper(view.open(relpath))
+
+
+def _get_workspace():
+    global _workspace
+    if _workspace is None:
+        _workspace = tempfile.mkdtemp(prefix='supergrader_workspace_')
+        atexit.register(shutil.rmtree, _workspace, True)
+    return _workspace
+
+
+def get_workdir(path):
+    '''
+    Returns a real directory for commands to run in: the directory itself,
+    or for an archive, where it has been extracted
+    '''
+    if not is_archive(path):
+        return path
+    view = get_view(path)
+    if view.extracted is None:
+        view.extracted = tempfile.mkdtemp(dir=_get_workspace())
+        view.extract(view.extracted)
+    return view.extracted
+
+
+def forget(root):
+    '''
+    Close the archive at root and delete its extracted copy, once it has
+    been graded
+    '''
+    view = _views.pop(root, None)
+    if view is None:
+        return
+    view.close()
+    if view.extracted is not None:
+        shutil.rmtree(view.extracted, ignore_errors=True)
@@ -0,0 +1,147 @@
+'''
+Persistent on-disk cache of validator results, so that unchanged
+submissions do not need to be regraded
+'''
+import hashlib
+import json
+import os
+import stat
+import tempfile
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'supergrader')
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Validator results that are worth replaying. Errors are usually caused by
+# the grading environment rather than the submission, so are always rerun.
+CACHEABLE_RESULTS = set(['.', 'F', '?'])
+
+
+def hash_directory(directory):
+    '''
+    Returns a hex digest of every entry below the given directory: its
+    relative path, type and mode bits, and the contents of files or the
+    target of symlinks. Empty directories count too, as validators may look
+    for them. Archives are hashed as a whole.
+    '''
+    digest = hashlib.sha256()
+    if os.path.isfile(directory):
+        with open(directory, 'rb') as fd:
+            for block in iter(lambda: fd.read(65536), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, directory)
+            digest.update(relpath.encode('utf-8', 'surrogateescape') + b'\0')
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # Gone since it was listed
+                digest.update(b'\0')
+                continue
+            digest.update(('%o\0' % st.st_mode).encode('ascii'))
+            try:
+                if stat.S_ISLNK(st.st_mode):
+                    digest.update(os.fsencode(os.readlink(path)))
+                elif stat.S_ISREG(st.st_mode):
+                    with open(path, 'rb') as fd:
+                        for block in iter(lambda: fd.read(65536), b''):
+                            digest.update(block)
+            except OSError:
+                # Unreadable files only contribute their name and mode
+                pass
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResultCache:
+    '''
+    Stores one small JSON file per (directory contents, validator) key. The
+    modification time of each file is bumped on every hit, so eviction can
+    discard the least recently used entries first.
+    '''
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE,
+                 fallback=None):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+
+        # Anything else with a get(key) method to consult on a miss, eg a
+        # results database
+        self.fallback = fallback
+
+    def make_key(self, directory_digest, identity, directory=''):
+        '''
+        Messages may name the directory they were made for, so the same
+        contents in another directory, eg another student's identical
+        submission, don't share results
+        '''
+        digest = hashlib.sha256(directory_digest.encode('ascii'))
+        digest.update(identity.encode('utf-8') + b'\0')
+        digest.update(directory.encode('utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        '''
+        Returns the cached (result, message) pair for key, or None
+        '''
+        path = self._entry_path(key)
+        try:
+            with open(path) as fd:
+                entry = json.load(fd)
+            os.utime(path)
+        except (OSError, ValueError):
+            return self._get_fallback(key)
+        return entry['result'], entry['message']
+
+    def _get_fallback(self, key):
+        if self.fallback is None:
+            return None
+        cached = self.fallback.get(key)
+        if cached:
+            self.put(key, *cached)
+        return cached
+
+    def put(self, key, result, message):
+        if result not in CACHEABLE_RESULTS:
+            return
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that concurrent workers never
+        # see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump({'result': result, 'message': message}, tmp_file)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        '''
+        Deletes the least recently used entries until the cache fits within
+        max_size bytes
+        '''
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,283 @@
+'''
+Bounded capture of the output of validator commands, with matching of the
+output line by line as it arrives
+'''
+import asyncio
+import os
+import re
+import selectors
+import signal
+import subprocess
+import time
+
+CHUNK_SIZE = 65536
+DEFAULT_MAX_SIZE = 1024 * 1024
+DEFAULT_MAX_LINE_LENGTH = 64 * 1024
+STREAMS = ('stdout', 'stderr')
+
+
+class OutputMismatch(Exception):
+    pass
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class RingBuffer:
+    '''
+    Keeps only the last size bytes written to it, so a program printing
+    forever can't use up all the memory
+    '''
+    def __init__(self, size=DEFAULT_MAX_SIZE):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.position = 0
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if len(data) >= self.size:
+            self.buffer[:] = data[-self.size:]
+            self.position = 0
+            return
+        end = self.position + len(data)
+        if end <= self.size:
+            self.buffer[self.position:end] = data
+        else:
+            split = self.size - self.position
+            self.buffer[self.position:] = data[:split]
+            self.buffer[:len(data) - split] = data[split:]
+        self.position = end % self.size
+
+    @property
+    def truncated(self):
+        return self.total > self.size
+
+    def getvalue(self):
+        if not self.truncated:
+            return bytes(self.buffer[:self.total])
+        return bytes(self.buffer[self.position:] + self.buffer[:self.position])
+
+
+class LineReader:
+    '''
+    Splits chunks of output into lines. Lines longer than max_length are cut
+    short, rather than held in memory until a newline turns up.
+    '''
+    def __init__(self, max_length=DEFAULT_MAX_LINE_LENGTH):
+        self.max_length = max_length
+        self.pending = bytearray()
+
+    def _add(self, data):
+        room = self.max_length - len(self.pending)
+        if room > 0:
+            self.pending += data[:room]
+
+    def _take(self):
+        line = self.pending.decode('utf-8', 'replace')
+        self.pending = bytearray()
+        return line
+
+    def feed(self, data):
+        lines = []
+        start = 0
+        end = data.find(b'\n')
+        while end != -1:
+            self._add(data[start:end])
+            lines.append(self._take())
+            start = end + 1
+            end = data.find(b'\n', start)
+        self._add(data[start:])
+        return lines
+
+    def flush(self):
+        '''
+        Returns the last line, if the output didn't end with a newline
+        '''
+        return self._take() if self.pending else None
+
+
+class ExpectedOutput:
+    '''
+    Compares output line by line against the expected text, ignoring
+    trailing whitespace, raising OutputMismatch at the first difference
+    '''
+    def __init__(self, expected, stream='stdout'):
+        self.expected = [line.rstrip() for line in expected.splitlines()]
+        self.stream = stream
+        self.line_number = 0
+
+    def feed(self, line):
+        line = line.rstrip()
+        if self.line_number >= len(self.expected):
+            raise OutputMismatch('%s has unexpected extra line %i: "%s"' % (
+                self.stream, self.line_number + 1, line))
+        expected = self.expected[self.line_number]
+        self.line_number += 1
+        if line != expected:
+            raise OutputMismatch('%s line %i is "%s" instead of "%s"' % (
+                self.stream, self.line_number, line, expected))
+
+    def finish(self):
+        if self.line_number < len(self.expected):
+            raise OutputMismatch('%s ended after %i lines, expected %i' % (
+                self.stream, self.line_number, len(self.expected)))
+
+
+class RegexMatch:
+    '''
+    Checks that a line of output matches a regular expression
+    '''
+    def __init__(self, regex, stream='stdout'):
+        self.regex = re.compile(regex) if isinstance(regex, str) else regex
+        self.stream = stream
+        self.matched = False
+
+    def feed(self, line):
+        if not self.matched and self.regex.search(line):
+            self.matched = True
+
+    def finish(self):
+        if not self.matched:
+            raise OutputMismatch('%s has no line matching /%s/' % (
+                self.stream, self.regex.pattern))
+
+
+class Capture:
+    '''
+    Keeps the tail of one output stream, feeding each line to the matchers
+    '''
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, matchers=()):
+        self.buffer = RingBuffer(max_size)
+        self.matchers = list(matchers)
+        self.lines = LineReader()
+
+    def feed(self, data):
+        self.buffer.write(data)
+        if self.matchers:
+            for line in self.lines.feed(data):
+                self._match(line)
+
+    def _match(self, line):
+        for matcher in self.matchers:
+            matcher.feed(line)
+
+    def close(self):
+        last_line = self.lines.flush()
+        if last_line is not None and self.matchers:
+            self._match(last_line)
+        for matcher in self.matchers:
+            matcher.finish()
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+def kill(process, group=False):
+    '''
+    Kill the process, or with group, everything in its process group (eg
+    anything a shell script started), which needs it to have been started
+    with start_new_session
+    '''
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        # Already finished
+        pass
+
+
+def _completed(cmd, process, captures):
+    output = {name: capture.getvalue() for name, capture in captures.items()}
+    return subprocess.CompletedProcess(
+        cmd, process.returncode, output.get('stdout'), output.get('stderr'))
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise CommandTimeout()
+    return remaining
+
+
+def run(cmd, kwds, captures, timeout=None):
+    '''
+    Like subprocess.run, but with each stream named in the captures dict
+    read into its Capture as it arrives. If the output doesn't match, the
+    process is killed and OutputMismatch raised, and if it is still running
+    after timeout seconds, it is killed and CommandTimeout raised.
+    '''
+    deadline = time.monotonic() + timeout if timeout else None
+    group = kwds.get('start_new_session', False)
+    for name in captures:
+        kwds[name] = subprocess.PIPE
+    process = subprocess.Popen(cmd, **kwds)
+    selector = selectors.DefaultSelector()
+    for name, capture in captures.items():
+        selector.register(getattr(process, name), selectors.EVENT_READ,
+                          capture)
+    try:
+        while selector.get_map():
+            for key, events in selector.select(_remaining(deadline)):
+                data = os.read(key.fileobj.fileno(), CHUNK_SIZE)
+                if data:
+                    key.data.feed(data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.data.close()
+        try:
+            process.wait(_remaining(deadline))
+        except subprocess.TimeoutExpired:
+            raise CommandTimeout()
+    except BaseException:
+        kill(process, group)
+        raise
+    finally:
+        selector.close()
+        for name in captures:
+            getattr(process, name).close()
+        process.wait()
+    return _completed(cmd, process, captures)
+
+
+async def _pump(stream, capture):
+    while True:
+        data = await stream.read(CHUNK_SIZE)
+        if not data:
+            capture.close()
+            return
+        capture.feed(data)
+
+
+async def _communicate(process, tasks):
+    await asyncio.gather(*tasks)
+    await process.wait()
+
+
+async def communicate_async(cmd, process, captures, timeout=None,
+                            group=False):
+    '''
+    Async version of run, for a process started with asyncio with a pipe
+    for each stream named in captures
+    '''
+    tasks = [
+        asyncio.ensure_future(_pump(getattr(process, name), capture))
+        for name, capture in captures.items()
+    ]
+    try:
+        await asyncio.wait_for(_communicate(process, tasks), timeout)
+    except BaseException as e:
+        kill(process, group)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await process.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            raise CommandTimeout() from None
+        raise
+    return _completed(cmd, process, captures)
@@ -0,0 +1,94 @@
+'''
+Checkpoints of finished directories, so long runs can be resumed
+'''
+import hashlib
+import json
+import os
+import time
+
+DEFAULT_SYNC_INTERVAL = 5.0
+
+
+def plan_identity(plan):
+    '''
+    Returns a digest identifying the validators in a plan and their
+    configuration, so a checkpoint is only resumed with the same profile
+    '''
+    digest = hashlib.sha256()
+    for validator in plan:
+        digest.update(validator.identity.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def load(path, identity):
+    '''
+    Returns a dict of directory to (info, grid) for every directory in the
+    checkpoint graded with the same plan. A partially written last line,
+    eg from being killed mid-write, is ignored.
+    '''
+    completed = {}
+    try:
+        fd = open(path)
+    except FileNotFoundError:
+        return completed
+    with fd:
+        for line in fd:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('plan') != identity:
+                continue
+            grid = [(tuple(key), result) for key, result in record['grid']]
+            completed[record['info']['directory']] = record['info'], grid
+    return completed
+
+
+class Checkpoint:
+    '''
+    Appends a line of JSON for every finished directory. Each line goes out
+    in a single write to a file opened with O_APPEND, so a crash can at
+    worst leave one partial line, and the file is fsync'ed at most every
+    sync_interval seconds.
+    '''
+    def __init__(self, path, identity, resume=False,
+                 sync_interval=DEFAULT_SYNC_INTERVAL):
+        self.identity = identity
+        self.sync_interval = sync_interval
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not resume:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        self.last_sync = time.monotonic()
+
+        # Terminate any partial line left behind, so it doesn't swallow the
+        # first new record
+        if resume and not self._ends_with_newline(path):
+            os.write(self.fd, b'\n')
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            if fd.tell() == 0:
+                return True
+            fd.seek(-1, os.SEEK_END)
+            return fd.read(1) == b'\n'
+
+    def add(self, info, grid):
+        line = json.dumps({
+            'plan': self.identity,
+            'info': info,
+            'grid': grid,
+        }) + '\n'
+        os.write(self.fd, line.encode('utf-8'))
+        if time.monotonic() - self.last_sync > self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.fd)
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        os.close(self.fd)
@@ -0,0 +1,216 @@
+'''
+A grading daemon, which imports the profile and compiles its validators
+once, then grades directories sent to it over a Unix domain socket. The
+profile is reloaded whenever its file changes. Messages are JSON lines, as
+with `distributed`:
+
+    client                                  daemon
+    {"type": "grade", "directories": [...],
+     "cwd": ..., "format": "text"}      ->
+                                        <-  {"type": "output", "data": ...}
+                                            repeated, as the report is
+                                            written
+                                        <-  {"type": "done", "directories": 2}
+                                            or {"type": "error", "message": ...}
+
+Jobs are graded one at a time, in the order they arrive.
+'''
+import asyncio
+import importlib
+import os
+import signal
+import socket
+import tempfile
+import time
+import traceback
+
+import distributed
+
+# How often to run cleanup, eg evicting old cache entries, between jobs
+CLEANUP_INTERVAL = 600.0
+
+
+def get_default_socket():
+    return os.environ.get('SUPERGRADER_SOCKET', os.path.join(
+        tempfile.gettempdir(), 'supergrader-%i.sock' % os.getuid()))
+
+
+class WarmProfile:
+    '''
+    The profile module and the plan compiled from it, which are loaded
+    again if the profile's file has changed since. load() should import the
+    profile module and compile(module) return its plan.
+    '''
+    def __init__(self, load, compile):
+        self.load = load
+        self.compile = compile
+        self.module = None
+        self.plan = None
+        self.stat_key = None
+
+    def _get_stat_key(self):
+        stat = os.stat(self.module.__file__)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get_plan(self):
+        if self.module is None:
+            self.module = self.load()
+        elif self._get_stat_key() == self.stat_key:
+            return self.plan
+        else:
+            self.module = importlib.reload(self.module)
+
+        # If compiling fails, the next job tries again
+        stat_key = self._get_stat_key()
+        self.plan = self.compile(self.module)
+        self.stat_key = stat_key
+        return self.plan
+
+
+class OutputStream:
+    '''
+    File-like object for reporters, sending what is written to the client.
+    Called from the thread grading the job.
+    '''
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(distributed.send(
+            self.writer, {'type': 'output', 'data': data}), self.loop).result()
+
+    def flush(self):
+        pass
+
+
+class Daemon:
+    '''
+    Serves grading jobs on the Unix domain socket at path. grade(directories,
+    plan) should yield (info, grid) for each directory, and get_reporter(
+    format, verbose, stream) return a reporter writing to stream.
+    '''
+    def __init__(self, path, profile, grade, get_reporter, cleanup=None):
+        self.path = path
+        self.profile = profile
+        self.grade = grade
+        self.get_reporter = get_reporter
+        self.cleanup = cleanup
+        self.last_cleanup = time.monotonic()
+
+    def serve(self):
+        asyncio.run(self._serve())
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+                return
+        raise OSError('A daemon is already listening on %s' % self.path)
+
+    async def _serve(self):
+        self._remove_stale_socket()
+        loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        # Only the user running the daemon may send it jobs
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(
+                self._handle, self.path, limit=distributed.MAX_MESSAGE_SIZE)
+        finally:
+            os.umask(umask)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            os.unlink(self.path)
+            if self.cleanup:
+                self.cleanup()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            request = await distributed.receive(reader)
+            if request is None:
+                return
+            if request.get('type') != 'grade':
+                await distributed.send(writer, {
+                    'type': 'error',
+                    'message': 'Unknown request %s' % request.get('type'),
+                })
+                return
+            async with self.lock:
+                reply = await loop.run_in_executor(
+                    None, self.run_job, request, OutputStream(writer, loop))
+            await distributed.send(writer, reply)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def run_job(self, request, stream):
+        '''
+        Grades the directories of a request, returning the final message
+        '''
+        try:
+            plan = self.profile.get_plan()
+        except Exception as e:
+            traceback.print_exc()
+            return {
+                'type': 'error',
+                'message': 'Unable to load profile: %s' % e,
+            }
+
+        # Relative paths are relative to the client
+        cwd = os.getcwd()
+        count = 0
+        try:
+            os.chdir(request.get('cwd', cwd))
+            reporter = self.get_reporter(
+                request.get('format', 'text'), request.get('verbose', False),
+                stream)
+            reporter.start(plan)
+            for info, grid in self.grade(request['directories'], plan):
+                reporter.report(info, grid)
+                count += 1
+            reporter.finish()
+        except Exception as e:
+            traceback.print_exc()
+            return {'type': 'error', 'message': str(e)}
+        finally:
+            os.chdir(cwd)
+            self._maybe_cleanup()
+        return {'type': 'done', 'directories': count}
+
+    def _maybe_cleanup(self):
+        now = time.monotonic()
+        if self.cleanup and now - self.last_cleanup > CLEANUP_INTERVAL:
+            self.last_cleanup = now
+            self.cleanup()
+
+
+def request(path, message, stream):
+    '''
+    Sends a job to the daemon listening on path, writing the report to
+    stream as it arrives, and returns the final message
+    '''
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        with sock.makefile('rwb') as fd:
+            fd.write(distributed.encode(message))
+            fd.flush()
+            for line in fd:
+                reply = distributed.decode(line)
+                if reply['type'] != 'output':
+                    return reply
+                stream.write(reply['data'])
+                stream.flush()
+    raise ConnectionError('The daemon closed the connection')
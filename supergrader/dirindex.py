@@ -0,0 +1,197 @@
+'''
+In-memory index of the files in a submission directory, shared by every
+validator that checks for the existence of files
+'''
+import functools
+import os
+import re
+import sys
+
+# On case-insensitive filesystems a name missing from a listing may still
+# exist under a different case, so misses are double checked
+CASE_INSENSITIVE_PLATFORMS = set(['darwin', 'win32'])
+
+
+GLOB_CHARACTERS = set('*?[')
+
+
+def is_glob(pattern):
+    return bool(GLOB_CHARACTERS.intersection(pattern))
+
+
+def _translate_segment(segment):
+    i = 0
+    regex = ''
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            # As with fnmatch, a "]" straight after the "[" or "[!" is in the
+            # set rather than the end of it
+            start = i
+            if segment[start:start + 1] in ('!', '^'):
+                start += 1
+            if segment[start:start + 1] == ']':
+                start += 1
+            end = segment.find(']', start)
+            if end == -1:
+                regex += re.escape(char)
+                continue
+            body = segment[i:end]
+            i = end + 1
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            regex += '[' + body.replace('\\', '\\\\') + ']'
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+@functools.lru_cache(maxsize=None)
+def compile_glob(pattern):
+    '''
+    Compiles a glob pattern to a regular expression matching relative paths
+    separated by '/'. Like glob, "*" does not match across directories,
+    while a "**" segment matches any number of directories.
+    '''
+    segments = pattern.rstrip('/').split('/')
+    regex = ''
+    for i, segment in enumerate(segments):
+        is_last = i == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if is_last else '(?:[^/]+/)*'
+        else:
+            regex += _translate_segment(segment) + ('' if is_last else '/')
+    return re.compile(regex + r'\Z')
+
+
+class Entry:
+    __slots__ = ('exists', 'is_dir', 'is_symlink')
+
+    def __init__(self, exists, is_dir, is_symlink=False):
+        self.exists = exists
+        self.is_dir = is_dir
+        self.is_symlink = is_symlink
+
+
+def scan(path):
+    '''
+    Returns a dict of name to Entry for everything in the given directory,
+    or None if it is not a directory
+    '''
+    entries = {}
+    try:
+        iterator = os.scandir(path)
+    except OSError:
+        return None
+    with iterator:
+        for entry in iterator:
+            is_symlink = entry.is_symlink()
+            try:
+                is_dir = entry.is_dir()
+                exists = True
+                if is_symlink:
+                    # Like os.path.exists, broken symlinks do not count
+                    entry.stat()
+            except OSError:
+                is_dir = exists = False
+            entries[entry.name] = Entry(exists, is_dir, is_symlink)
+    return entries
+
+
+class DirectoryIndex:
+    '''
+    Lists each directory below root with a single os.scandir call the first
+    time something inside it is looked up, so that existence checks are
+    in-memory lookups rather than a stat each
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.listings = {}
+        self.walks = {}
+
+    def refresh(self):
+        self.listings.clear()
+        self.walks.clear()
+
+    def listdir(self, relpath=''):
+        '''
+        Returns a dict of name to Entry for the directory at relpath, or
+        None if it is not a directory
+        '''
+        if relpath not in self.listings:
+            self.listings[relpath] = scan(os.path.join(self.root, relpath))
+        return self.listings[relpath]
+
+    def walk(self, relpath=''):
+        '''
+        Returns a list of (path, is_dir) for everything below the directory
+        at relpath, with paths relative to it and separated by '/'.
+        Symlinked directories are listed but not descended into.
+        '''
+        if relpath in self.walks:
+            return self.walks[relpath]
+        results = []
+        pending = ['']
+        while pending:
+            subdir = pending.pop()
+            path = os.path.join(relpath, subdir) if subdir else relpath
+            listing = self.listdir(path)
+            for name, entry in sorted((listing or {}).items()):
+                if not entry.exists:
+                    continue
+                path = subdir + '/' + name if subdir else name
+                results.append((path, entry.is_dir))
+                if entry.is_dir and not entry.is_symlink:
+                    pending.append(path)
+        self.walks[relpath] = results
+        return results
+
+    def _fallback_exists(self, relpath):
+        return os.path.exists(os.path.join(self.root, relpath))
+
+    def exists(self, relpath):
+        '''
+        Equivalent to os.path.exists(os.path.join(root, relpath))
+        '''
+        if os.path.isabs(relpath):
+            return os.path.exists(relpath)
+        parts = [p for p in relpath.split(os.sep) if p not in ('', '.')]
+        if '..' in parts:
+            return self._fallback_exists(relpath)
+        if not parts:
+            return self.listdir() is not None
+
+        listing = self.listdir(os.sep.join(parts[:-1]))
+        entry = listing.get(parts[-1]) if listing is not None else None
+        if entry is None or not entry.exists:
+            if sys.platform in CASE_INSENSITIVE_PLATFORMS:
+                return self._fallback_exists(relpath)
+            return False
+
+        # A trailing slash only matches directories
+        if relpath.endswith(os.sep) and not entry.is_dir:
+            return False
+        return True
+
+
+# Indexes for the submissions currently being graded
+_indexes = {}
+
+
+def get_index(root, make_index=DirectoryIndex):
+    if root not in _indexes:
+        _indexes[root] = make_index(root)
+    return _indexes[root]
+
+
+def forget(root):
+    '''
+    Drop the index for root, eg after it is graded or after a command may
+    have changed its contents
+    '''
+    _indexes.pop(root, None)
@@ -0,0 +1,393 @@
+'''
+Grading spread across machines. A coordinator hands out directories to
+workers over TCP and collects their results into a single report. Every
+message is a JSON object on a line of its own:
+
+    worker                              coordinator
+    {"type": "hello", "name": ...,
+     "token": ...}                  ->
+                                    <-  {"type": "config", "profile": ...,
+                                         "plan": ...}
+                                        or {"type": "error", "message": ...}
+    {"type": "request", "max": 4}   ->
+                                    <-  {"type": "work", "lease": 300,
+                                         "directories": [[0, "alice"], ...]}
+                                        or {"type": "wait", "seconds": 0.5}
+                                        or {"type": "done"}
+    {"type": "heartbeat"}           ->  (while grading, renews leases)
+    {"type": "result", "index": 0,
+     "info": ..., "grid": ...}      ->
+
+Workers grade whatever they are given and coordinators trust the results
+they get, so both share a secret token, and a worker that doesn't send it is
+hung up on. A worker leases the directories it is given, and only its
+results for those count. If it disconnects, or its lease runs out without a
+heartbeat, the directories are handed to another worker, up to a number of
+retries.
+'''
+import asyncio
+import collections
+import contextlib
+import hmac
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+DEFAULT_PORT = 7482
+DEFAULT_LEASE = 300.0
+DEFAULT_RETRIES = 2
+WAIT_INTERVAL = 0.5
+TOKEN_VARIABLE = 'SUPERGRADER_TOKEN'
+
+# Largest message accepted, eg a directory's info record with long messages
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+def encode(message):
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def decode(line):
+    '''
+    Returns the message on a line, or None at the end of the stream
+    '''
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+async def send(writer, message):
+    writer.write(encode(message))
+    await writer.drain()
+
+
+async def receive(reader):
+    return decode(await reader.readline())
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    '''
+    Parses "host:port", ":port" or "host" into a (host, port) pair
+    '''
+    host, _, port = address.rpartition(':')
+    if not _:
+        return address, DEFAULT_PORT
+    return host or default_host, int(port)
+
+
+def add_token_argument(parser):
+    parser.add_argument('--token', default=os.environ.get(TOKEN_VARIABLE),
+                        help='secret shared by the coordinator and its '
+                             'workers, defaults to $%s' % TOKEN_VARIABLE)
+
+
+def add_coordinator_arguments(parser):
+    add_token_argument(parser)
+    parser.add_argument('--bind', default='127.0.0.1:%i' % DEFAULT_PORT,
+                        help='host:port to listen for workers on')
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE,
+                        help='seconds a worker has to send a result or '
+                             'heartbeat before its directories are handed '
+                             'to another worker')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help='times a directory is handed out again after a '
+                             'worker dies, before giving up on it')
+
+
+class RefusedError(Exception):
+    pass
+
+
+class Coordinator:
+    '''
+    Serves directories to workers from a thread of its own, while the
+    results are consumed in order with iter_results. give_up(directory,
+    message) should return an (info, grid) pair recording a directory that
+    could not be graded. Only workers sending token are served.
+    '''
+    def __init__(self, directories, config, give_up, token,
+                 host='127.0.0.1', port=DEFAULT_PORT, lease=DEFAULT_LEASE,
+                 retries=DEFAULT_RETRIES):
+        self.directories = list(directories)
+        self.config = config
+        self.give_up = give_up
+        self.token = token
+        self.host = host
+        self.port = port
+        self.lease = lease
+        self.retries = retries
+        self.address = None
+
+        # Only touched from the event loop's thread
+        self.pending = collections.deque(range(len(self.directories)))
+        self.leases = {}
+        self.attempts = collections.Counter()
+        self.done = set()
+        self.worker_ids = itertools.count(1)
+        self.connections = set()
+
+        # Handed from the event loop's thread to iter_results
+        self.results = queue.Queue()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.error = None
+        started = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        if self.error:
+            self.thread.join()
+            raise self.error
+        return self.address
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(
+                self._handle, self.host, self.port, limit=MAX_MESSAGE_SIZE))
+        except OSError as e:
+            self.error = e
+            started.set()
+            self.loop.close()
+            return
+        self.address = server.sockets[0].getsockname()[:2]
+        expiry = self.loop.create_task(self._expire_leases())
+        started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # Hang up on the workers, which then see there is nothing left
+            server.close()
+            tasks = [expiry] + list(self.connections)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(server.wait_closed())
+            self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def iter_results(self):
+        '''
+        Yields (info, grid) for each directory, in order, as soon as it and
+        every directory before it have been graded
+        '''
+        finished = {}
+        next_index = 0
+        while next_index < len(self.directories):
+            index, info, grid = self.results.get()
+            finished[index] = info, grid
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    async def _handle(self, reader, writer):
+        worker = None
+        self.connections.add(asyncio.current_task())
+        try:
+            hello = await receive(reader)
+            if not hello or hello.get('type') != 'hello':
+                return
+            if not self._check_token(hello.get('token')):
+                await send(writer, {'type': 'error', 'message': 'Bad token'})
+                return
+            worker = next(self.worker_ids)
+            await send(writer, dict(self.config, type='config'))
+            while True:
+                message = await receive(reader)
+                if message is None:
+                    break
+                kind = message.get('type')
+                if kind == 'request':
+                    await send(writer, self._assign(
+                        worker, message.get('max', 1)))
+                elif kind == 'result':
+                    self._accept(worker, message)
+                elif kind == 'heartbeat':
+                    self._renew(worker)
+        except (ConnectionError, ValueError, KeyError, TypeError):
+            pass
+        except asyncio.CancelledError:
+            # Stopping, so there is no one left to hand the leases to
+            worker = None
+        finally:
+            self.connections.discard(asyncio.current_task())
+            if worker is not None:
+                self._release(worker)
+            writer.close()
+
+    def _check_token(self, token):
+        if not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token.encode('utf-8'),
+                                   self.token.encode('utf-8'))
+
+    def _assign(self, worker, count):
+        if len(self.done) == len(self.directories):
+            return {'type': 'done'}
+        batch = []
+        deadline = time.monotonic() + self.lease
+        while self.pending and len(batch) < count:
+            index = self.pending.popleft()
+            if index in self.done:
+                continue
+            self.leases[index] = worker, deadline
+            batch.append([index, self.directories[index]])
+        if not batch:
+            return {'type': 'wait', 'seconds': WAIT_INTERVAL}
+        return {'type': 'work', 'lease': self.lease, 'directories': batch}
+
+    def _accept(self, worker, message):
+        # Only from the worker holding the lease, so a worker can't report on
+        # directories it wasn't given, and one whose lease ran out can't
+        # race the worker the directory was handed to
+        index = message['index']
+        holder, _ = self.leases.get(index, (None, None))
+        if holder != worker:
+            return
+        self._complete(index, message['info'], message['grid'])
+
+    def _complete(self, index, info, grid):
+        self.done.add(index)
+        self.leases.pop(index, None)
+        grid = [(tuple(key), result) for key, result in grid]
+        self.results.put((index, info, grid))
+
+    def _renew(self, worker):
+        deadline = time.monotonic() + self.lease
+        for index, (holder, _) in list(self.leases.items()):
+            if holder == worker:
+                self.leases[index] = worker, deadline
+
+    def _release(self, worker):
+        for index, (holder, _) in list(self.leases.items()):
+            if holder == worker:
+                self._retry(index, 'its worker disconnected')
+
+    def _retry(self, index, reason):
+        del self.leases[index]
+        self.attempts[index] += 1
+        if self.attempts[index] <= self.retries:
+            # Put back at the front, as later results wait on this one
+            self.pending.appendleft(index)
+            return
+        directory = self.directories[index]
+        info, grid = self.give_up(directory, 'Gave up after %i attempts, '
+                                  'the last as %s' % (
+                                      self.attempts[index], reason))
+        self._complete(index, info, grid)
+
+    async def _expire_leases(self):
+        while True:
+            await asyncio.sleep(min(self.lease / 4, 1.0))
+            now = time.monotonic()
+            for index, (holder, deadline) in list(self.leases.items()):
+                if deadline < now:
+                    self._retry(index, 'its lease expired')
+
+
+class Worker:
+    '''
+    Connects to a coordinator and grades directories until there are none
+    left. load_plan(config) should return the plan for the coordinator's
+    config, and grade(directories, plan) a list of (info, grid) pairs.
+    token has to match the coordinator's, or RefusedError is raised.
+    '''
+    def __init__(self, address, token, load_plan, grade, name=None,
+                 chunk_size=1, connect_timeout=30.0):
+        self.address = address
+        self.token = token
+        self.load_plan = load_plan
+        self.grade = grade
+        self.name = name or socket.gethostname()
+        self.chunk_size = chunk_size
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # The coordinator may still be starting up
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return socket.create_connection(self.address)
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(WAIT_INTERVAL)
+
+    def send(self, message):
+        with self.lock:
+            self.fd.write(encode(message))
+            self.fd.flush()
+
+    def receive(self):
+        return decode(self.fd.readline())
+
+    @contextlib.contextmanager
+    def heartbeat(self, lease):
+        '''
+        Renews the leases every third of the lease while the block runs
+        '''
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(lease / 3):
+                try:
+                    self.send({'type': 'heartbeat'})
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def run(self):
+        '''
+        Returns the number of directories graded
+        '''
+        graded = 0
+        with self.connect() as sock, sock.makefile('rwb') as self.fd:
+            self.send({'type': 'hello', 'name': self.name,
+                       'token': self.token})
+            config = self.receive()
+            if config is None:
+                return graded
+            if config.get('type') == 'error':
+                raise RefusedError(config['message'])
+            plan = self.load_plan(config)
+            while True:
+                try:
+                    self.send({'type': 'request', 'max': self.chunk_size})
+                    reply = self.receive()
+                except ConnectionError:
+                    # The coordinator hangs up once it has every result
+                    reply = None
+                if reply is None or reply['type'] == 'done':
+                    return graded
+                if reply['type'] == 'wait':
+                    time.sleep(reply['seconds'])
+                    continue
+                indexes, directories = zip(*reply['directories'])
+                with self.heartbeat(reply['lease']):
+                    results = self.grade(list(directories), plan)
+                for index, (info, grid) in zip(indexes, results):
+                    self.send({
+                        'type': 'result',
+                        'index': index,
+                        'info': info,
+                        'grid': grid,
+                    })
+                graded += len(results)
@@ -0,0 +1,236 @@
+'''
+Shared, memoized file reading for validators that check file contents, so
+that many checks against the same file only read and sanitize it once
+'''
+import collections
+import re
+
+import archive
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+regexp_whitespace = re.compile(r'\s+', re.MULTILINE)
+
+
+def estimate_size(contents):
+    '''
+    Rough size in bytes of sanitized contents, which is either a string or
+    a list of words
+    '''
+    if isinstance(contents, str):
+        return len(contents)
+    return sum(len(word) + 8 for word in contents)
+
+
+def patterns_overlap(a, b):
+    '''
+    Checks if an occurrence of a could ever overlap an occurrence of b
+    '''
+    if a in b or b in a:
+        return True
+    for i in range(1, min(len(a), len(b))):
+        if a.endswith(b[:i]) or b.endswith(a[:i]):
+            return True
+    return False
+
+
+def count_all(contents, patterns):
+    '''
+    Returns a dict of the number of non-overlapping occurrences of each of
+    the patterns in contents, as str.count or list.count would, scanning
+    contents once where possible
+    '''
+    patterns = set(patterns)
+    if not isinstance(contents, str):
+        words = collections.Counter(contents)
+        return {pattern: words[pattern] for pattern in patterns}
+
+    counts = {}
+    if '' in patterns:
+        patterns.remove('')
+        counts[''] = contents.count('')
+
+    # A single alternation only finds the same occurrences as separate
+    # scans would if no two of its patterns can overlap each other, so
+    # split the patterns into groups of mutually independent patterns
+    groups = []
+    for pattern in sorted(patterns):
+        for group in groups:
+            if not any(patterns_overlap(pattern, other) for other in group):
+                group.append(pattern)
+                break
+        else:
+            groups.append([pattern])
+
+    for group in groups:
+        if len(group) == 1:
+            counts[group[0]] = contents.count(group[0])
+            continue
+        regexp = re.compile('|'.join(re.escape(p) for p in group))
+        matches = collections.Counter(
+            match.group() for match in regexp.finditer(contents))
+        for pattern in group:
+            counts[pattern] = matches[pattern]
+    return counts
+
+
+def has_border(pattern):
+    '''
+    Checks if pattern can overlap itself, eg "aa" or "abab"
+    '''
+    return any(
+        pattern.endswith(pattern[:i]) for i in range(1, len(pattern)))
+
+
+def iter_sanitized_chunks(path, normalize_whitespace=False, ignore_case=False,
+                          chunk_size=CHUNK_SIZE):
+    '''
+    Reads path a chunk at a time, yielding chunks that when joined together
+    equal the whole file sanitized as FileTextValidator.sanitize would
+    (before splitting into words)
+    '''
+    pending = ''
+    with archive.open_text(path) as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), ''):
+            text = pending + chunk
+            pending = ''
+            if normalize_whitespace:
+                # A run of whitespace may continue into the next chunk, so
+                # hold it back until the next chunk is read
+                end = len(text.rstrip())
+                text, pending = text[:end], text[end:]
+                text = regexp_whitespace.sub(' ', text)
+            if ignore_case:
+                text = text.lower()
+            yield text
+    if pending:
+        yield ' '
+
+
+def stream_count(path, pattern, normalize_whitespace=False, ignore_case=False,
+                 whole_word_only=False, chunk_size=CHUNK_SIZE):
+    '''
+    Counts occurrences of pattern in path without holding the whole file in
+    memory, giving the same result as counting in the fully sanitized file
+    '''
+    chunks = iter_sanitized_chunks(
+        path, normalize_whitespace, ignore_case, chunk_size)
+    if whole_word_only:
+        return stream_count_words(chunks, pattern)
+
+    if not pattern:
+        return sum(len(text) for text in chunks) + 1
+
+    regexp = re.compile(re.escape(pattern)) if has_border(pattern) else None
+    count = 0
+    carry = ''
+    for text in chunks:
+        buffer = carry + text
+        last_end = 0
+        if regexp is None:
+            # Occurrences can't overlap, so the last one is simply the
+            # right-most one
+            count += buffer.count(pattern)
+            index = buffer.rfind(pattern)
+            if index != -1:
+                last_end = index + len(pattern)
+        else:
+            for match in regexp.finditer(buffer):
+                count += 1
+                last_end = match.end()
+
+        # Keep just enough of the end of the buffer to find occurrences
+        # spanning into the next chunk
+        keep = max(last_end, len(buffer) - len(pattern) + 1)
+        carry = buffer[keep:]
+    return count
+
+
+def stream_count_words(chunks, word):
+    count = 0
+    pending = ''
+    for text in chunks:
+        text = pending + text
+        # The last word may continue into the next chunk
+        end = len(text)
+        while end and not text[end - 1].isspace():
+            end -= 1
+        text, pending = text[:end], text[end:]
+        count += text.split().count(word)
+    count += pending.split().count(word)
+    return count
+
+
+class CachedFile:
+    def __init__(self, contents):
+        self.contents = contents
+        self.counts = {}
+
+
+class FileCache:
+    '''
+    LRU cache of sanitized file contents, keyed by path, modification time,
+    size and however the contents were sanitized. Files that changed since
+    they were cached simply miss, since their mtime or size differ.
+    '''
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def _get(self, path, sanitize, sanitize_key):
+        mtime_ns, size = archive.stat_key(path)
+        key = (path, mtime_ns, size, sanitize_key)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        with archive.open_text(path) as fd:
+            contents = fd.read()
+        if sanitize is not None:
+            contents = sanitize(contents)
+        cached_file = CachedFile(contents)
+        self._store(key, cached_file)
+        return cached_file
+
+    def _store(self, key, cached_file):
+        size = estimate_size(cached_file.contents)
+        if size > self.max_size:
+            return
+        self.entries[key] = cached_file
+        self.size += size
+        while self.size > self.max_size:
+            old_key, old_file = self.entries.popitem(last=False)
+            self.size -= estimate_size(old_file.contents)
+
+    def read(self, path, sanitize=None, sanitize_key=None):
+        '''
+        Returns the contents of path, passed through sanitize. Any callable
+        given as sanitize must always return the same result for the same
+        sanitize_key.
+        '''
+        return self._get(path, sanitize, sanitize_key).contents
+
+    def count(self, path, pattern, patterns=(), sanitize=None,
+              sanitize_key=None):
+        '''
+        Returns the number of occurrences of pattern in the sanitized
+        contents of path. The first time any pattern is counted for a file,
+        all of the given patterns are counted along with it in one pass.
+        '''
+        cached_file = self._get(path, sanitize, sanitize_key)
+        if pattern not in cached_file.counts:
+            pending = set(patterns) - set(cached_file.counts)
+            pending.add(pattern)
+            cached_file.counts.update(
+                count_all(cached_file.contents, pending))
+        return cached_file.counts[pattern]
+
+
+# Cache shared by all validators in this process
+default_cache = FileCache()
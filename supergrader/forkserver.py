@@ -0,0 +1,364 @@
+'''
+A fork server for running student Python code. The server is forked from
+the grading process once and imports the modules the checks have in common,
+eg numpy or pytest. It then forks a child for each check, which starts in a
+few milliseconds with everything already imported, where a new interpreter
+would take hundreds. Requests and results are JSON lines over pipes:
+
+    grading process                     server
+    {"id": 1, "check": 3,
+     "directory": ..., "timeout": 10}  ->
+                                       <-  {"id": 1, "result": "F",
+                                            "message": ...}
+
+Checks are registered before the server is forked, since the children run
+them from their copy of the grading process's memory. The server is forked
+again if a new check is registered later, eg after a profile is reloaded
+with a changed validator.
+'''
+import atexit
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import selectors
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+CHUNK_SIZE = 65536
+
+
+class CheckError(Exception):
+    pass
+
+
+class TailWriter:
+    '''
+    Text stream keeping only the last size characters written to it, to
+    stand in for sys.stdout
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.parts = []
+        self.length = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        if self.length > 2 * self.size:
+            self.parts = [self.getvalue()]
+            self.length = len(self.parts[0])
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)[-self.size:]
+
+
+# Checks that can be run, by key, each a (function, modules to preload)
+# pair. function(directory) runs in the forked child, and returns a
+# (result, message) pair.
+_checks = {}
+
+
+def register(identity, function, preload=()):
+    '''
+    Returns the key to run function with. identity should identify what
+    function does, eg a validator's identity: checks with the same identity
+    share a key, so reloading a profile reuses the checks that haven't
+    changed rather than adding to them and forking the server again.
+    '''
+    key = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+    if key not in _checks:
+        _checks[key] = function, tuple(preload)
+    return key
+
+
+def _send(fd, message):
+    data = (json.dumps(message) + '\n').encode('utf-8')
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _close_fds(keep):
+    # The server shouldn't hold open anything of the grading process's, eg
+    # sockets it has since closed
+    low = 3
+    for fd in sorted(keep):
+        os.closerange(low, fd)
+        low = fd + 1
+    os.closerange(low, os.sysconf('SC_OPEN_MAX'))
+
+
+def _run_child(function, request):
+    '''
+    Runs in the child forked for a check, in a session of its own so it can
+    be killed along with anything it started
+    '''
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    directory = request['directory']
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    result, message = function(directory)
+    return {'result': result, 'message': message}
+
+
+class Child:
+    __slots__ = ('request', 'pid', 'deadline', 'chunks', 'timed_out')
+
+    def __init__(self, request, pid, deadline):
+        self.request = request
+        self.pid = pid
+        self.deadline = deadline
+        self.chunks = []
+        self.timed_out = False
+
+
+class Server:
+    '''
+    The server side, running in the forked server process
+    '''
+    def __init__(self, requests_fd, responses_fd, checks):
+        self.requests_fd = requests_fd
+        self.responses_fd = responses_fd
+        self.checks = checks
+        self.selector = selectors.DefaultSelector()
+        self.children = {}
+
+    def serve(self):
+        self.selector.register(self.requests_fd, selectors.EVENT_READ)
+        pending = b''
+        while True:
+            for key, events in self.selector.select(self._get_timeout()):
+                data = os.read(key.fd, CHUNK_SIZE)
+                if key.fd != self.requests_fd:
+                    self._read_child(key.fd, data)
+                    continue
+                if not data:
+                    # The grading process is done, or gone
+                    self._kill_all()
+                    return
+                pending += data
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    self._start(json.loads(line.decode('utf-8')))
+            self._expire()
+
+    def _get_timeout(self):
+        deadlines = [child.deadline for child in self.children.values()
+                     if child.deadline is not None and not child.timed_out]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.monotonic(), 0)
+
+    def _start(self, request):
+        function, preload = self.checks[request['check']]
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_fd)
+                for fd in [self.requests_fd, self.responses_fd] + \
+                        list(self.children):
+                    os.close(fd)
+                try:
+                    response = _run_child(function, request)
+                except BaseException:
+                    response = {'result': 'E',
+                                'message': traceback.format_exc()}
+                _send(write_fd, response)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        timeout = request.get('timeout')
+        deadline = time.monotonic() + timeout if timeout else None
+        self.children[read_fd] = Child(request, pid, deadline)
+        self.selector.register(read_fd, selectors.EVENT_READ)
+
+    def _read_child(self, fd, data):
+        child = self.children[fd]
+        if data:
+            child.chunks.append(data)
+            return
+        self.selector.unregister(fd)
+        os.close(fd)
+        del self.children[fd]
+        pid, status = os.waitpid(child.pid, 0)
+        response = {'id': child.request['id']}
+        result = self._parse_result(child.chunks)
+        if child.timed_out:
+            response['timeout'] = True
+        elif result is not None:
+            response.update(result)
+        elif os.WIFSIGNALED(status):
+            name = signal.Signals(os.WTERMSIG(status)).name
+            response.update(result='F', message='Check killed by %s' % name,
+                            signal=name)
+        else:
+            response.update(result='F', message='Check exited with status %i'
+                            % os.WEXITSTATUS(status))
+        _send(self.responses_fd, response)
+
+    def _parse_result(self, chunks):
+        # Nothing, or only part of a result, if the child was killed
+        try:
+            return json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            return None
+
+    def _kill(self, child):
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Not yet in a session of its own
+            try:
+                os.kill(child.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _expire(self):
+        now = time.monotonic()
+        for child in self.children.values():
+            if child.deadline is not None and child.deadline <= now and \
+                    not child.timed_out:
+                child.timed_out = True
+                self._kill(child)
+
+    def _kill_all(self):
+        for child in self.children.values():
+            self._kill(child)
+            os.waitpid(child.pid, 0)
+
+
+def _serve(requests_fd, responses_fd, checks, preload):
+    # Ctrl-C is for the grading process, which then closes the pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _close_fds([requests_fd, responses_fd])
+
+    # sys.stdout and sys.stderr may have been replaced with streams whose
+    # files were just closed
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+    Server(requests_fd, responses_fd, checks).serve()
+
+
+class ForkServer:
+    '''
+    The grading process's side: forks the server when first needed, then
+    hands it checks to run. run may be called from several threads at
+    once.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owner = os.getpid()
+        self.pid = None
+        self.known = set()
+
+    def start(self):
+        checks = dict(_checks)
+        preload = sorted(set(itertools.chain.from_iterable(
+            modules for function, modules in checks.values())))
+        requests_read, requests_write = os.pipe()
+        responses_read, responses_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Never return into the grading process's code, or run its
+            # atexit handlers
+            try:
+                os.close(requests_write)
+                os.close(responses_read)
+                _serve(requests_read, responses_write, checks, preload)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        os.close(requests_read)
+        os.close(responses_write)
+        self.pid = pid
+        self.known = set(checks)
+        self.requests = os.fdopen(requests_write, 'wb')
+        self.pending = {}
+        self.ids = itertools.count(1)
+        reader = threading.Thread(
+            target=self._read, args=(os.fdopen(responses_read, 'rb'),
+                                     self.pending),
+            daemon=True)
+        reader.start()
+
+    def _read(self, responses, pending):
+        with responses:
+            for line in responses:
+                response = json.loads(line.decode('utf-8'))
+                with self.lock:
+                    future = pending.pop(response['id'])
+                future.set_result(response)
+        with self.lock:
+            for future in pending.values():
+                future.set_exception(CheckError('The fork server exited'))
+            pending.clear()
+
+    def stop(self):
+        if self.pid is None:
+            return
+        self.requests.close()
+        os.waitpid(self.pid, 0)
+        self.pid = None
+
+    def run(self, key, directory, timeout=None):
+        '''
+        Runs the check registered as key on directory, returning the
+        response, with a "timeout" key if it took longer than timeout
+        seconds and was killed
+        '''
+        future = Future()
+        with self.lock:
+            if key not in self.known:
+                self.stop()
+                self.start()
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            try:
+                self.requests.write((json.dumps({
+                    'id': request_id,
+                    'check': key,
+                    'directory': directory,
+                    'timeout': timeout,
+                }) + '\n').encode('utf-8'))
+                self.requests.flush()
+            except OSError:
+                # Gone, so start another next time
+                del self.pending[request_id]
+                self.pid = None
+                self.known = set()
+                raise CheckError('The fork server exited')
+        return future.result()
+
+
+# Shared by every validator in the process
+_server = None
+
+
+def get_server():
+    global _server
+    # Forked worker processes inherit the server, but need their own
+    if _server is None or _server.owner != os.getpid():
+        _server = ForkServer()
+        atexit.register(_server.stop)
+    return _server
@@ -0,0 +1,142 @@
+'''
+Reporters receive each directory's results as soon as it is graded
+'''
+import csv
+import json
+import sys
+
+import utils
+
+
+def print_report(results_grid, results_list, verbose=False, file=None):
+    for result in results_list:
+        if result['failures'] + result['skipped']:
+            print_result(file=file, **result)
+        elif verbose:
+            print_result(file=file, **result)
+    s = utils.format_matrix(results_grid)
+    print(s, file=file)
+
+def print_result(directory, errors, successes, failures, skipped, messages,
+                 file=None, **extra):
+    print(
+        utils.Term.Bold(directory),
+        '-',
+        utils.Term.Green(successes),
+        utils.Term.Red(failures),
+        utils.Term.Yellow(skipped),
+        file=file,
+    )
+
+    for category, message_list in messages.items():
+        if message_list:
+            print(' ' * 4 + '[' + category.upper() + ']', file=file)
+            for msg in message_list:
+                print(' ' * 8 + '-', msg, file=file)
+
+
+class Reporter:
+    '''
+    Base class for reporters. report is called with the info record and
+    results grid entries of each directory, in order, as soon as it has
+    been graded.
+    '''
+    def __init__(self, stream=None, verbose=False):
+        self.stream = stream or sys.stdout
+        self.verbose = verbose
+
+    def start(self, plan):
+        pass
+
+    def report(self, info, grid):
+        raise NotImplementedError()
+
+    def update(self, results):
+        '''
+        Called with a list of (info, grid) for directories that have been
+        regraded, eg in watch mode
+        '''
+        for info, grid in results:
+            self.report(info, grid)
+
+    def finish(self):
+        pass
+
+
+class TextReporter(Reporter):
+    '''
+    The classic terminal report, printed once every directory is graded
+    '''
+    def start(self, plan):
+        self.results_grid = {}
+        self.results_list = []
+        self.indices = {}
+
+    def report(self, info, grid):
+        self.indices[info['directory']] = len(self.results_list)
+        self.results_list.append(info)
+        self.results_grid.update(grid)
+
+    def update(self, results):
+        for info, grid in results:
+            self.results_list[self.indices[info['directory']]] = info
+            self.results_grid.update(grid)
+            print_result(file=self.stream, **info)
+        print(utils.format_matrix(self.results_grid), file=self.stream)
+
+    def finish(self):
+        print_report(self.results_grid, self.results_list, self.verbose,
+                     file=self.stream)
+
+
+def get_results(grid):
+    '''
+    Returns a dict of validator label, which is unique within the plan, to
+    result from results grid entries
+    '''
+    return {name: result for (dirname, name), result in grid}
+
+
+class JSONLinesReporter(Reporter):
+    '''
+    Writes one JSON object per directory, per line
+    '''
+    def report(self, info, grid):
+        record = dict(info)
+        record['results'] = get_results(grid)
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+
+class CSVReporter(Reporter):
+    '''
+    Writes one row per directory, with a column for each validator's result
+    '''
+    COLUMNS = ['directory', 'successes', 'failures', 'errors', 'skipped']
+
+    def start(self, plan):
+        self.names = [plan.labels[validator] for validator in plan]
+        self.writer = csv.writer(self.stream)
+        self.writer.writerow(self.COLUMNS + self.names + ['messages'])
+        self.stream.flush()
+
+    def report(self, info, grid):
+        results = get_results(grid)
+        messages = [
+            msg
+            for category in ('error', 'fail', 'skip')
+            for msg in info['messages'][category]
+        ]
+        self.writer.writerow(
+            [info[column] for column in self.COLUMNS] +
+            [results.get(name, '') for name in self.names] +
+            ['; '.join(messages)]
+        )
+        self.stream.flush()
+
+
+REPORTERS = {
+    'text': TextReporter,
+    'jsonl': JSONLinesReporter,
+    'csv': CSVReporter,
+}
@@ -0,0 +1,140 @@
+'''
+Optional SQLite database of results, keeping the history of every run
+'''
+import json
+import sqlite3
+import time
+
+import cache
+
+DEFAULT_BATCH_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    profile TEXT,
+    arguments TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    directory TEXT NOT NULL,
+    validator TEXT NOT NULL,
+    result TEXT NOT NULL,
+    message TEXT,
+    duration REAL,
+    cache_key TEXT
+);
+CREATE INDEX IF NOT EXISTS results_directory
+    ON results (directory, validator);
+CREATE INDEX IF NOT EXISTS results_cache_key ON results (cache_key);
+'''
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class ResultsStore:
+    '''
+    Records every validator result of a run. Rows are buffered and written
+    batch_size at a time in a single transaction, so the grading loop never
+    waits on the disk for each result.
+    '''
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.connection = connect(path)
+        self.batch_size = batch_size
+        self.pending = []
+        self.run_id = None
+
+    def start_run(self, profile, arguments=None):
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (started, profile, arguments) '
+                'VALUES (?, ?, ?)',
+                (time.time(), profile, json.dumps(arguments)),
+            )
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add(self, info):
+        '''
+        Queue up the results in a directory's info record
+        '''
+        for detail in info['validators']:
+            timing = info['timings'].get(detail['name'])
+            self.pending.append((
+                self.run_id,
+                info['directory'],
+                detail['name'],
+                detail['result'],
+                detail['message'],
+                timing['wall'] if timing else None,
+                detail.get('key'),
+            ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO results (run_id, directory, validator, result, '
+                'message, duration, cache_key) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self.pending,
+            )
+        self.pending = []
+
+    def finish(self):
+        self.flush()
+        with self.connection:
+            self.connection.execute(
+                'UPDATE runs SET finished = ? WHERE id = ?',
+                (time.time(), self.run_id),
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def history(self, directory, validator=None):
+        '''
+        Returns (run_id, validator, result, message) rows for a directory,
+        oldest run first, eg to spot regressions across resubmissions
+        '''
+        query = ('SELECT run_id, validator, result, message FROM results '
+                 'WHERE directory = ?')
+        params = [directory]
+        if validator is not None:
+            query += ' AND validator = ?'
+            params.append(validator)
+        return self.connection.execute(
+            query + ' ORDER BY run_id, rowid', params).fetchall()
+
+
+class StoreLookup:
+    '''
+    Read-only view of a results database for use as the fallback of a
+    ResultCache, so results recorded in earlier runs can be replayed
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    def get(self, key):
+        if self.connection is None:
+            self.connection = connect(self.path)
+        placeholders = ', '.join('?' for _ in cache.CACHEABLE_RESULTS)
+        row = self.connection.execute(
+            'SELECT result, message FROM results WHERE cache_key = ? AND '
+            'result IN (%s) ORDER BY run_id DESC LIMIT 1' % placeholders,
+            [key] + sorted(cache.CACHEABLE_RESULTS),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
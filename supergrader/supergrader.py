@@ -1,23 +1,40 @@
 import argparse
+import asyncio
+import heapq
 import os
 import sys
 import importlib
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 # 1st party
 import validators
 import utils
+import cache
+import watch
+import dirindex
+import archive
+import reporters
+import timings
+import store
+import checkpoint
+import distributed
+import daemon
+import workspace
 
 _is_verbose = False
+_result_cache = None
 parser = None
 
+MAX_CHUNK_SIZE = 32
+
 class ArgError(ValueError):
     pass
 
-def parse_args(argv):
+def parse_args(argv, prog='supergrader', add_arguments=None):
     global parser
     parser = argparse.ArgumentParser(
-        prog='supergrader',
+        prog=prog,
         description='Symlink files recursively, good for dotfiles.'
     )
     supergrader_profile = os.environ.get('SUPERGRADER_PROFILE', 'sgprofile')
@@ -26,6 +43,59 @@ def parse_args(argv):
                         action='store_true')
     parser.add_argument('-p', '--profile', default=supergrader_profile,
                         help='Python module path to "profile" module')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of directories to grade in parallel')
+    parser.add_argument('-c', '--concurrency', type=int, default=0,
+                        help='run up to this many validators at once using '
+                             'asyncio, overlapping shell commands across '
+                             'directories')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='always rerun validators instead of replaying '
+                             'results for unchanged directories')
+    parser.add_argument('--cache-dir', default=os.environ.get(
+                            'SUPERGRADER_CACHE', cache.DEFAULT_CACHE_DIR),
+                        help='directory to store cached results in')
+    parser.add_argument('--cache-size', type=int,
+                        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help='maximum size of the result cache, in MB')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run commands in the submission directories '
+                             'themselves, rather than private copies')
+    parser.add_argument('--workspace-dir',
+                        help='directory to make copies of submissions for '
+                             'commands in, ideally on the same filesystem '
+                             'as the submissions')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running, regrading directories as they '
+                             'change')
+    parser.add_argument('--interval', type=float,
+                        default=watch.DEFAULT_INTERVAL,
+                        help='seconds between checks for changes when '
+                             'watching without inotify')
+    parser.add_argument('-f', '--format', default='text',
+                        choices=sorted(reporters.REPORTERS),
+                        help='report format, jsonl and csv write a record '
+                             'as soon as each directory is graded')
+    parser.add_argument('-o', '--output',
+                        help='file to write the report to, instead of stdout')
+    parser.add_argument('--timings', action='store_true',
+                        help='print a table of validators ranked by the '
+                             'time they took')
+    parser.add_argument('--timings-json',
+                        help='file to write raw validator timings to, '
+                             'as JSON')
+    parser.add_argument('--db',
+                        help='SQLite database to record results of every '
+                             'run in, which is also used as a fallback for '
+                             'the result cache')
+    parser.add_argument('--checkpoint',
+                        help='file to record each finished directory in, '
+                             'so the run can be resumed')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip directories already graded with the same '
+                             'profile according to the checkpoint file')
+    if add_arguments:
+        add_arguments(parser)
     parser.add_argument('directories', nargs='*',
                         help='one or more activity or assignment directories')
     args = parser.parse_args(argv)
@@ -40,12 +110,28 @@ def check_args(args):
     '''
     if not args.directories:
         raise ArgError()
+    if args.jobs < 1 or args.concurrency < 0:
+        raise ArgError()
+    if args.resume and not args.checkpoint:
+        raise ArgError()
     if args.verbose:
         global _is_verbose
         _is_verbose = True
     # Expand all relevant user directories
     #args.source = os.path.expanduser(args.source)
 
+def setup_cache(args):
+    global _result_cache
+    _result_cache = None
+    if args.cache:
+        max_size = args.cache_size * 1024 * 1024
+        fallback = store.StoreLookup(args.db) if args.db else None
+        _result_cache = cache.ResultCache(args.cache_dir, max_size, fallback)
+    return _result_cache
+
+def setup_workspaces(args):
+    workspace.setup(args.isolate, args.workspace_dir)
+
 def get_profile(args):
     sys.path.append(os.getcwd())
     profile = importlib.import_module(args.profile)
@@ -59,7 +145,830 @@ def get_profile(args):
 def get_validator_classes(profile):
     return profile.VALIDATORS
 
-def main(args):
+def resolve_validator_class(validator_class):
+    '''
+    Check if validator class is actually a list or tuple that consists of the
+    name of the function, and keyword args, and if so build the class
+    '''
+    if hasattr(validator_class, '__iter__'):
+        name, kwargs = validator_class
+        if hasattr(validators, name + '_validator'):
+            name = name + '_validator'
+        if not hasattr(validators, name):
+            raise validators.ConfigurationError('Unknown validator: ' + name)
+        validator_function = getattr(validators, name)
+        validator_class = validator_function(**kwargs)
+    return validator_class
+
+
+class Plan(list):
+    '''
+    The validators of a profile, in profile order, which is the order their
+    results are reported in. The order to run them in is kept as `order`,
+    and the name each one's results are reported under as `labels`.
+    '''
+    def __init__(self, validators):
+        super().__init__(validators)
+        self.dependencies = get_dependencies(self)
+        self.order = order_plan(self, self.dependencies)
+        self.labels = get_labels(self)
+
+
+def compile_plan(validator_classes):
+    '''
+    Resolve and build every validator in the profile once per run, checking
+    their configuration up front, so that grading each directory only has
+    to run them. Raises ConfigurationError if the profile is invalid.
+    '''
+    validators.FileTextValidator.clear_pattern_groups()
+    return Plan(
+        resolve_validator_class(validator_class)()
+        for validator_class in validator_classes
+    )
+
+
+def get_labels(plan):
+    '''
+    Returns a dict of each validator to a label unique within the plan, its
+    name unless an earlier validator has the same name (eg the default
+    class name), in which case its position among them is added: "Name (2)"
+    '''
+    taken = set(validator.get_name() for validator in plan)
+    seen = {}
+    labels = {}
+    for validator in plan:
+        name = validator.get_name()
+        if name not in seen:
+            seen[name] = 1
+            labels[validator] = name
+            continue
+        label = name
+        while label in taken:
+            seen[name] += 1
+            label = '%s (%i)' % (name, seen[name])
+        taken.add(label)
+        labels[validator] = label
+    return labels
+
+
+def get_dependencies(plan):
+    '''
+    Returns a dict of each validator to the list of validators named in its
+    `requires`
+    '''
+    by_name = {}
+    for validator in plan:
+        by_name.setdefault(validator.get_name(), []).append(validator)
+
+    dependencies = {}
+    for validator in plan:
+        requires = validator.requires
+        if isinstance(requires, str):
+            raise validators.ConfigurationError(
+                '%s requires should be a list' % validator.get_name())
+        dependencies[validator] = []
+        for name in requires:
+            if name not in by_name:
+                raise validators.ConfigurationError('%s requires unknown %s' % (
+                    validator.get_name(), name))
+            dependencies[validator].extend(by_name[name])
+    return dependencies
+
+
+def order_plan(plan, dependencies):
+    '''
+    Returns the validators in an order that runs every validator after the
+    ones it requires, and otherwise runs the cheapest first, keeping
+    profile order between validators of the same cost
+    '''
+    position = {validator: i for i, validator in enumerate(plan)}
+    waiting_on = {validator: len(dependencies[validator])
+                  for validator in plan}
+    dependents = {validator: [] for validator in plan}
+    for validator in plan:
+        for dependency in dependencies[validator]:
+            dependents[dependency].append(validator)
+
+    ready = [(validator.cost, position[validator])
+             for validator in plan if not waiting_on[validator]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        cost, i = heapq.heappop(ready)
+        validator = plan[i]
+        order.append(validator)
+        for dependent in dependents[validator]:
+            waiting_on[dependent] -= 1
+            if not waiting_on[dependent]:
+                heapq.heappush(ready, (dependent.cost, position[dependent]))
+
+    if len(order) < len(plan):
+        cycle = [v.get_name() for v in plan if waiting_on[v]]
+        raise validators.ConfigurationError(
+            'Circular requires between ' + ', '.join(cycle))
+    return order
+
+
+def get_blocker(plan, validator, results):
+    '''
+    Returns the name of the first validator required by this one that did
+    not pass, or None if it can run
+    '''
+    for dependency in plan.dependencies[validator]:
+        if results[dependency][0] != '.':
+            return dependency.get_name()
+    return None
+
+
+def skip_result(validator, blocker):
+    return '?', '%s skipped as %s did not pass' % (
+        validator.get_name(), blocker)
+
+
+def new_info(source_d):
+    return {
+        'directory': source_d,
+        'errors': 0,
+        'successes': 0,
+        'failures': 0,
+        'skipped': 0,
+        'messages': {
+            'error': [],
+            'skip': [],
+            'fail': [],
+            'feedback': [],
+        },
+        'timings': {},
+        'validators': [],
+    }
+
+
+def run_validator(validator, source_d):
+    '''
+    Actually run the validator, catching exceptions to mark as failure.
+    Returns a (result, message, cacheable) tuple.
+    '''
+    try:
+        validator.validate(source_d)
+    except Exception as e:
+        return classify_exception(e)
+    return '.', validator.get_feedback(), True
+
+
+async def run_validator_async(validator, source_d, semaphore):
+    '''
+    Like run_validator, but awaits the validator's validate_async, holding
+    the semaphore that limits how many validators run at once. The timing
+    of the validator is returned too, leaving out the time spent waiting
+    for the semaphore.
+    '''
+    timer = timings.Timer(measure_cpu=False)
+    try:
+        async with semaphore:
+            with timer:
+                await validator.validate_async(source_d)
+    except Exception as e:
+        return classify_exception(e) + (timer.as_dict(),)
+    return '.', validator.get_feedback(), True, timer.as_dict()
+
+
+def classify_exception(e):
+    '''
+    Returns the (result, message, cacheable) for a validator's exception.
+    Running out of time or resources may be down to how loaded the machine
+    was, so those results aren't cached.
+    '''
+    if isinstance(e, validators.ValidationUnableToCheckError):
+        return '?', str(e), True
+    if isinstance(e, validators.ValidationError):
+        return 'F', str(e), \
+            not isinstance(e, validators.ValidationLimitError)
+    traceback.print_exception(type(e), e, e.__traceback__)
+    return 'E', str(e), False
+
+
+def record_result(info, source_d, name, result, message, key=None):
+    '''
+    Update the per-directory info accounting with a single validator result
+    '''
+    info['validators'].append({
+        'name': name,
+        'result': result,
+        'message': message,
+        'key': key,
+    })
+    if result == '.':
+        info['successes'] += 1
+        if message:
+            info['messages']['feedback'].append(message)
+        if _is_verbose:
+            utils.success(source_d, name)
+        return
+
+    if _is_verbose:
+        utils.failure(source_d, name)
+    if result == '?':
+        info['skipped'] += 1
+        info['messages']['skip'].append(message)
+    elif result == 'F':
+        info['failures'] += 1
+        info['messages']['fail'].append(message)
+    else:
+        info['failures'] += 1
+        info['errors'] += 1
+        info['messages']['error'].append(message)
+
+
+def record_results(info, grid, source_d, plan, results):
+    '''
+    Record the results of running the plan, in profile order
+    '''
+    for validator in plan:
+        name = plan.labels[validator]
+        result, message, key = results[validator]
+        record_result(info, source_d, name, result, message, key)
+        grid.append((format_matrix_labels(source_d, name), result))
+
+
+def hash_directory(source_d):
+    '''
+    Returns the content digest of the directory, if the result cache is on
+    '''
+    if _result_cache is None:
+        return None
+    return cache.hash_directory(source_d)
+
+
+def get_cache_key(validator, digest, source_d):
+    if digest is None or not validator.cacheable:
+        return None
+    return _result_cache.make_key(digest, validator.identity, source_d)
+
+
+def trace_directory_summary(info):
+    source_d = info['directory']
+    utils.success(source_d, info['successes'])
+    if info['failures']:
+        utils.failure(source_d + ' failures:', info['failures'])
+        utils.failure(source_d + ' errors:', info['errors'])
+
+
+def grade_directory(source_d, plan):
+    '''
+    Run every validator against a single directory, returning the info dict
+    for the directory and a list of (key, result) pairs for the results grid
+    '''
+    return grade_in_lockstep([source_d], plan)[0]
+
+
+def iter_grade_directory(source_d, plan):
+    '''
+    Generator doing the work of grade_directory. Batched validators are not
+    run here, instead the validator is yielded, and the (result, message,
+    cacheable, timing) for this directory should be sent back. The (info,
+    grid) pair is returned once every validator is done.
+    '''
+    if _is_verbose:
+        utils.trace('TARGET', source_d)
+    info = new_info(source_d)
+    grid = []
+    directory_timer = timings.Timer().start()
+    digest = hash_directory(source_d)
+    results = {}
+    for validator in plan.order:
+        name = plan.labels[validator]
+
+        if _is_verbose:
+            utils.trace('Validator', name)
+
+        # Don't bother running checks whose prerequisites failed
+        key = None
+        blocker = get_blocker(plan, validator, results)
+        if blocker:
+            result, message = skip_result(validator, blocker)
+        else:
+            # Replay the result if this directory is unchanged since last run
+            key = get_cache_key(validator, digest, source_d)
+            cached = _result_cache.get(key) if key else None
+            if cached:
+                result, message = cached
+            else:
+                if validator.batched:
+                    result, message, cacheable, timing = yield validator
+                else:
+                    with timings.Timer() as timer:
+                        result, message, cacheable = run_validator(
+                            validator, source_d)
+                    timing = timer.as_dict()
+                info['timings'][name] = timing
+                key = key if cacheable else None
+                if key:
+                    _result_cache.put(key, result, message)
+        results[validator] = result, message, key
+    record_results(info, grid, source_d, plan, results)
+
+    directory_timer.stop()
+    info['time'] = directory_timer.as_dict()
+    dirindex.forget(source_d)
+    archive.forget(source_d)
+    if _is_verbose:
+        trace_directory_summary(info)
+    return info, grid
+
+
+def grade_in_lockstep(directories, plan):
+    '''
+    Grades directories together, so that each batched validator is run once
+    for all the directories waiting on it
+    '''
+    steps = [iter_grade_directory(d, plan) for d in directories]
+    graded = [None] * len(steps)
+    sends = dict.fromkeys(range(len(steps)))
+    while sends:
+        waiting = {}
+        for i, value in sends.items():
+            try:
+                validator = steps[i].send(value)
+            except StopIteration as stop:
+                graded[i] = stop.value
+            else:
+                waiting.setdefault(validator, []).append(i)
+
+        sends = {}
+        for validator, indexes in waiting.items():
+            batch = [directories[i] for i in indexes]
+            sends.update(zip(indexes, run_batch(validator, batch)))
+    return graded
+
+
+def run_batch(validator, directories):
+    '''
+    Runs a batched validator, returning (result, message, cacheable,
+    timing) for each directory. The time taken is split evenly between the
+    directories.
+    '''
+    with timings.Timer() as timer:
+        try:
+            errors = validator.validate_batch(directories)
+        except Exception as e:
+            errors = [e] * len(directories)
+    return get_batch_results(validator, errors, timer)
+
+
+def get_batch_results(validator, errors, timer):
+    timing = {
+        measure: value / len(errors) if value is not None else None
+        for measure, value in timer.as_dict().items()
+    }
+    results = []
+    for error in errors:
+        if error is None:
+            result, message, cacheable = '.', validator.get_feedback(), True
+        else:
+            result, message, cacheable = classify_exception(error)
+        results.append((result, message, cacheable, timing))
+    return results
+
+
+class BatchQueue:
+    '''
+    Gathers up batched validators for the asyncio engine. Once every
+    directory still being graded is waiting on a batched validator, each
+    validator is run once for all of the directories waiting on it.
+    '''
+    def __init__(self, active, semaphore):
+        self.active = active
+        self.semaphore = semaphore
+        self.waiting = {}
+        self.count = 0
+        self.tasks = set()
+
+    async def run(self, validator, source_d):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(validator, []).append((source_d, future))
+        self.count += 1
+        self._flush_if_ready()
+        return await future
+
+    def done(self):
+        self.active -= 1
+        self._flush_if_ready()
+
+    def _flush_if_ready(self):
+        if not self.waiting or self.count < self.active:
+            return
+        waiting, self.waiting, self.count = self.waiting, {}, 0
+        for validator, requests in waiting.items():
+            task = asyncio.ensure_future(self._run(validator, requests))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, validator, requests):
+        directories = [source_d for source_d, future in requests]
+        timer = timings.Timer(measure_cpu=False)
+        try:
+            async with self.semaphore:
+                with timer:
+                    errors = await validator.validate_batch_async(directories)
+        except Exception as e:
+            errors = [e] * len(directories)
+        results = get_batch_results(validator, errors, timer)
+        for (source_d, future), result in zip(requests, results):
+            future.set_result(result)
+
+
+async def grade_directory_async(source_d, plan, semaphore, batches=None):
+    '''
+    Async version of grade_directory. Validators for a single directory
+    still run one after another, but other directories may be graded in
+    the meantime while this one waits on child processes. Batched
+    validators are handed to the BatchQueue, if given.
+    '''
+    if _is_verbose:
+        utils.trace('TARGET', source_d)
+    info = new_info(source_d)
+    grid = []
+
+    # Other directories' child processes finish in the meantime, so child
+    # CPU time can't be attributed to a single validator
+    directory_timer = timings.Timer(measure_cpu=False).start()
+    digest = hash_directory(source_d)
+    results = {}
+    for validator in plan.order:
+        name = plan.labels[validator]
+        key = None
+        blocker = get_blocker(plan, validator, results)
+        if blocker:
+            result, message = skip_result(validator, blocker)
+        else:
+            key = get_cache_key(validator, digest, source_d)
+            cached = _result_cache.get(key) if key else None
+            if cached:
+                result, message = cached
+            else:
+                if validator.batched and batches:
+                    result, message, cacheable, timing = await batches.run(
+                        validator, source_d)
+                else:
+                    result, message, cacheable, timing = \
+                        await run_validator_async(
+                            validator, source_d, semaphore)
+                info['timings'][name] = timing
+                key = key if cacheable else None
+                if key:
+                    _result_cache.put(key, result, message)
+        results[validator] = result, message, key
+    record_results(info, grid, source_d, plan, results)
+
+    directory_timer.stop()
+    info['time'] = directory_timer.as_dict()
+    dirindex.forget(source_d)
+    archive.forget(source_d)
+    if _is_verbose:
+        trace_directory_summary(info)
+    return info, grid
+
+
+async def grade_directories_async(directories, plan, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = BatchQueue(len(directories), semaphore)
+
+    async def grade(source_d):
+        try:
+            return await grade_directory_async(
+                source_d, plan, semaphore, batches)
+        finally:
+            batches.done()
+
+    return await asyncio.gather(*[grade(d) for d in directories])
+
+
+def grade_chunk(directories, plan, concurrency=0):
+    '''
+    Grade a list of directories, returning a list of (info, grid) in the
+    same order, using the asyncio engine if a concurrency limit is given
+    '''
+    if concurrency:
+        return asyncio.run(grade_directories_async(
+            directories, plan, concurrency))
+    return grade_in_lockstep(directories, plan)
+
+
+def get_chunk_size(args, directories, plan):
+    '''
+    Number of directories handed to grade_chunk at a time. Chunks need to
+    be big enough to keep the asyncio engine or the worker pool busy, while
+    still small enough that results come back steadily.
+    '''
+    size = 1
+    if args.concurrency:
+        size = args.concurrency * 4
+    if args.jobs > 1:
+        per_worker = len(directories) // (args.jobs * 4)
+        size = max(size, min(per_worker, MAX_CHUNK_SIZE))
+
+    # Batched validators run once per chunk, so try to fill a batch while
+    # still leaving every worker something to do
+    batch_size = max([v.batch_size for v in plan if v.batched], default=0)
+    if batch_size:
+        per_worker = -(-len(directories) // args.jobs)
+        size = max(size, min(batch_size, per_worker))
+    return size
+
+
+def iter_chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Per-process state for worker processes when grading with --jobs
+_worker_plan = None
+_worker_concurrency = 0
+
+
+def _init_worker(args):
+    global _worker_plan, _worker_concurrency
+    check_args(args)
+    setup_cache(args)
+    setup_workspaces(args)
+    _worker_plan = compile_plan(get_validator_classes(get_profile(args)))
+    _worker_concurrency = args.concurrency
+
+
+def _grade_chunk_worker(directories):
+    return grade_chunk(
+        directories, _worker_plan, _worker_concurrency)
+
+
+def grade_directories(args, plan, directories=None):
+    '''
+    Yields (info, grid) for each directory in args.directories (or the
+    given subset of them), in order, spreading the work across a pool of
+    processes if args.jobs > 1
+    '''
+    if directories is None:
+        directories = args.directories
+    chunks = iter_chunks(directories, get_chunk_size(args, directories, plan))
+    if args.jobs == 1 or len(directories) < 2:
+        for chunk in chunks:
+            yield from grade_chunk(chunk, plan, args.concurrency)
+        return
+
+    # Profiles build validator classes dynamically, so rather than pickling
+    # them each worker imports the profile itself
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             initializer=_init_worker,
+                             initargs=(args,)) as executor:
+        for results in executor.map(_grade_chunk_worker, chunks):
+            yield from results
+
+
+def give_up_result(plan, source_d, message):
+    '''
+    Returns (info, grid) recording every validator as an error, for a
+    directory that no worker managed to grade
+    '''
+    info = new_info(source_d)
+    grid = []
+    record_results(info, grid, source_d, plan,
+                   {validator: ('E', message, None) for validator in plan})
+    return info, grid
+
+
+def grade_distributed(args, plan, directories=None):
+    '''
+    Like grade_directories, but hands the directories out to workers that
+    connect to a coordinator listening on args.bind
+    '''
+    if directories is None:
+        directories = args.directories
+    if not directories:
+        return
+    config = {
+        'profile': args.profile,
+        'plan': checkpoint.plan_identity(plan),
+    }
+    host, port = distributed.parse_address(args.bind)
+    coordinator = distributed.Coordinator(
+        directories, config,
+        lambda source_d, message: give_up_result(plan, source_d, message),
+        args.token, host, port, args.lease, args.retries)
+    try:
+        address = coordinator.start()
+    except OSError as e:
+        utils.error('Unable to listen on %s: %s' % (args.bind, e))
+    print('Coordinator listening on %s:%i' % address, file=sys.stderr)
+    try:
+        yield from coordinator.iter_results()
+    finally:
+        coordinator.stop()
+
+
+def serve_coordinator(argv):
+    args = parse_args(argv, 'supergrader serve-coordinator',
+                      distributed.add_coordinator_arguments)
+    if args.watch:
+        parser.error('--watch is not supported with serve-coordinator')
+    if not args.token:
+        parser.error('a --token for the workers to send is required')
+    main(args, grade_distributed)
+
+
+def add_service_arguments(parser):
+    '''
+    Options for grading shared by the worker and the daemon
+    '''
+    parser.add_argument('-v', '--verbose', help='increase output verbosity',
+                        action='store_true')
+    parser.add_argument('-c', '--concurrency', type=int, default=0,
+                        help='run up to this many validators at once using '
+                             'asyncio')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='always rerun validators instead of replaying '
+                             'results for unchanged directories')
+    parser.add_argument('--cache-dir', default=os.environ.get(
+                            'SUPERGRADER_CACHE', cache.DEFAULT_CACHE_DIR),
+                        help='directory to store cached results in')
+    parser.add_argument('--cache-size', type=int,
+                        default=cache.DEFAULT_MAX_SIZE // (1024 * 1024),
+                        help='maximum size of the result cache, in MB')
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run commands in the submission directories '
+                             'themselves, rather than private copies')
+    parser.add_argument('--workspace-dir',
+                        help='directory to make copies of submissions for '
+                             'commands in, ideally on the same filesystem '
+                             'as the submissions')
+
+
+def parse_worker_args(argv):
+    global parser
+    parser = argparse.ArgumentParser(
+        prog='supergrader worker',
+        description='Grade directories handed out by a coordinator.'
+    )
+    parser.add_argument('coordinator',
+                        help='host:port the coordinator is listening on')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='number of directories to ask for at a time')
+    parser.add_argument('--name', help='name of the worker, defaults to the '
+                                       'hostname')
+    distributed.add_token_argument(parser)
+    add_service_arguments(parser)
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('the coordinator\'s --token is required')
+    args.db = None
+    return args
+
+
+def get_worker_chunk_size(args, plan):
+    '''
+    Like get_chunk_size, for a worker that doesn't know how many
+    directories there are
+    '''
+    size = max(args.concurrency * 4, 1)
+    batch_size = max([v.batch_size for v in plan if v.batched], default=0)
+    return max(size, min(batch_size, MAX_CHUNK_SIZE))
+
+
+def run_worker(args):
+    global _is_verbose
+    _is_verbose = args.verbose
+    if args.concurrency < 0:
+        parser.error('concurrency must not be negative')
+
+    def load_plan(config):
+        # The profile has to be importable by the worker too, eg from a
+        # shared checkout
+        args.profile = config['profile']
+        try:
+            plan = compile_plan(get_validator_classes(get_profile(args)))
+        except validators.ConfigurationError as e:
+            utils.error('Invalid profile: ' + str(e))
+        if checkpoint.plan_identity(plan) != config['plan']:
+            utils.error('Profile %s differs from the coordinator\'s' %
+                        args.profile)
+        setup_cache(args)
+        setup_workspaces(args)
+        worker.chunk_size = args.chunk_size or \
+            get_worker_chunk_size(args, plan)
+        return plan
+
+    worker = distributed.Worker(
+        distributed.parse_address(args.coordinator), args.token, load_plan,
+        lambda directories, plan: grade_chunk(
+            directories, plan, args.concurrency),
+        name=args.name)
+    try:
+        graded = worker.run()
+    except distributed.RefusedError as e:
+        utils.error('The coordinator refused the connection: %s' % e)
+    except OSError as e:
+        utils.error('Lost connection to the coordinator: %s' % e)
+    if _result_cache is not None:
+        _result_cache.evict()
+    if _is_verbose:
+        utils.trace('Directories graded:', str(graded))
+
+
+def parse_daemon_args(argv):
+    global parser
+    parser = argparse.ArgumentParser(
+        prog='supergrader serve',
+        description='Grade directories sent by supergrader client, keeping '
+                    'the profile loaded between jobs.'
+    )
+    parser.add_argument('-p', '--profile', default=os.environ.get(
+                            'SUPERGRADER_PROFILE', 'sgprofile'),
+                        help='Python module path to "profile" module, '
+                             'reloaded whenever its file changes')
+    parser.add_argument('--socket', default=daemon.get_default_socket(),
+                        help='Unix domain socket to listen on')
+    add_service_arguments(parser)
+    args = parser.parse_args(argv)
+    args.db = None
+    args.jobs = 1
+    return args
+
+
+def serve_daemon(args):
+    global _is_verbose
+    _is_verbose = args.verbose
+    if args.concurrency < 0:
+        parser.error('concurrency must not be negative')
+    setup_cache(args)
+    setup_workspaces(args)
+
+    def compile_profile(profile):
+        return compile_plan(get_validator_classes(profile))
+
+    def get_job_reporter(format, verbose, stream):
+        return reporters.REPORTERS[format](stream, verbose=verbose)
+
+    def cleanup():
+        if _result_cache is not None:
+            _result_cache.evict()
+
+    profile = daemon.WarmProfile(lambda: get_profile(args), compile_profile)
+    try:
+        profile.get_plan()
+    except validators.ConfigurationError as e:
+        utils.error('Invalid profile: ' + str(e))
+    server = daemon.Daemon(
+        args.socket, profile,
+        lambda directories, plan: grade_directories(args, plan, directories),
+        get_job_reporter, cleanup)
+    if _is_verbose:
+        utils.trace('Listening on', args.socket)
+    try:
+        server.serve()
+    except OSError as e:
+        utils.error(str(e))
+
+
+def parse_client_args(argv):
+    global parser
+    parser = argparse.ArgumentParser(
+        prog='supergrader client',
+        description='Grade directories with a running supergrader serve.'
+    )
+    parser.add_argument('-v', '--verbose', help='increase output verbosity',
+                        action='store_true')
+    parser.add_argument('--socket', default=daemon.get_default_socket(),
+                        help='Unix domain socket the daemon listens on')
+    parser.add_argument('-f', '--format', default='text',
+                        choices=sorted(reporters.REPORTERS),
+                        help='report format')
+    parser.add_argument('-o', '--output',
+                        help='file to write the report to, instead of stdout')
+    parser.add_argument('directories', nargs='+',
+                        help='one or more activity or assignment directories')
+    return parser.parse_args(argv)
+
+
+def run_client(args):
+    message = {
+        'type': 'grade',
+        'directories': args.directories,
+        'cwd': os.getcwd(),
+        'format': args.format,
+        'verbose': args.verbose,
+    }
+    output = open(args.output, 'w', newline='') if args.output else None
+    try:
+        reply = daemon.request(args.socket, message, output or sys.stdout)
+    except OSError as e:
+        utils.error('Unable to reach the daemon on %s: %s' % (
+            args.socket, e))
+    finally:
+        if output:
+            output.close()
+    if reply['type'] == 'error':
+        utils.error(reply['message'])
+
+
+def main(args, grade=grade_directories):
     try:
         check_args(args)
         profile = get_profile(args)
@@ -67,91 +976,131 @@ def main(args):
     except ArgError:
         parser.print_usage()
         sys.exit(1)
+    try:
+        plan = compile_plan(validator_classes)
+    except validators.ConfigurationError as e:
+        utils.error('Invalid profile: ' + str(e))
+    setup_cache(args)
+    setup_workspaces(args)
 
-    results_grid = {}
-    results_list = []
+    output = open(args.output, 'w', newline='') if args.output else None
+    try:
+        reporter = get_reporter(args, output)
+        reporter.start(plan)
+        collector = None
+        if args.timings or args.timings_json:
+            collector = timings.TimingCollector()
+        results_store = None
+        if args.db:
+            results_store = store.ResultsStore(args.db)
+            results_store.start_run(args.profile, vars(args))
+        try:
+            completed = {}
+            checkpointer = None
+            if args.checkpoint:
+                identity = checkpoint.plan_identity(plan)
+                if args.resume:
+                    completed = checkpoint.load(args.checkpoint, identity)
+                checkpointer = checkpoint.Checkpoint(
+                    args.checkpoint, identity, resume=args.resume)
 
-    # Args are correct, lets now perform necessary steps
-    for source_d in args.directories:
-        if _is_verbose:
-            utils.trace('TARGET', source_d)
-        info = {
-            'directory': source_d,
-            'errors': 0,
-            'successes': 0,
-            'failures': 0,
-            'skipped': 0,
-            'messages': {
-                'error': [],
-                'skip': [],
-                'fail': [],
-                'feedback': [],
-            },
-        }
-        results_list.append(info)
-        for validator_class in validator_classes:
-
-            # Check if validator class is actually a list or tuple that
-            # consists of the name of the function, and keyword args
-            if hasattr(validator_class, '__iter__'):
-                name, kwargs = validator_class
-                if hasattr(validators, name + '_validator'):
-                    name = name + '_validator'
-                validator_function = getattr(validators, name)
-                validator_class = validator_function(**kwargs)
-
-            validator = validator_class()
-            name = validator.get_name()
-
-            if _is_verbose:
-                utils.trace('Validator', name)
-
-            # Actually run the validator, catching exceptions to mark as
-            # failure
-            result = '.'
+            # Args are correct, lets now perform necessary steps. The
+            # checkpoint matters most when grading fails, so it is always
+            # synced and closed.
             try:
-                validator.validate(source_d)
-            except validators.ValidationUnableToCheckError as e:
-                if _is_verbose:
-                    utils.failure(source_d, name)
-                info['skipped'] += 1
-                info['messages']['skip'].append(str(e))
-                result = '?'
-            except validators.ValidationError as e:
-                if _is_verbose:
-                    utils.failure(source_d, name)
-                info['failures'] += 1
-                result = 'F'
-                info['messages']['fail'].append(str(e))
-            except Exception as e:
-                if _is_verbose:
-                    utils.failure(source_d, name)
-                info['failures'] += 1
-                info['errors'] += 1
-                result = 'E'
-                traceback.print_exc()
-                info['messages']['error'].append(str(e))
-            else:
-                info['successes'] += 1
-                feedback = validator.get_feedback()
-                if feedback:
-                    info['messages']['feedback'].append(feedback)
-                if _is_verbose:
-                    utils.success(source_d, name)
+                for info, grid in resume_directories(args, plan, completed,
+                                                     grade):
+                    if checkpointer and info['directory'] not in completed:
+                        checkpointer.add(info, grid)
+                    reporter.report(info, grid)
+                    if collector:
+                        collector.add(info)
+                    if results_store:
+                        results_store.add(info)
+            finally:
+                if checkpointer:
+                    checkpointer.close()
+            if results_store:
+                results_store.finish()
+        finally:
+            # Keep the results of a run that failed part way, which is left
+            # without a finished time
+            if results_store:
+                results_store.flush()
+                results_store.close()
+        if _result_cache is not None:
+            _result_cache.evict()
+        reporter.finish()
+
+        if args.timings:
+            # Keep machine readable reports on stdout parseable
+            stream = sys.stdout if args.format == 'text' else sys.stderr
+            print(collector.format_table(), file=stream)
+        if args.timings_json:
+            collector.write_json(args.timings_json)
+
+        if args.watch:
+            try:
+                watch_directories(args, plan, reporter)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if output:
+            output.close()
 
-            # Set the result to results_grid
-            key = format_matrix_labels(source_d, name)
-            results_grid[key] = result
 
+def resume_directories(args, plan, completed, grade=grade_directories):
+    '''
+    Like grade_directories (or grade), but yields the results of already completed
+    directories from a checkpoint in place of grading them again
+    '''
+    remaining = [d for d in args.directories if d not in completed]
+    if _is_verbose and completed:
+        utils.trace('Resuming, directories left:', str(len(remaining)))
+    graded = grade(args, plan, remaining)
+    for source_d in args.directories:
+        if source_d in completed:
+            yield completed[source_d]
+        else:
+            yield next(graded)
 
+
+def get_reporter(args, stream=None):
+    reporter_class = reporters.REPORTERS[args.format]
+    return reporter_class(stream, verbose=_is_verbose)
+
+
+def watch_directories(args, plan, reporter):
+    '''
+    Regrade directories as they change, reporting the updated results after
+    each pass
+    '''
+    watcher = watch.get_watcher(args.directories, args.interval)
+    in_place = changes_submissions(plan)
+    while True:
+        changed = watcher.wait()
+        if not changed:
+            continue
         if _is_verbose:
-            if not info['failures']:
-                utils.success(source_d, successes)
-            else:
-                utils.success(source_d, successes)
-                utils.failure(source_d + ' failures:', failures)
-                utils.failure(source_d + ' errors:', errors)
-    print_report(results_grid, results_list)
+            utils.trace('CHANGED', ' '.join(changed))
+
+        # Everything up to now is about to be graded, while anything changed
+        # during grading is picked up next time round
+        watcher.sync()
+        reporter.update(list(grade_directories(args, plan, changed)))
+        if in_place:
+            # Otherwise what the validators change would be regraded over
+            # and over, at the cost of missing edits made while grading
+            watcher.sync()
+
+
+def changes_submissions(plan):
+    '''
+    Returns whether any validator runs commands in the submissions
+    themselves, rather than isolated copies, and so may change them
+    '''
+    return any(not (workspace.enabled and validator.isolate)
+               for validator in plan if hasattr(validator, 'isolate'))
 
 
 def format_matrix_labels(source_d, name):
@@ -159,32 +1108,18 @@ def format_matrix_labels(source_d, name):
     return dirname, name
 
 
-def print_report(results_grid, results_list):
-    for result in results_list:
-        if result['failures'] + result['skipped']:
-            print_result(**result)
-        elif _is_verbose:
-            print_result(**result)
-    s = utils.format_matrix(results_grid)
-    print(s)
-
-def print_result(directory, errors, successes, failures, skipped, messages):
-    print(
-        utils.Term.Bold(directory),
-        '-',
-        utils.Term.Green(successes),
-        utils.Term.Red(failures),
-        utils.Term.Yellow(skipped),
-    )
-
-    for category, message_list in messages.items():
-        if message_list:
-            print(' ' * 4 + '[' + category.upper() + ']')
-            for msg in message_list:
-                print(' ' * 8 + '-', msg)
-
 def cli():
-    main(parse_args(sys.argv))
+    argv = sys.argv[1:]
+    if argv[:1] == ['serve-coordinator']:
+        serve_coordinator(argv[1:])
+    elif argv[:1] == ['worker']:
+        run_worker(parse_worker_args(argv[1:]))
+    elif argv[:1] == ['serve']:
+        serve_daemon(parse_daemon_args(argv[1:]))
+    elif argv[:1] == ['client']:
+        run_client(parse_client_args(argv[1:]))
+    else:
+        main(parse_args(argv))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+'''
+Timing of validators, to find out which checks dominate grading time
+'''
+import json
+import math
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def child_cpu_time():
+    '''
+    Total user and system CPU time used by finished child processes, or None
+    if this can't be measured on this platform
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Timer:
+    '''
+    Measures wall-clock time and child process CPU time of a block:
+
+        with Timer() as timer:
+            validator.validate(directory)
+        timer.as_dict()
+    '''
+    def __init__(self, measure_cpu=True):
+        self.measure_cpu = measure_cpu
+        self.wall = None
+        self.cpu = None
+
+    def start(self):
+        self._start_cpu = child_cpu_time() if self.measure_cpu else None
+        self._start_wall = time.perf_counter()
+        return self
+
+    def stop(self):
+        self.wall = time.perf_counter() - self._start_wall
+        if self._start_cpu is not None:
+            self.cpu = child_cpu_time() - self._start_cpu
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def as_dict(self):
+        return {'wall': self.wall, 'cpu': self.cpu}
+
+
+def percentile(sorted_values, fraction):
+    '''
+    Nearest-rank percentile of an already sorted list
+    '''
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class TimingCollector:
+    '''
+    Collects the timings recorded in each directory's info record
+    '''
+    def __init__(self):
+        self.records = []
+
+    def add(self, info):
+        for name, timing in info.get('timings', {}).items():
+            self.records.append({
+                'directory': info['directory'],
+                'validator': name,
+                'wall': timing['wall'],
+                'cpu': timing['cpu'],
+            })
+
+    def summarize(self):
+        '''
+        Returns a list of per-validator stats, slowest total first
+        '''
+        by_validator = {}
+        for record in self.records:
+            by_validator.setdefault(record['validator'], []).append(record)
+
+        results = []
+        for name, records in by_validator.items():
+            walls = sorted(record['wall'] for record in records)
+            cpus = [r['cpu'] for r in records if r['cpu'] is not None]
+            results.append({
+                'validator': name,
+                'runs': len(walls),
+                'total': sum(walls),
+                'mean': sum(walls) / len(walls),
+                'p95': percentile(walls, 0.95),
+                'cpu': sum(cpus) if cpus else None,
+            })
+        results.sort(key=lambda stats: stats['total'], reverse=True)
+        return results
+
+    def format_table(self):
+        stats = self.summarize()
+        if not stats:
+            return 'No validators were timed'
+        name_width = max(len(s['validator']) for s in stats + [
+            {'validator': 'Validator'}]) + 1
+        lines = [
+            'Validator'.ljust(name_width) +
+            '   Runs   Total(s)    Mean(s)     p95(s)   Child CPU(s)'
+        ]
+        for s in stats:
+            cpu = '%14.3f' % s['cpu'] if s['cpu'] is not None else ' ' * 13 + '-'
+            lines.append('%s %6i %10.3f %10.4f %10.4f %s' % (
+                s['validator'].ljust(name_width), s['runs'], s['total'],
+                s['mean'], s['p95'], cpu))
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as fd:
+            json.dump({
+                'validators': self.summarize(),
+                'timings': self.records,
+            }, fd, indent=2)
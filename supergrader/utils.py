@@ -49,51 +49,219 @@ def apply_command_list_template(command_list, directory, args):
     return [item for item in results if item]
 
 
-def make_matrix(labels_top, labels_side, matrix, max_width=80):
-    results = []
+def is_positional_placeholder(arg):
+    return (
+        isinstance(arg, str) and arg[:1] == '$' and arg[1:].isdigit() and
+        str(int(arg[1:])) == arg[1:]
+    )
+
+
+class CommandTemplate:
+    '''
+    Precompiled version of apply_command_list_template, that works out which
+    items of the command list need substituting only once. Also supports
+    $DIRS, which is replaced by any number of directories.
+    '''
+    def __init__(self, command_list):
+        self.command_list = list(command_list)
+        self.substitutions = [
+            (i, arg) for i, arg in enumerate(self.command_list)
+            if arg in ('$DIR', '$DIRS') or is_positional_placeholder(arg)
+        ]
+
+    def apply(self, directory, args, directories=()):
+        results = list(self.command_list)
+        for i, arg in self.substitutions:
+            if arg == '$DIR':
+                results[i] = directory
+            elif arg == '$DIRS':
+                results[i] = list(directories)
+            else:
+                position = int(arg[1:])
+                results[i] = args[position] if position < len(args) else arg
+
+        # Returns list of truthy replaced arguments in command
+        flattened = []
+        for item in results:
+            if isinstance(item, list):
+                flattened.extend(item)
+            else:
+                flattened.append(item)
+        return [item for item in flattened if item]
+
+
+def truncate_label(label, width):
+    '''
+    Shortens label to fit width, keeping the end, which is usually the most
+    distinctive part of a path
+    '''
+    if len(label) <= width:
+        return label
+    return '...' + label[-(width - 3):]
 
-    first_col_width = max(len(s) for s in labels_side) + 1
-    column_labels = [' ' * first_col_width] + [s + ' ' for s in labels_top]
 
-    total = sum(len(s) for s in column_labels)
+def paginate_columns(column_widths, available_width):
+    '''
+    Splits column indices into pages that each fit in the available width
+    '''
+    pages = []
+    page = []
+    page_width = 0
+    for index, width in enumerate(column_widths):
+        if page and page_width + width > available_width:
+            pages.append(page)
+            page = []
+            page_width = 0
+        page.append(index)
+        page_width += width
+    if page:
+        pages.append(page)
+    return pages
+
+
+def iter_matrix_lines(labels_top, labels_side, matrix, max_width=80):
+    '''
+    Yields the lines of a matrix with labels_top across the top and
+    labels_side down the side, with matrix being a sequence of rows (one per
+    side label). Rows are only accessed as they are output. If the column
+    labels don't fit, they are replaced with numbers and listed above the
+    matrix, and if there are still too many columns, the matrix is split
+    into pages of columns that fit within max_width.
+    '''
+    if not labels_side:
+        return
+    first_col_width = min(
+        max(len(s) for s in labels_side) + 1,
+        max(max_width // 2, 8),
+    )
+    column_labels = [s + ' ' for s in labels_top]
+
+    total = first_col_width + sum(len(s) for s in column_labels)
     compressed_mode = total > max_width
 
     if compressed_mode:
+        digits = max(len(str(len(labels_top) - 1)), 2)
         column_labels = []
         for index, label in enumerate(labels_top):
-            number = '%02i' % i
-            results.append(number + ' - ' + label)
-            column_labels.append(results)
+            number = str(index).zfill(digits)
+            yield number + ' - ' + label
+            column_labels.append(number + ' ')
 
     column_widths = [len(s) for s in column_labels]
-    results.append(''.join(column_labels))
+    pages = paginate_columns(column_widths, max_width - first_col_width)
+    for page_number, page in enumerate(pages):
+        if len(pages) > 1:
+            yield 'Columns %i-%i of %i' % (
+                page[0] + 1, page[-1] + 1, len(column_labels))
+        header = ' ' * first_col_width + ''.join(column_labels[i] for i in page)
+        yield header.rstrip()
 
-    for i, row in enumerate(matrix):
-        row_formatted = []
-        row = [labels_side[i]] + row
-        for width, col in zip(column_widths, row):
-            row_formatted.append(col.ljust(width))
-        results.append(''.join(row_formatted))
+        for label, row in zip(labels_side, matrix):
+            row_formatted = [
+                truncate_label(label, first_col_width - 1).ljust(
+                    first_col_width)
+            ]
+            for i in page:
+                row_formatted.append((row[i] or '').ljust(column_widths[i]))
+            yield ''.join(row_formatted).rstrip()
 
-    return '\n'.join(results)
+
+def make_matrix(labels_top, labels_side, matrix, max_width=80):
+    return '\n'.join(
+        iter_matrix_lines(labels_top, labels_side, matrix, max_width))
+
+
+class TupleDictRows:
+    '''
+    Sequence of matrix rows backed by a dict with (side, top) keys, building
+    each row only when it is accessed
+    '''
+    def __init__(self, tuple_dict, labels_top, labels_side):
+        self.tuple_dict = tuple_dict
+        self.labels_top = labels_top
+        self.labels_side = labels_side
+
+    def __len__(self):
+        return len(self.labels_side)
+
+    def __getitem__(self, index):
+        side = self.labels_side[index]
+        return [self.tuple_dict.get((side, top)) for top in self.labels_top]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 
 def tuple_dict_to_display_matrix(tuple_dict):
     # Remove duplicates, sort, and split the left and right column labels
-    left_labels = sorted(list(set(left for left, _ in tuple_dict.keys())))
-    right_labels = sorted(list(set(right for _, right in tuple_dict.keys())))
+    left_labels = sorted(set(left for left, _ in tuple_dict.keys()))
+    right_labels = sorted(set(right for _, right in tuple_dict.keys()))
 
-    # Build the matrix "list of lists" format for the tuple_dict
-    matrix = [
-        [tuple_dict.get((left, right)) for left in left_labels]
-        for right in right_labels
-    ]
-    return left_labels, right_labels, matrix
+    # Rows are the left labels (directories), so there can be any number
+    # of them, with a column for each right label (validators)
+    matrix = TupleDictRows(tuple_dict, right_labels, left_labels)
+    return right_labels, left_labels, matrix
+
+
+def summarize_tuple_dict(tuple_dict):
+    '''
+    Returns a list of (right label, {result: count}) for each right label,
+    counting in a single pass
+    '''
+    counts = {}
+    for (left, right), result in tuple_dict.items():
+        right_counts = counts.setdefault(right, {})
+        right_counts[result] = right_counts.get(result, 0) + 1
+    return sorted(counts.items())
+
+
+def format_summary(tuple_dict, passing='.'):
+    '''
+    Formats a compact pass-rate summary, one line per right label
+    '''
+    summary = summarize_tuple_dict(tuple_dict)
+    if not summary:
+        return ''
+    label_width = max(len(label) for label, _ in summary) + 1
+    lines = []
+    for label, counts in summary:
+        total = sum(counts.values())
+        passed = counts.get(passing, 0)
+        others = ' '.join(
+            '%s:%i' % (result, count)
+            for result, count in sorted(counts.items())
+            if result != passing
+        )
+        lines.append('%s %5.1f%% (%i/%i) %s' % (
+            label.ljust(label_width), 100.0 * passed / total, passed, total,
+            others))
+    return '\n'.join(line.rstrip() for line in lines)
 
 
-def format_matrix(tuple_dict):
-    left_labels, right_labels, matrix = tuple_dict_to_display_matrix(tuple_dict)
-    return make_matrix(left_labels, right_labels, matrix)
+def format_matrix(tuple_dict, max_width=80, max_rows=100, passing='.'):
+    '''
+    Formats the results matrix. For more than max_rows directories, only
+    the directories that are not entirely passing are shown (up to
+    max_rows of them), followed by a per-validator summary.
+    '''
+    labels_top, labels_side, matrix = tuple_dict_to_display_matrix(tuple_dict)
+    if len(labels_side) <= max_rows:
+        return make_matrix(labels_top, labels_side, matrix, max_width)
+
+    failing = [
+        label for label, row in zip(labels_side, matrix)
+        if any(result != passing for result in row)
+    ]
+    shown = failing[:max_rows]
+    rows = TupleDictRows(tuple_dict, labels_top, shown)
+    lines = list(iter_matrix_lines(labels_top, shown, rows, max_width))
+    hidden = len(labels_side) - len(shown)
+    lines.append('(%i more directories not shown, %i of them failing)' % (
+        hidden, len(failing) - len(shown)))
+    lines.append('')
+    lines.append(format_summary(tuple_dict, passing))
+    return '\n'.join(lines)
 
 
 def error(msg):
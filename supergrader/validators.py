@@ -1,12 +1,137 @@
-import subprocess
+import asyncio
+import collections
+import functools
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import math
 import re
 import os.path
+import runpy
+import signal
 import sys
+import traceback
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import utils
+import archive
+import capture
+import filecache
+import dirindex
+import forkserver
+import workspace
 
 INFINITY = sys.maxsize
 
+BATCH_PROTOCOLS = ('exit', 'lines', 'json')
+
+# What commands that fail to allocate memory tend to print on the way out,
+# from Python, C and C++
+OUT_OF_MEMORY_MESSAGES = (
+    b'MemoryError', b'Cannot allocate memory', b'bad_alloc', b'out of memory',
+)
+
+
+def set_limits(limits):
+    '''
+    Runs in the child process just before the command, applying a list of
+    (resource, soft limit, hard limit)
+    '''
+    for limit, soft, hard in limits:
+        current_soft, current_hard = resource.getrlimit(limit)
+        if current_hard != resource.RLIM_INFINITY:
+            soft = min(soft, current_hard)
+            hard = min(hard, current_hard)
+        resource.setrlimit(limit, (soft, hard))
+
+def get_signal(returncode):
+    '''
+    Returns the signal that killed a command, from its return code or that
+    of a shell that ran it, or None if it exited by itself
+    '''
+    if returncode < 0:
+        return -returncode
+    if returncode > 128:
+        return returncode - 128
+    return None
+
+def get_limits(name, cpu_limit, memory_limit):
+    '''
+    Returns the (resource, soft limit, hard limit) for set_limits to apply
+    limits of cpu_limit seconds and memory_limit MB, either of which may be
+    None
+    '''
+    if cpu_limit is None and memory_limit is None:
+        return []
+    if resource is None:
+        raise ConfigurationError(
+            '%s resource limits are not supported on this platform' % name)
+    limits = []
+    if cpu_limit is not None:
+        # SIGXCPU at the limit, and if that is ignored SIGKILL a second later
+        cpu_limit = int(math.ceil(cpu_limit))
+        limits.append((resource.RLIMIT_CPU, cpu_limit, cpu_limit + 1))
+    if memory_limit is not None:
+        memory_limit = int(memory_limit * 1024 * 1024)
+        limits.append((resource.RLIMIT_AS, memory_limit, memory_limit))
+    return limits
+
+
+def describe_exception(e):
+    return traceback.format_exception_only(type(e), e)[-1].strip()
+
+
+def _hash_code(digest, code):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(digest, const)
+        else:
+            digest.update(repr(const).encode('utf-8'))
+
+
+def _describe_value(value):
+    if callable(value):
+        return getattr(value, '__module__', '') + '.' + getattr(
+            value, '__qualname__', type(value).__qualname__)
+    return repr(value)
+
+
+def describe_callable(value):
+    '''
+    Returns a string standing for what a function does, from its code,
+    defaults and closure, which is the same in every process
+    '''
+    if isinstance(value, (classmethod, staticmethod)):
+        value = value.__func__
+    if isinstance(value, functools.partial):
+        return 'partial(%s, %r, %r)' % (
+            describe_callable(value.func), value.args, value.keywords)
+    code = getattr(value, '__code__', None)
+    if code is None:
+        # eg builtins and classes
+        return _describe_value(value)
+    digest = hashlib.sha256()
+    _hash_code(digest, code)
+    digest.update(repr(value.__defaults__).encode('utf-8'))
+    for cell in value.__closure__ or ():
+        try:
+            contents = cell.cell_contents
+        except ValueError:
+            # Not assigned yet
+            continue
+        digest.update(_describe_value(contents).encode('utf-8'))
+    return '%s:%s' % (value.__qualname__, digest.hexdigest())
+
+
 class ConfigurationError(Exception):
     pass
 
@@ -16,7 +141,60 @@ class ValidationError(Exception):
 class ValidationUnableToCheckError(Exception):
     pass
 
+class ValidationLimitError(ValidationError):
+    '''
+    The check ran out of time, CPU or memory, which can depend on how
+    loaded the machine was, so the result is never cached
+    '''
+    pass
+
+class ValidationTimeoutError(ValidationLimitError):
+    pass
+
 class ValidatorBase:
+    # Set to False for validators whose results depend on more than the
+    # contents of the directory, so they are never replayed from the cache
+    cacheable = True
+
+    # Names of validators that must pass before this one is worth running.
+    # If any of them doesn't, this validator is skipped.
+    requires = ()
+
+    # Rough relative cost of running the validator, cheaper validators run
+    # first unless requires says otherwise
+    cost = 1
+
+    # Set for validators that should be handed every directory of a chunk at
+    # once, with validate_batch, up to batch_size at a time
+    batched = False
+    batch_size = 100
+
+    def __init__(self):
+        self.prepare()
+        self.identity = self.get_identity()
+
+    def prepare(self):
+        '''
+        Called once when the validator is built, before it validates any
+        directories. Override to check configuration, raising
+        ConfigurationError, and to precompute anything that does not depend
+        on the directory.
+        '''
+        pass
+
+    def require(self, *attributes):
+        missing = [name for name in attributes if not hasattr(self, name)]
+        if missing:
+            raise ConfigurationError('%s is missing %s' % (
+                self.get_name(), ', '.join(missing)))
+
+    def overrides(self, base, name):
+        '''
+        Checks if the validator replaces base's method name, eg a hook that
+        stands in for an attribute
+        '''
+        return getattr(type(self), name) is not getattr(base, name)
+
     def get_name(self):
         if hasattr(self, 'name'):
             return self.name
@@ -25,6 +203,31 @@ class ValidatorBase:
     def get_feedback(self):
         return None
 
+    async def validate_async(self, directory):
+        '''
+        Used by the asyncio engine. By default validators do not wait on
+        anything, so this just runs validate.
+        '''
+        self.validate(directory)
+
+    def validate_batch(self, directories):
+        '''
+        Used for batched validators. Returns a list with, for each directory,
+        None if it passed or the exception explaining why it didn't.
+        '''
+        errors = []
+        for directory in directories:
+            try:
+                self.validate(directory)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    async def validate_batch_async(self, directories):
+        return self.validate_batch(directories)
+
     @classmethod
     def as_function(cls):
         '''
@@ -40,12 +243,90 @@ class ValidatorBase:
 
             for key, value in kwargs.items():
                 setattr(SubclassedValidator, key, value)
+            SubclassedValidator._function_kwargs = kwargs
 
             return SubclassedValidator
         return validator_as_function
 
+    @classmethod
+    def get_identity(cls):
+        '''
+        Returns a string identifying the validator class and its
+        configuration, ie the attributes set by as_function, and the code of
+        its methods, so editing either gives a new identity
+        '''
+        bases = [
+            klass.__module__ + '.' + klass.__qualname__
+            for klass in cls.__mro__
+            if '_function_kwargs' not in vars(klass)
+        ]
+        config = {}
+        methods = (types.FunctionType, classmethod, staticmethod)
+        for klass in reversed(cls.__mro__):
+            for key, value in vars(klass).items():
+                # Private methods like _check_result matter as much as public
+                # ones, but private data is bookkeeping, eg _pattern_groups
+                if key.startswith('_') and not isinstance(value, methods):
+                    continue
+                if callable(value) or isinstance(value, methods):
+                    value = describe_callable(value)
+                config[key] = value
+        return repr((bases, sorted(config.items())))
+
 
 class ShellValidator(ValidatorBase):
+    cost = 10
+
+    # Checks on the output of the command, which are made line by line as
+    # the output arrives, so the command is stopped at the first mismatch
+    expected_output = None
+    expected_regex = None
+    output_stream = 'stdout'
+
+    # Only the last this many bytes of each captured stream are kept
+    max_capture_size = capture.DEFAULT_MAX_SIZE
+
+    # Seconds of wall-clock time before the command, and anything it
+    # started, is killed, and limits on the seconds of CPU time and MB of
+    # memory it may use
+    timeout = None
+    cpu_limit = None
+    memory_limit = None
+
+    # Run the command in a private copy of the directory, so it can't
+    # change what later validators see. 'hardlink' hardlinks files where
+    # they can't be reflinked, for commands that never write to existing
+    # files in place.
+    isolate = True
+
+    def prepare(self):
+        # Subclasses overriding get_command may not have a command at all
+        self.command_template = None
+        if hasattr(self, 'command') or \
+                not self.overrides(ShellValidator, 'get_command'):
+            self.require('command')
+            if isinstance(self.command, str):
+                raise ConfigurationError(
+                    '%s command should be a list' % self.get_name())
+            self.command_template = utils.CommandTemplate(self.command)
+        if self.output_stream not in capture.STREAMS:
+            raise ConfigurationError('%s has invalid output_stream %s' % (
+                self.get_name(), self.output_stream))
+        self.compiled_regex = None
+        if self.expected_regex is not None:
+            try:
+                self.compiled_regex = re.compile(self.expected_regex)
+            except re.error as e:
+                raise ConfigurationError('%s has invalid expected_regex: %s' % (
+                    self.get_name(), e))
+        self.limits = self.get_limits()
+
+    def get_limits(self):
+        '''
+        Returns the (resource, soft limit, hard limit) to apply to commands
+        '''
+        return get_limits(self.get_name(), self.cpu_limit, self.memory_limit)
+
     def get_arguments(self, resource):
         return []
 
@@ -56,78 +337,669 @@ class ShellValidator(ValidatorBase):
         return directory
 
     def get_command(self, directory):
-        return utils.apply_command_list_template(
-            self.command,
+        return self.command_template.apply(
             directory,
             self.get_arguments(directory),
         )
 
     def get_capture(self, directory):
+        '''
+        Which of stdout and stderr to capture. Captured output is available
+        to check_results, as the stdout and stderr of the result.
+        '''
+        if self.expected_output is not None or self.compiled_regex:
+            return [self.output_stream]
         return []
 
+    def get_matchers(self, directory):
+        '''
+        Returns a dict of stream name to a list of objects with feed(line)
+        and finish() methods, which raise capture.OutputMismatch if the
+        output isn't as expected
+        '''
+        matchers = []
+        if self.expected_output is not None:
+            matchers.append(capture.ExpectedOutput(
+                self.expected_output, self.output_stream))
+        if self.compiled_regex:
+            matchers.append(capture.RegexMatch(
+                self.compiled_regex, self.output_stream))
+        return {self.output_stream: matchers} if matchers else {}
+
     def check_results(self, result):
         return result.returncode == 0
 
-    def _run_command(self, cmd, kwds, directory):
+    def _prepare_kwds(self, kwds, directory):
         # Compute working directory and misc keyword args
         kwds.setdefault('cwd', self.get_cwd(directory))
+        if self.limits:
+            kwds.setdefault('preexec_fn',
+                            functools.partial(set_limits, self.limits))
+
+        # In its own process group, everything the command started can be
+        # killed along with it
+        if self.timeout is not None:
+            kwds.setdefault('start_new_session', True)
+        return kwds
+
+    def _get_captures(self, directory):
+        # Check which of stdout and/or stderr need capturing
+        names = self.get_capture(directory)
+        if set(names) - set(capture.STREAMS):
+            raise ConfigurationError('Invalid captures: %s' % str(names))
+        if self.memory_limit is not None and 'stderr' not in names:
+            # To tell running out of memory apart from other failures
+            names = list(names) + ['stderr']
+        matchers = self.get_matchers(directory)
+        return {
+            name: capture.Capture(self.max_capture_size, matchers.get(name, ()))
+            for name in names
+        }
 
-        # Run the command itself, capturing stdout and/or stderr as necessary
-        captures = self.get_capture(directory)
-        if captures:
-            if set(captures) - set(['stdout', 'stderr']):
-                raise ConfigurationError('Invalid captures: %s' % str(captures))
+    def _run_command(self, cmd, kwds, directory):
+        kwds = self._prepare_kwds(kwds, directory)
+        captures = self._get_captures(directory)
+        try:
+            return capture.run(cmd, kwds, captures, self.timeout)
+        except capture.OutputMismatch as e:
+            raise ValidationError(str(e))
+        except capture.CommandTimeout:
+            raise self._timeout_error(cmd)
 
-            raise ConfigurationError('Captures not yet implemented')
-            for capture in captures:
-                kwds[capture] = fd
-            result = subprocess.run(cmd, **kwds)
+    async def _run_command_async(self, cmd, kwds, directory):
+        kwds = self._prepare_kwds(kwds, directory)
+        captures = self._get_captures(directory)
+        for name in captures:
+            kwds[name] = asyncio.subprocess.PIPE
+        if kwds.pop('shell', False):
+            if isinstance(cmd, str):
+                process = await asyncio.create_subprocess_shell(cmd, **kwds)
+            else:
+                # Same as subprocess does with a list and shell=True: the
+                # first item is the script, the rest are its arguments
+                process = await asyncio.create_subprocess_exec(
+                    '/bin/sh', '-c', *cmd, **kwds)
+        elif isinstance(cmd, str):
+            process = await asyncio.create_subprocess_exec(cmd, **kwds)
         else:
-            result = subprocess.run(cmd, **kwds)
-        return result
+            process = await asyncio.create_subprocess_exec(*cmd, **kwds)
+        try:
+            return await capture.communicate_async(
+                cmd, process, captures, self.timeout,
+                group=kwds.get('start_new_session', False))
+        except capture.OutputMismatch as e:
+            raise ValidationError(str(e))
+        except capture.CommandTimeout:
+            raise self._timeout_error(cmd)
+
+    def _timeout_error(self, cmd):
+        return ValidationTimeoutError('Command timed out after %ss: %s' % (
+            self.timeout, ' '.join(cmd)))
+
+    def _check_result(self, result):
+        if self.check_results(result):
+            return
+        command = ' '.join(result.args)
+        killed_by = get_signal(result.returncode)
+        if self.cpu_limit is not None and \
+                killed_by in (signal.SIGXCPU, signal.SIGKILL):
+            raise ValidationLimitError('Command exceeded CPU limit of %ss: %s'
+                                       % (self.cpu_limit, command))
+        if self.memory_limit is not None and self._out_of_memory(result):
+            raise ValidationLimitError(
+                'Command unsuccessful (memory limited to %sMB): %s' % (
+                    self.memory_limit, command))
+        raise ValidationError('Command unsuccessful: ' + command)
+
+    def _out_of_memory(self, result):
+        if get_signal(result.returncode) in (signal.SIGKILL, signal.SIGSEGV):
+            return True
+        stderr = result.stderr or b''
+        return any(message in stderr for message in OUT_OF_MEMORY_MESSAGES)
+
+    def validate(self, directory):
+        # Ensure directories are created and run the actual command, in an
+        # extracted copy if the submission is an archive, and a workspace
+        # of its own if isolated
+        source = archive.get_workdir(directory)
+        workdir = workspace.acquire(source, self.isolate)
+        try:
+            cmd = self.get_command(workdir)
+            kwds = self.get_kwds(workdir)
+            result = self._run_command(cmd, kwds, workdir)
+        finally:
+            workspace.release(source, workdir)
+        self._forget(directory, workdir)
+        self._check_result(result)
+
+    async def validate_async(self, directory):
+        loop = asyncio.get_running_loop()
+        source = archive.get_workdir(directory)
+        workdir = await loop.run_in_executor(
+            None, workspace.acquire, source, self.isolate)
+        try:
+            cmd = self.get_command(workdir)
+            kwds = self.get_kwds(workdir)
+            result = await self._run_command_async(cmd, kwds, workdir)
+        finally:
+            await loop.run_in_executor(
+                None, workspace.release, source, workdir)
+        self._forget(directory, workdir)
+        self._check_result(result)
+
+    def _forget(self, directory, workdir):
+        # Only a command run in the directory itself can have changed it
+        if workdir == directory:
+            dirindex.forget(directory)
+
+
+class BatchShellValidator(ShellValidator):
+    '''
+    Runs one command for many directories at once, with $DIRS in the command
+    replaced by the directories, to save starting a process (eg a whole
+    interpreter) for each one. The command is run directly from the current
+    directory rather than through the shell. How pass and fail is worked out
+    for each directory depends on protocol:
+
+        exit    a zero exit status means every directory passed, otherwise
+                the batch is split in half and rerun to find the failures
+        lines   each line of output is a directory, a tab, then "ok" or
+                "fail", optionally followed by a tab and a message
+        json    the output is a JSON object of each directory to true,
+                false, or {"ok": ..., "message": ...}
+    '''
+    batched = True
+    protocol = 'exit'
+
+    # The output of the whole batch is parsed, so keep more of it
+    max_capture_size = 16 * 1024 * 1024
+
+    # Batched commands are expected to only read the directories, eg
+    # linters, and report results by their paths
+    isolate = False
+
+    def prepare(self):
+        self.require('command')
+        super().prepare()
+        if '$DIRS' not in self.command:
+            raise ConfigurationError(
+                '%s command should include $DIRS' % self.get_name())
+        if self.protocol not in BATCH_PROTOCOLS:
+            raise ConfigurationError('%s has unknown protocol %s' % (
+                self.get_name(), self.protocol))
+
+    def get_kwds(self, directory):
+        return {}
+
+    def get_capture(self, directory):
+        captures = super().get_capture(directory)
+        if self.protocol != 'exit' and 'stdout' not in captures:
+            captures.append('stdout')
+        return captures
+
+    def get_cwd(self, directory):
+        return None
+
+    def get_batch_command(self, directories):
+        workdirs = [archive.get_workdir(d) for d in directories]
+        return self.command_template.apply(None, [], workdirs)
+
+    def iter_batches(self, directories):
+        for i in range(0, len(directories), self.batch_size):
+            yield directories[i:i + self.batch_size]
+
+    def validate(self, directory):
+        error, = self.validate_batch([directory])
+        if error:
+            raise error
+
+    async def validate_async(self, directory):
+        error, = await self.validate_batch_async([directory])
+        if error:
+            raise error
+
+    def validate_batch(self, directories):
+        errors = []
+        for batch in self.iter_batches(directories):
+            errors.extend(self._validate_batch(batch))
+        return errors
+
+    async def validate_batch_async(self, directories):
+        errors = []
+        for batch in self.iter_batches(directories):
+            errors.extend(await self._validate_batch_async(batch))
+        return errors
+
+    def _validate_batch(self, directories):
+        cmd = self.get_batch_command(directories)
+        try:
+            result = self._run_command(cmd, self.get_kwds(None), None)
+        except ValidationTimeoutError as e:
+            if len(directories) == 1:
+                return self._timeout_results(e, directories)
+            result = None
+        if self._should_bisect(result, directories):
+            half = len(directories) // 2
+            return (self._validate_batch(directories[:half]) +
+                    self._validate_batch(directories[half:]))
+        return self.split_results(result, directories)
+
+    async def _validate_batch_async(self, directories):
+        cmd = self.get_batch_command(directories)
+        try:
+            result = await self._run_command_async(
+                cmd, self.get_kwds(None), None)
+        except ValidationTimeoutError as e:
+            if len(directories) == 1:
+                return self._timeout_results(e, directories)
+            result = None
+        if self._should_bisect(result, directories):
+            half = len(directories) // 2
+            return (await self._validate_batch_async(directories[:half]) +
+                    await self._validate_batch_async(directories[half:]))
+        return self.split_results(result, directories)
+
+    def _should_bisect(self, result, directories):
+        # A batch that timed out (with no result) is split whatever the
+        # protocol, as which directory held it up isn't known
+        if len(directories) < 2:
+            return False
+        return result is None or (
+            self.protocol == 'exit' and result.returncode != 0)
+
+    def _timeout_results(self, error, directories):
+        for directory in directories:
+            dirindex.forget(directory)
+        return [error] * len(directories)
+
+    def split_results(self, result, directories):
+        '''
+        Returns the error (or None) for each directory from the result of a
+        batch command
+        '''
+        for directory in directories:
+            dirindex.forget(directory)
+        if self.protocol == 'exit':
+            if result.returncode == 0:
+                return [None] * len(directories)
+            return [ValidationError(
+                'Command unsuccessful: ' + ' '.join(result.args))]
+
+        try:
+            reported = self.parse_output(result.stdout.decode('utf-8'))
+        except ValueError as e:
+            error = ValidationUnableToCheckError(
+                '%s output could not be parsed: %s' % (self.get_name(), e))
+            return [error] * len(directories)
+
+        errors = []
+        for directory in directories:
+            # Archives are reported by where they were extracted to
+            workdir = archive.get_workdir(directory)
+            passed, message = reported.get(
+                os.path.normpath(workdir), (None, None))
+            if passed is None:
+                errors.append(ValidationUnableToCheckError(
+                    '%s gave no result for %s' % (self.get_name(), directory)))
+            elif passed:
+                errors.append(None)
+            else:
+                errors.append(ValidationError(
+                    message or '%s failed' % self.get_name()))
+        return errors
+
+    def parse_output(self, output):
+        '''
+        Returns a dict of normalized directory path to (passed, message),
+        raising ValueError if the output doesn't follow the protocol
+        '''
+        reported = {}
+        if self.protocol == 'json':
+            results = json.loads(output)
+            if not isinstance(results, dict):
+                raise ValueError('expected a JSON object')
+            for directory, value in results.items():
+                if isinstance(value, dict):
+                    value = value.get('ok'), value.get('message')
+                else:
+                    value = value, None
+                if not isinstance(value[0], bool):
+                    raise ValueError('no ok status for ' + directory)
+                reported[os.path.normpath(directory)] = value
+            return reported
+
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            fields = line.split('\t', 2)
+            if len(fields) < 2 or fields[1] not in ('ok', 'fail'):
+                raise ValueError('invalid line %r' % line)
+            message = fields[2] if len(fields) > 2 else None
+            reported[os.path.normpath(fields[0])] = fields[1] == 'ok', message
+        return reported
+
+
+class PythonValidator(ValidatorBase):
+    '''
+    Runs student Python code in a process forked from a fork server, which
+    has the preload modules already imported, so each check starts in a few
+    milliseconds instead of starting a new interpreter. module is the path
+    of a student script to run as if with "python module", and tests the
+    name of a module in the profile's path whose test functions are then
+    called, and which can import the student's modules. The script's
+    printed output is checked against expected_output and expected_regex,
+    and check_module can be overridden to check the variables it left
+    behind.
+    '''
+    cost = 5
+
+    module = None
+    run_name = '__main__'
+    tests = None
+    stdin = ''
+
+    # Modules for the fork server to import, once, for every check
+    preload = ()
+
+    expected_output = None
+    expected_regex = None
+    max_capture_size = capture.DEFAULT_MAX_SIZE
+
+    # Seconds before the check is killed, and limits on the seconds of CPU
+    # time and MB of memory it may use
+    timeout = 10
+    cpu_limit = None
+    memory_limit = None
+
+    # As for ShellValidator, run in a private copy of the directory
+    isolate = True
+
+    def prepare(self):
+        if not hasattr(os, 'fork'):
+            raise ConfigurationError(
+                '%s needs os.fork, which is not available on this platform' %
+                self.get_name())
+        if self.module is None and self.tests is None:
+            raise ConfigurationError(
+                '%s needs a module or tests' % self.get_name())
+        self.compiled_regex = None
+        if self.expected_regex is not None:
+            try:
+                self.compiled_regex = re.compile(self.expected_regex)
+            except re.error as e:
+                raise ConfigurationError('%s has invalid expected_regex: %s' % (
+                    self.get_name(), e))
+        self.limits = get_limits(
+            self.get_name(), self.cpu_limit, self.memory_limit)
+        self.check_key = forkserver.register(
+            self.get_identity(), self.run_check, self.preload)
+
+    def run_check(self, directory):
+        '''
+        Runs in the process forked for each check, returning a (result,
+        message) pair
+        '''
+        set_limits(self.limits)
+        output = forkserver.TailWriter(self.max_capture_size)
+        sys.stdout = output
+        sys.stderr = forkserver.TailWriter(self.max_capture_size)
+        sys.stdin = io.StringIO(self.stdin)
+        try:
+            namespace = self.run_module(directory)
+            self.check_output(output.getvalue())
+            self.check_module(namespace)
+            self.run_tests()
+        except ValidationUnableToCheckError as e:
+            return '?', str(e)
+        except MemoryError:
+            # Reported as a limit, as it may depend on the machine
+            message = 'Check ran out of memory'
+            if self.memory_limit is not None:
+                message += ' (limited to %sMB)' % self.memory_limit
+            return 'L', message
+        except (ValidationError, capture.OutputMismatch) as e:
+            return 'F', str(e)
+        except AssertionError as e:
+            return 'F', str(e) or 'Assertion failed'
+        except Exception as e:
+            return 'F', describe_exception(e)
+        return '.', self.get_feedback()
+
+    def run_module(self, directory):
+        '''
+        Runs the student's script, returning the variables it defined
+        '''
+        if self.module is None:
+            return None
+        if not os.path.isfile(self.module):
+            raise ValidationError(
+                'Expected file does not exist: %s' % self.module)
+        try:
+            return runpy.run_path(self.module, run_name=self.run_name)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise ValidationError('%s exited with status %s' % (
+                    self.module, e.code))
+            return {}
+        except MemoryError:
+            raise
+        except Exception as e:
+            raise ValidationError('%s raised %s' % (
+                self.module, describe_exception(e)))
+
+    def check_output(self, output):
+        matchers = []
+        if self.expected_output is not None:
+            matchers.append(capture.ExpectedOutput(self.expected_output))
+        if self.compiled_regex:
+            matchers.append(capture.RegexMatch(self.compiled_regex))
+        for line in output.splitlines():
+            for matcher in matchers:
+                matcher.feed(line)
+        for matcher in matchers:
+            matcher.finish()
+
+    def check_module(self, namespace):
+        '''
+        Override to check the variables the script defined, raising
+        ValidationError or AssertionError if they aren't right
+        '''
+        pass
+
+    def run_tests(self):
+        if self.tests is None:
+            return
+        module = importlib.import_module(self.tests)
+        tests = [
+            (name, value) for name, value in vars(module).items()
+            if name.startswith('test') and callable(value)
+        ]
+        failures = []
+        for name, test in tests:
+            try:
+                test()
+            except Exception as e:
+                failures.append('%s (%s)' % (name, describe_exception(e)))
+        if failures:
+            raise ValidationError('%i of %i tests failed: %s' % (
+                len(failures), len(tests), ', '.join(failures)))
 
     def validate(self, directory):
-        # Ensure directories are created and run the actual command
-        cmd = self.get_command(directory)
-        kwds = self.get_kwds(directory)
-        result = self._run_command(cmd, kwds, directory)
+        source = archive.get_workdir(directory)
+        workdir = workspace.acquire(source, self.isolate)
+        try:
+            response = forkserver.get_server().run(
+                self.check_key, os.path.abspath(workdir), self.timeout)
+        finally:
+            workspace.release(source, workdir)
+        if workdir == directory:
+            dirindex.forget(directory)
+
+        if response.get('timeout'):
+            raise ValidationTimeoutError(
+                'Check timed out after %ss' % self.timeout)
+        result, message = response['result'], response['message']
+        if self.cpu_limit is not None and \
+                response.get('signal') in ('SIGXCPU', 'SIGKILL'):
+            raise ValidationLimitError(
+                'Check exceeded CPU limit of %ss' % self.cpu_limit)
+        if result == 'L':
+            raise ValidationLimitError(message)
+        if result == '?':
+            raise ValidationUnableToCheckError(message)
+        if result == 'F':
+            raise ValidationError(message)
+        if result == 'E':
+            raise forkserver.CheckError(message)
 
-        if not self.check_results(result):
-            raise ValidationError('Command unsuccessful: ' + ' '.join(result.args))
+    @classmethod
+    def get_identity(cls):
+        '''
+        As for other validators, plus the source of the tests module, so
+        results aren't replayed from the cache once the tests are changed
+        '''
+        identity = super().get_identity()
+        if cls.tests is None:
+            return identity
+        return '%s tests:%s' % (identity, cls.get_tests_digest())
 
+    @classmethod
+    def get_tests_digest(cls):
+        try:
+            spec = importlib.util.find_spec(cls.tests)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None or not spec.has_location:
+            raise ConfigurationError('%s can\'t find tests module %s' % (
+                getattr(cls, 'name', cls.__name__), cls.tests))
+        with open(spec.origin, 'rb') as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+
+    async def validate_async(self, directory):
+        # Waiting on the fork server blocks, so do it from another thread
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.validate, directory)
+
+
+class FilePattern:
+    '''
+    Entry in a FileStructureValidator dir_tree that matches any number of
+    paths, below the directory it is in, using either a glob (eg "*.py" or
+    "**/test_*.py") or a regular expression. A pattern ending in "/" only
+    matches directories. Unlike glob, hidden files are matched too.
+    '''
+    def __init__(self, pattern, min_count=1, max_count=None, regex=False):
+        self.pattern = pattern
+        self.min_count = min_count
+        self.max_count = max_count
+        self.dirs_only = pattern.endswith('/')
+        try:
+            if regex:
+                self.regexp = re.compile(pattern.rstrip('/') + r'\Z')
+            else:
+                self.regexp = dirindex.compile_glob(pattern)
+        except re.error as e:
+            raise ConfigurationError('Invalid pattern %r: %s' % (pattern, e))
+
+    def __repr__(self):
+        return 'FilePattern(%r, min_count=%r, max_count=%r)' % (
+            self.pattern, self.min_count, self.max_count)
+
+    def count(self, index, rel_dir=''):
+        return sum(
+            1 for path, is_dir in index.walk(rel_dir)
+            if (is_dir or not self.dirs_only) and self.regexp.match(path)
+        )
+
+    def check(self, index, rel_dir=''):
+        '''
+        Returns None if the number of matches is acceptable, otherwise a
+        description of what is missing
+        '''
+        count = self.count(index, rel_dir)
+        if self.max_count is not None and count > self.max_count:
+            return 'at most %i of %s (found %i)' % (
+                self.max_count, self.pattern, count)
+        if count < self.min_count:
+            if self.min_count == 1:
+                return self.pattern
+            return 'at least %i of %s (found %i)' % (
+                self.min_count, self.pattern, count)
+        return None
 
 
 class FileStructureValidator(ValidatorBase):
     example_dir_tree = [
         'file',
+        '*.html',
+        FilePattern('**/test_*.py', min_count=3),
         ('dirname', [
             '',
         ])
     ]
 
+    def prepare(self):
+        # A dir_tree from an overridden get_dir_tree may change, so it is
+        # compiled every time instead
+        self.compiled_dir_tree = None
+        if not self.overrides(FileStructureValidator, 'get_dir_tree'):
+            self.require('dir_tree')
+            self.compiled_dir_tree = self.compile_dir_tree(self.get_dir_tree())
+
+    def compile_dir_tree(self, dir_tree_node):
+        '''
+        Checks the dir_tree is well formed, replacing glob strings with
+        FilePatterns
+        '''
+        if isinstance(dir_tree_node, str):
+            if dirindex.is_glob(dir_tree_node):
+                return FilePattern(dir_tree_node)
+            return dir_tree_node
+        elif isinstance(dir_tree_node, FilePattern):
+            return dir_tree_node
+        elif isinstance(dir_tree_node, list):
+            return [self.compile_dir_tree(child) for child in dir_tree_node]
+        elif isinstance(dir_tree_node, tuple) and len(dir_tree_node) == 2:
+            path, children = dir_tree_node
+            if isinstance(path, str):
+                return path, self.compile_dir_tree(children)
+        raise ConfigurationError('%s has invalid dir_tree entry: %r' % (
+            self.get_name(), dir_tree_node))
+
     def get_dir_tree(self):
         return self.dir_tree
 
+    def get_compiled_dir_tree(self):
+        if self.compiled_dir_tree is not None:
+            return self.compiled_dir_tree
+        return self.compile_dir_tree(self.get_dir_tree())
+
     def validate(self, directory):
-        dir_tree = self.get_dir_tree()
+        dir_tree = self.get_compiled_dir_tree()
         fails = []
-        self._recurse_validate(dir_tree, directory, fails)
+        index = archive.get_index(directory)
+        self._recurse_validate(dir_tree, directory, fails, index)
         if fails:
             raise ValidationError('Could not find: ' + ', '.join(fails))
 
-    def _recurse_validate(self, dir_tree_node, root_dir, fails):
-        if isinstance(dir_tree_node, str):
-            path = os.path.join(root_dir, dir_tree_node)
-            if not os.path.exists(path):
+    def _recurse_validate(self, dir_tree_node, root_dir, fails, index,
+                          rel_dir=''):
+        if isinstance(dir_tree_node, FilePattern):
+            missing = dir_tree_node.check(index, rel_dir)
+            if missing:
+                fails.append(missing)
+        elif isinstance(dir_tree_node, str):
+            if not index.exists(os.path.join(rel_dir, dir_tree_node)):
                 fails.append(dir_tree_node)
         elif isinstance(dir_tree_node, list):
             for child in dir_tree_node:
-                self._recurse_validate(child, root_dir, fails)
+                self._recurse_validate(child, root_dir, fails, index, rel_dir)
         else:
             path, children = dir_tree_node
+            rel_path = os.path.join(rel_dir, path)
             path = os.path.join(root_dir, path)
-            if os.path.exists(path):
-                self._recurse_validate(children, path, fails)
+            if index.exists(rel_path):
+                self._recurse_validate(children, path, fails, index, rel_path)
             else:
                 fails.append(path)
 
@@ -135,9 +1007,50 @@ class FileStructureValidator(ValidatorBase):
 class FileTextValidator(ValidatorBase):
     regexp_whitespace = re.compile(r'\s+', re.MULTILINE)
 
+    # Files bigger than this are counted a chunk at a time, rather than
+    # being read into memory (and the shared file cache) all at once
+    large_file_size = 16 * 1024 * 1024
+
+    # Reads file contents, rather than just listing directories
+    cost = 2
+
+    # Every search text seen so far, grouped by path and how the file is
+    # sanitized, so all the texts for a file can be counted in one pass.
+    # Private, as it isn't configuration and mustn't be part of the identity.
+    _pattern_groups = collections.defaultdict(set)
+
+    def prepare(self):
+        self.require('path')
+        self.expected_range = self.get_range()
+
+        # Text from an overridden get_text may change, so it is sanitized
+        # every time instead
+        self.sanitized_text = None
+        if not self.overrides(FileTextValidator, 'get_text'):
+            self.require('text')
+            self.sanitized_text = self.sanitize(self.get_text(),
+                                                is_search=True)
+            self.get_pattern_group().add(self.sanitized_text)
+
+    def get_pattern_group(self):
+        return self._pattern_groups[(self.path, self.get_sanitize_key())]
+
+    @staticmethod
+    def clear_pattern_groups():
+        '''
+        Forgets every search text seen so far, when a new plan is compiled,
+        so the texts of validators no longer in use aren't counted
+        '''
+        FileTextValidator._pattern_groups = collections.defaultdict(set)
+
     def get_text(self):
         return self.text
 
+    def get_sanitized_text(self, text):
+        if self.sanitized_text is not None:
+            return self.sanitized_text
+        return self.sanitize(text, is_search=True)
+
     def get_range(self):
         exact_count = getattr(self, 'exact_count', None)
         if exact_count:
@@ -170,19 +1083,49 @@ class FileTextValidator(ValidatorBase):
                 text = text.split()
         return text
 
+    def get_sanitize_key(self):
+        '''
+        Identifies how sanitize transforms file contents, so that sanitized
+        contents can be shared between validators
+        '''
+        return (
+            type(self).sanitize,
+            getattr(self, 'normalize_whitespace', False),
+            getattr(self, 'ignore_case', False),
+            getattr(self, 'whole_word_only', False),
+        )
+
+    def count_in_file(self, full_path, sanitized_text):
+        # Only the stock sanitize method can be applied a chunk at a time
+        is_large = archive.getsize(full_path) > self.large_file_size
+        if is_large and type(self).sanitize is FileTextValidator.sanitize:
+            return filecache.stream_count(
+                full_path,
+                sanitized_text,
+                getattr(self, 'normalize_whitespace', False),
+                getattr(self, 'ignore_case', False),
+                getattr(self, 'whole_word_only', False),
+            )
+        return filecache.default_cache.count(
+            full_path,
+            sanitized_text,
+            self.get_pattern_group(),
+            self.sanitize,
+            self.get_sanitize_key(),
+        )
+
     def validate(self, directory):
         full_path = os.path.join(directory, self.path)
-        if not os.path.exists(full_path):
+        if not archive.exists(full_path):
             raise ValidationError(f'Expected file does not exist: {self.path}')
-        file_contents = self.sanitize(open(full_path).read())
         text = self.get_text()
-        sanitized_text = self.sanitize(text, is_search=True)
-        if sanitized_text not in file_contents:
+        sanitized_text = self.get_sanitized_text(text)
+        actual_count = self.count_in_file(full_path, sanitized_text)
+        if not actual_count:
             raise ValidationError(f'{self.path} does not contain "{text}"')
 
-        expected_range = self.get_range()
+        expected_range = self.expected_range
         if expected_range:
-            actual_count = file_contents.count(sanitized_text)
             msg = f'{self.path} contains {actual_count} instances of "{text}" '
             if actual_count not in expected_range:
                 max_count = expected_range.stop - 1
@@ -199,6 +1142,8 @@ class FileTextValidator(ValidatorBase):
 
 
 shell_validator = ShellValidator.as_function()
+batch_shell_validator = BatchShellValidator.as_function()
+python_validator = PythonValidator.as_function()
 file_structure_validator = FileStructureValidator.as_function()
 file_text_validator = FileTextValidator.as_function()
 
@@ -0,0 +1,154 @@
+'''
+Watches submission directories for changes, so that only the directories
+that changed need to be regraded
+'''
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DEFAULT_INTERVAL = 1.0
+
+# How long to wait for more events after the first one, so that a flurry
+# of writes (eg a git checkout) results in a single regrade
+DEBOUNCE = 0.2
+
+
+def snapshot(directory):
+    '''
+    Returns a dict mapping each path below directory to its (mtime, size),
+    or for an archive, just the archive's
+    '''
+    results = {}
+    if os.path.isfile(directory):
+        stat = os.stat(directory)
+        results[directory] = (stat.st_mtime_ns, stat.st_size)
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            results[path] = (stat.st_mtime_ns, stat.st_size)
+    return results
+
+
+class PollingWatcher:
+    '''
+    Detects changes by periodically comparing mtimes and sizes of every
+    file below the watched directories
+    '''
+    def __init__(self, directories, interval=DEFAULT_INTERVAL):
+        self.directories = list(directories)
+        self.interval = interval
+        self.snapshots = {}
+        self.sync()
+
+    def sync(self):
+        '''
+        Forget any changes made so far, eg by the validators themselves
+        '''
+        self.snapshots = {d: snapshot(d) for d in self.directories}
+
+    def poll(self):
+        changed = []
+        for directory in self.directories:
+            current = snapshot(directory)
+            if current != self.snapshots[directory]:
+                self.snapshots[directory] = current
+                changed.append(directory)
+        return changed
+
+    def wait(self):
+        '''
+        Blocks until at least one directory changes, returning the list of
+        changed directories in their original order
+        '''
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if changed:
+                return changed
+
+
+class InotifyWatcher:
+    '''
+    Detects changes using inotify, via the optional inotify_simple package
+    '''
+    FLAGS = (
+        inotify_simple.flags.CREATE | inotify_simple.flags.DELETE |
+        inotify_simple.flags.MODIFY | inotify_simple.flags.MOVED_FROM |
+        inotify_simple.flags.MOVED_TO | inotify_simple.flags.ATTRIB |
+        inotify_simple.flags.CLOSE_WRITE
+    ) if inotify_simple else 0
+
+    def __init__(self, directories, interval=DEFAULT_INTERVAL):
+        self.directories = list(directories)
+        self.interval = interval
+        self.inotify = inotify_simple.INotify()
+
+        # Watch descriptor to a list of (path watched, directory, name),
+        # where only events for name count if it isn't None. Watching one
+        # path twice gives the same descriptor, so there may be several.
+        self.watches = {}
+        for directory in self.directories:
+            self._add_watches(directory, directory)
+
+    def _add_watch(self, path, directory, name=None):
+        try:
+            wd = self.inotify.add_watch(path, self.FLAGS)
+        except OSError:
+            return
+        entry = (path, directory, name)
+        entries = self.watches.setdefault(wd, [])
+        if entry not in entries:
+            entries.append(entry)
+
+    def _add_watches(self, path, directory):
+        # An archive is watched through the directory it is in, as a watch
+        # on the file itself is lost when it is replaced by renaming
+        # another file over it
+        if os.path.isfile(path):
+            parent, name = os.path.split(os.path.abspath(path))
+            self._add_watch(parent, directory, name)
+            return
+
+        # inotify is not recursive, so every subdirectory needs a watch
+        for root, dirs, files in os.walk(path):
+            self._add_watch(root, directory)
+
+    def sync(self):
+        self.inotify.read(timeout=0)
+
+    def wait(self):
+        events = self.inotify.read()
+        time.sleep(DEBOUNCE)
+        events += self.inotify.read(timeout=0)
+
+        changed = set()
+        for event in events:
+            for root, directory, name in self.watches.get(event.wd, ()):
+                if name is not None and event.name != name:
+                    continue
+                changed.add(directory)
+                if name is None and event.mask & inotify_simple.flags.ISDIR \
+                        and event.mask & inotify_simple.flags.CREATE:
+                    self._add_watches(os.path.join(root, event.name),
+                                      directory)
+        return [d for d in self.directories if d in changed]
+
+
+def get_watcher(directories, interval=DEFAULT_INTERVAL):
+    '''
+    Returns an inotify based watcher if possible, falling back on polling
+    '''
+    if inotify_simple is not None:
+        try:
+            return InotifyWatcher(directories, interval)
+        except OSError:
+            pass
+    return PollingWatcher(directories, interval)
@@ -0,0 +1,250 @@
+'''
+Isolated workspaces for commands. Each command runs in a private copy of
+the submission, so build artifacts and edits can't leak into the next
+validator or into the submission itself. Copies are made cheaply by
+cloning each file (a reflink, where the filesystem supports it), and only
+fall back to copying the data when that doesn't work. Workspace directories
+are taken from a pool and cleared for reuse afterwards, rather than created
+and deleted for each command.
+
+Validators can isolate with 'hardlink' to hardlink files where reflinks
+aren't supported, which is faster than copying, but hardlinked files are
+the same file as in the submission, so a command that writes to an
+existing file in place, rather than replacing it, still changes the
+submission. Only commands known not to do that should use it.
+'''
+import atexit
+import errno
+import os
+import shutil
+import stat
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl cloning a whole file, from linux/fs.h
+FICLONE = 0x40049409
+
+DEFAULT_POOL_SIZE = 8
+
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+
+# Errors meaning a method isn't supported between two files, rather than
+# that something went wrong
+UNSUPPORTED_ERRNOS = set([
+    errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP,
+    errno.EMLINK,
+])
+
+# Global switch, off with --no-isolate
+enabled = True
+
+
+def get_methods(isolate):
+    '''
+    Returns the ways to try to clone a file in turn, for a validator's
+    isolate setting
+    '''
+    if isolate == HARDLINK:
+        return (REFLINK, HARDLINK, COPY)
+    return (REFLINK, COPY)
+
+
+def reflink(source, destination):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            os.unlink(destination)
+            raise
+    shutil.copystat(source, destination)
+
+
+def copy(source, destination):
+    shutil.copy2(source, destination)
+
+
+CLONERS = {
+    REFLINK: reflink,
+    HARDLINK: os.link,
+    COPY: copy,
+}
+
+
+class WorkspacePool:
+    '''
+    Temporary directories under root to populate with submissions. Up to
+    size cleared workspaces are kept for reuse, and more are created when
+    they are all in use.
+    '''
+    def __init__(self, root, size=DEFAULT_POOL_SIZE):
+        self.root = root
+        self.size = size
+        self.pid = os.getpid()
+        self.free = []
+        self.lock = threading.Lock()
+
+        # Methods found not to work, by (method, device), so they aren't
+        # tried again for every file
+        self.unsupported = set()
+
+    def fill(self):
+        '''
+        Creates workspaces up front, so none are made while grading
+        '''
+        with self.lock:
+            while len(self.free) < self.size:
+                self.free.append(tempfile.mkdtemp(dir=self.root))
+
+    def acquire(self, source, methods=get_methods(True)):
+        '''
+        Returns a workspace populated with the contents of source
+        '''
+        with self.lock:
+            if self.free:
+                path = self.free.pop()
+            else:
+                path = tempfile.mkdtemp(dir=self.root)
+        try:
+            self.populate(source, path, methods)
+        except BaseException:
+            self.release(path)
+            raise
+        return path
+
+    def release(self, path):
+        '''
+        Clears a workspace and returns it to the pool
+        '''
+        if not clear(path):
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        with self.lock:
+            if len(self.free) < self.size:
+                self.free.append(path)
+                return
+        os.rmdir(path)
+
+    def populate(self, source, destination, methods):
+        device = os.stat(source).st_dev
+        for root, dirs, files in os.walk(source):
+            relpath = os.path.relpath(root, source)
+            target = os.path.normpath(os.path.join(destination, relpath))
+            for name in list(dirs):
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    # Recreated as a link rather than followed
+                    dirs.remove(name)
+                    files.append(name)
+                    continue
+                os.mkdir(os.path.join(target, name))
+                shutil.copymode(path, os.path.join(target, name))
+            for name in files:
+                path = os.path.join(root, name)
+                mode = os.lstat(path).st_mode
+                if stat.S_ISLNK(mode):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif stat.S_ISREG(mode):
+                    self.clone(path, os.path.join(target, name), methods,
+                               device)
+
+    def clone(self, source, destination, methods, device):
+        for method in methods:
+            if method == COPY:
+                return copy(source, destination)
+            if (method, device) in self.unsupported:
+                continue
+            try:
+                return CLONERS[method](source, destination)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.unsupported.add((method, device))
+
+
+def _make_writable(function, path, excinfo):
+    # Commands may leave read-only directories behind, which can't be
+    # emptied until they are writable again
+    parent = os.path.dirname(path)
+    os.chmod(parent, os.stat(parent).st_mode | stat.S_IRWXU)
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.chmod(path, os.stat(path).st_mode | stat.S_IRWXU)
+    function(path)
+
+
+def clear(path):
+    '''
+    Deletes everything in a directory, returning whether it worked
+    '''
+    try:
+        os.chmod(path, stat.S_IRWXU)
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, onerror=_make_writable)
+            else:
+                os.unlink(entry.path)
+    except OSError:
+        return False
+    return True
+
+
+# Where workspaces are created, from --workspace-dir or else the system's
+# temporary directory. Every process makes its own pool under _root.
+_parent = None
+_root = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def setup(isolate=True, parent=None):
+    '''
+    Turns isolation on or off, and sets where workspaces are created. For
+    reflinks and hardlinks to work, parent needs to be on the same
+    filesystem as the submissions.
+    '''
+    global enabled, _parent, _root, _pool
+    enabled = isolate
+    if parent != _parent:
+        _parent = parent
+        _root = _pool = None
+
+
+def get_root():
+    global _root
+    if _root is None:
+        _root = tempfile.mkdtemp(prefix='supergrader_isolate_', dir=_parent)
+        atexit.register(shutil.rmtree, _root, True)
+    return _root
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        # Forked worker processes inherit the pool, but need their own
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = WorkspacePool(tempfile.mkdtemp(dir=get_root()))
+            _pool.fill()
+        return _pool
+
+
+def acquire(directory, isolate=True):
+    '''
+    Returns where a command should run for directory: a fresh workspace
+    with a copy of it, or with isolation off, the directory itself
+    '''
+    if not (enabled and isolate):
+        return directory
+    return get_pool().acquire(directory, get_methods(isolate))
+
+
+def release(directory, workdir):
+    if workdir != directory:
+        get_pool().release(workdir)
@@ -0,0 +1,112 @@
+'''
+Tests for grading zip and tar archives with the `archive` module.
+'''
+import os
+import tarfile
+import zipfile
+from os.path import join
+
+from supergrader import supergrader
+
+from .test_grading import GradingTestBase, without_timings
+
+archive = supergrader.archive
+validators = supergrader.validators
+
+
+def make_zip(path, files):
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, contents in files.items():
+            zf.writestr(name, contents)
+
+
+def make_tar(path, source):
+    with tarfile.open(path, 'w:gz') as tf:
+        tf.add(source, arcname='.')
+
+
+class TestArchiveView:
+    def test_listing(self, tmp_path):
+        path = str(tmp_path / 'sub.zip')
+        make_zip(path, {
+            'index.html': '<p>hi</p>',
+            'src/app/main.py': 'def main(): pass',
+            'empty/': '',
+            '../evil.txt': 'outside',
+        })
+        view = archive.ArchiveView(path)
+        assert sorted(view.listdir()) == ['empty', 'index.html', 'src']
+        assert view.listdir()['src'].is_dir
+        assert not view.listdir()['index.html'].is_dir
+        assert list(view.listdir('src')) == ['app']
+        assert view.listdir('empty') == {}
+        assert view.listdir('index.html') is None
+        assert view.exists('src/app/main.py')
+        assert not view.exists('evil.txt')
+        assert view.getsize('index.html') == 9
+        with view.open('src/app/main.py') as fd:
+            assert fd.read() == b'def main(): pass'
+
+        view.extract(str(tmp_path / 'out'))
+        assert sorted(os.listdir(str(tmp_path / 'out'))) == \
+            ['empty', 'index.html', 'src']
+        assert not os.path.exists(str(tmp_path / 'evil.txt'))
+        view.close()
+
+    def test_resolve(self, tmp_path):
+        path = str(tmp_path / 'sub.tar.gz')
+        os.makedirs(str(tmp_path / 'src'))
+        (tmp_path / 'src' / 'a.txt').write_text('hello')
+        make_tar(path, str(tmp_path / 'src'))
+        assert archive.exists(join(path, 'a.txt'))
+        assert not archive.exists(join(path, 'b.txt'))
+        assert archive.getsize(join(path, 'a.txt')) == 5
+        with archive.open_text(join(path, 'a.txt')) as fd:
+            assert fd.read() == 'hello'
+        assert archive.resolve(str(tmp_path / 'src' / 'a.txt')) is None
+        archive.forget(path)
+
+
+class TestGradeArchives(GradingTestBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.archives = []
+        for i, directory in enumerate(self.directories):
+            if i % 2:
+                path = directory + '.tar.gz'
+                make_tar(path, directory)
+            else:
+                path = directory + '.zip'
+                make_zip(path, self.SUBMISSIONS[os.path.basename(directory)])
+            self.archives.append(path)
+
+    def test_matches_directories(self):
+        expected = without_timings(self.grade())
+        self.directories = self.archives
+        results = without_timings(self.grade())
+        for (info, grid), (archive_info, archive_grid) in \
+                zip(expected, results):
+            assert archive_info['validators'] == info['validators']
+
+    def test_commands_use_workspace(self):
+        log = join(self.dir, 'workdirs.log')
+        plan = supergrader.compile_plan([
+            validators.shell_validator(
+                command=['pwd >> %s; test -f index.html' % log],
+                isolate=False),
+            validators.shell_validator(command=['pwd >> %s' % log],
+                                       isolate=False),
+        ])
+        supergrader.setup_cache(self.parse_args())
+        results = [supergrader.grade_directory(d, plan)
+                   for d in self.archives]
+        assert [info['successes'] for info, grid in results] == \
+            [2, 2, 1, 2]
+
+        # Each archive is extracted once, and removed once graded
+        with open(log) as fd:
+            workdirs = fd.read().split()
+        assert len(workdirs) == 8
+        assert workdirs[0] == workdirs[1] != workdirs[2]
+        assert not any(os.path.exists(path) for path in workdirs)
+        assert archive._views == {}
@@ -0,0 +1,191 @@
+'''
+Tests for `supergrader.capture` and output checks of shell validators.
+'''
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+from supergrader import supergrader
+
+validators = supergrader.validators
+capture = validators.capture
+
+
+class TestRingBuffer:
+    def test_keeps_tail(self):
+        ring = capture.RingBuffer(8)
+        ring.write(b'abc')
+        assert ring.getvalue() == b'abc'
+        assert not ring.truncated
+        ring.write(b'defgh')
+        assert ring.getvalue() == b'abcdefgh'
+        ring.write(b'ijk')
+        assert ring.getvalue() == b'defghijk'
+        assert ring.truncated
+        ring.write(b'0123456789')
+        assert ring.getvalue() == b'23456789'
+        ring.write(b'!')
+        assert ring.getvalue() == b'3456789!'
+        assert ring.total == 22
+
+
+class TestLineReader:
+    def test_lines(self):
+        reader = capture.LineReader(max_length=5)
+        assert reader.feed(b'ab') == []
+        assert reader.feed(b'c\nde\n\nfghijklmn') == ['abc', 'de', '']
+        assert reader.feed(b'op\nq') == ['fghij']
+        assert reader.flush() == 'q'
+        assert reader.flush() is None
+
+
+class TestMatchers:
+    def check(self, matcher, lines):
+        captured = capture.Capture(matchers=[matcher])
+        captured.feed(lines.encode('utf-8'))
+        captured.close()
+
+    def test_expected_output(self):
+        expected = 'one\ntwo  \nthree\n'
+        self.check(capture.ExpectedOutput(expected), 'one\ntwo\nthree')
+        with pytest.raises(capture.OutputMismatch,
+                           match='stdout line 2 is "2" instead of "two"'):
+            self.check(capture.ExpectedOutput(expected), 'one\n2\nthree\n')
+        with pytest.raises(capture.OutputMismatch,
+                           match='stdout ended after 1 lines, expected 3'):
+            self.check(capture.ExpectedOutput(expected), 'one\n')
+        with pytest.raises(capture.OutputMismatch,
+                           match='extra line 4: "four"'):
+            self.check(capture.ExpectedOutput(expected),
+                       'one\ntwo\nthree\nfour\n')
+
+    def test_regex(self):
+        self.check(capture.RegexMatch(r'\d+ passed'), 'ok\n12 passed\n')
+        with pytest.raises(capture.OutputMismatch,
+                           match='stderr has no line matching'):
+            self.check(capture.RegexMatch(r'\d+ passed', 'stderr'), 'ok\n')
+
+
+class TestShellValidatorOutput:
+    def validate(self, tmp_path, use_async=False, **kwargs):
+        validator = validators.shell_validator(**kwargs)()
+        if use_async:
+            asyncio.run(validator.validate_async(str(tmp_path)))
+        else:
+            validator.validate(str(tmp_path))
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_expected_output(self, tmp_path, use_async):
+        self.validate(tmp_path, use_async, command=['echo hi; echo there'],
+                      expected_output='hi\nthere\n')
+        self.validate(tmp_path, use_async, command=['echo hi >&2'],
+                      expected_regex='^h', output_stream='stderr')
+        with pytest.raises(validators.ValidationError,
+                           match='stdout line 1 is "bye" instead of "hi"'):
+            self.validate(tmp_path, use_async, command=['echo bye'],
+                          expected_output='hi\n')
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_fails_fast(self, tmp_path, use_async):
+        start = time.monotonic()
+        with pytest.raises(validators.ValidationError):
+            self.validate(tmp_path, use_async,
+                          command=['echo wrong; exec sleep 10'],
+                          expected_output='right\n')
+        assert time.monotonic() - start < 5
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_bounded(self, tmp_path, use_async):
+        results = []
+        self.validate(
+            tmp_path, use_async,
+            command=['head -c 3000000 /dev/zero | tr "\\0" x; echo; echo end'],
+            expected_regex='^end$', max_capture_size=1000,
+            check_results=lambda self, result: results.append(result) or True)
+        result, = results
+        assert result.returncode == 0
+        assert result.stdout == b'x' * 995 + b'\nend\n'
+        assert result.stderr is None
+
+    def test_invalid_configuration(self):
+        with pytest.raises(validators.ConfigurationError,
+                           match='invalid expected_regex'):
+            validators.shell_validator(command=['true'],
+                                       expected_regex='(')()
+        with pytest.raises(validators.ConfigurationError,
+                           match='invalid output_stream'):
+            validators.shell_validator(command=['true'],
+                                       output_stream='stdin')()
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+
+    # Orphans may be left as zombies if nothing reaps them, eg in containers
+    try:
+        with open('/proc/%i/stat' % pid) as fd:
+            return fd.read().split(') ')[-1][0] != 'Z'
+    except FileNotFoundError:
+        return True
+
+
+class TestShellValidatorLimits(TestShellValidatorOutput):
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_timeout(self, tmp_path, use_async):
+        start = time.monotonic()
+        pid_file = tmp_path / 'bg.pid'
+        with pytest.raises(validators.ValidationError,
+                           match='Command timed out after 0.5s'):
+            self.validate(tmp_path, use_async, timeout=0.5,
+                          command=['sleep 30 & echo $! > %s; sleep 30' %
+                                   pid_file])
+        assert time.monotonic() - start < 5
+
+        # Anything the command started is killed too
+        pid = int(pid_file.read_text())
+        time.sleep(0.1)
+        assert not is_running(pid)
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_timeout_with_capture(self, tmp_path, use_async):
+        with pytest.raises(validators.ValidationError, match='timed out'):
+            self.validate(tmp_path, use_async, timeout=0.5,
+                          command=['echo start; exec sleep 30'],
+                          expected_regex='never')
+        self.validate(tmp_path, use_async, timeout=5,
+                      command=['echo done'], expected_regex='done')
+
+    def test_cpu_limit(self, tmp_path):
+        with pytest.raises(validators.ValidationError,
+                           match='exceeded CPU limit of 1s'):
+            self.validate(tmp_path, cpu_limit=1, timeout=30,
+                          command=['while :; do :; done'])
+
+    def test_memory_limit(self, tmp_path):
+        allocate = [sys.executable, '-c', 'x = bytearray(512 * 1024 * 1024)']
+        with pytest.raises(validators.ValidationError,
+                           match=r'memory limited to 64MB'):
+            self.validate(tmp_path, memory_limit=64,
+                          get_kwds=lambda self, directory: {},
+                          command=allocate)
+
+    def test_failure_within_limits(self, tmp_path):
+        # Failing for some other reason doesn't blame the limits
+        with pytest.raises(validators.ValidationError) as info:
+            self.validate(tmp_path, memory_limit=200, cpu_limit=10,
+                          command=['exit 3'])
+        assert str(info.value) == 'Command unsuccessful: exit 3'
+        assert not isinstance(info.value, validators.ValidationLimitError)
+
+    def test_signal_reported_by_shell(self, tmp_path):
+        # The shell reports a child killed by SIGXCPU as exit status 128 + 24
+        with pytest.raises(validators.ValidationLimitError,
+                           match='exceeded CPU limit of 10s'):
+            self.validate(tmp_path, cpu_limit=10,
+                          command=['sh -c "kill -XCPU \\$\\$"; exit $?'])
@@ -0,0 +1,117 @@
+'''
+Tests for grading with a long running daemon, from `supergrader.daemon`.
+'''
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import join
+
+from supergrader import supergrader
+
+from .test_grading import GradingTestBase, without_timings, write_file
+from .test_distributed import SCRIPT
+
+daemon = supergrader.daemon
+
+
+def touch_later(path):
+    # Make sure the change shows, even with coarse timestamps
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+class TestWarmProfile:
+    def test_reload(self, tmp_path):
+        path = str(tmp_path / 'sgwarmprofile.py')
+        write_file(path, 'NAMES = ["a"]\n')
+        sys.path.insert(0, str(tmp_path))
+        compiled = []
+
+        def compile(module):
+            compiled.append(list(module.NAMES))
+            return compiled[-1]
+
+        try:
+            profile = daemon.WarmProfile(
+                lambda: __import__('sgwarmprofile'), compile)
+            assert profile.get_plan() == ['a']
+            assert profile.get_plan() == ['a']
+            assert len(compiled) == 1
+
+            write_file(path, 'NAMES = ["a", "b"]\n')
+            touch_later(path)
+            assert profile.get_plan() == ['a', 'b']
+            assert len(compiled) == 2
+        finally:
+            sys.path.remove(str(tmp_path))
+            sys.modules.pop('sgwarmprofile', None)
+
+
+class TestDaemon(GradingTestBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.socket = join(self.dir, 'sg.sock')
+        self.process = subprocess.Popen(
+            [sys.executable, SCRIPT, 'serve', '-p', self.profile_name,
+             '--no-cache', '--socket', self.socket], cwd=self.dir)
+        deadline = time.monotonic() + 30
+        while not os.path.exists(self.socket):
+            assert time.monotonic() < deadline
+            assert self.process.poll() is None
+            time.sleep(0.05)
+
+    def teardown_method(self, method):
+        self.process.terminate()
+        assert self.process.wait(timeout=30) == 0
+        assert not os.path.exists(self.socket)
+
+    def request(self, directories, format='jsonl'):
+        stream = io.StringIO()
+        reply = daemon.request(self.socket, {
+            'type': 'grade',
+            'directories': directories,
+            'cwd': self.dir,
+            'format': format,
+        }, stream)
+        return reply, stream.getvalue()
+
+    def test_grade(self):
+        expected = without_timings(self.grade())
+        names = [os.path.basename(d) for d in self.directories]
+        for i in range(2):
+            reply, output = self.request(names)
+            assert reply == {'type': 'done', 'directories': 4}
+            records = [json.loads(line) for line in output.splitlines()]
+            assert [record['directory'] for record in records] == names
+            for record, (info, grid) in zip(records, expected):
+                assert record['successes'] == info['successes']
+
+        reply, output = self.request(names[:1], 'csv')
+        assert output.splitlines()[0].startswith('directory,successes')
+
+    def test_reload_profile(self):
+        profile = join(self.dir, self.profile_name + '.py')
+        write_file(profile, 'import validators as v\nVALIDATORS = [\n'
+                   '    v.shell_validator(command=["exit 1"], name="Fails"),'
+                   '\n]\n')
+        touch_later(profile)
+        reply, output = self.request(['alice'])
+        record = json.loads(output)
+        assert record['results'] == {'Fails': 'F'}
+
+        write_file(profile, 'VALIDATORS = [\n')
+        touch_later(profile)
+        reply, output = self.request(['alice'])
+        assert reply['type'] == 'error'
+        assert reply['message'].startswith('Unable to load profile')
+
+    def test_client(self):
+        output = subprocess.check_output(
+            [sys.executable, SCRIPT, 'client', '--socket', self.socket,
+             '-f', 'csv', 'alice', 'bob'], cwd=self.dir,
+            universal_newlines=True)
+        assert [line.split(',')[0] for line in output.splitlines()] == \
+            ['directory', 'alice', 'bob']
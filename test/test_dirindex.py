@@ -0,0 +1,136 @@
+'''
+Tests for `dirindex` module.
+'''
+import os
+import re
+import shutil
+import tempfile
+from os.path import join, exists
+
+import pytest
+
+from supergrader import supergrader
+
+dirindex = supergrader.dirindex
+validators = supergrader.validators
+
+
+class TestDirectoryIndex:
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        os.makedirs(join(self.dir, 'css', 'vendor'))
+        open(join(self.dir, 'index.html'), 'w').write('')
+        open(join(self.dir, 'css', 'style.css'), 'w').write('')
+        os.symlink('style.css', join(self.dir, 'css', 'link.css'))
+        os.symlink('missing.css', join(self.dir, 'css', 'broken.css'))
+        self.index = dirindex.DirectoryIndex(self.dir)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_matches_os_path_exists(self):
+        paths = [
+            '', '.', 'index.html', 'index.html/', 'missing', 'css', 'css/',
+            'css/style.css', 'css/link.css', 'css/broken.css', 'css/vendor',
+            'css/vendor/', 'index.html/nope', 'css/../index.html',
+            './css//style.css', 'css/vendor/missing',
+        ]
+        for path in paths:
+            assert self.index.exists(path) == exists(join(self.dir, path)), \
+                path
+
+    def test_lists_each_directory_once(self):
+        self.index.exists('css/style.css')
+        self.index.exists('css/missing.css')
+        self.index.exists('css/vendor')
+        assert sorted(self.index.listings) == ['css']
+
+    def test_refresh(self):
+        assert not self.index.exists('new.html')
+        open(join(self.dir, 'new.html'), 'w').write('')
+        assert not self.index.exists('new.html')
+        self.index.refresh()
+        assert self.index.exists('new.html')
+
+    def test_structure_validator(self):
+        validator = validators.file_structure_validator(dir_tree=[
+            'index.html',
+            'about.html',
+            ('css', ['style.css', 'print.css']),
+            ('js', ['main.js']),
+        ])()
+        message = 'Could not find: about.html, print.css, ' + \
+            join(self.dir, 'js')
+        with pytest.raises(validators.ValidationError,
+                           match='^%s$' % re.escape(message)):
+            validator.validate(self.dir)
+        dirindex.forget(self.dir)
+
+
+class TestFilePattern:
+    FILES = [
+        'index.html', 'about.html', '.hidden.html', 'README',
+        'src/app.py', 'src/test_app.py', 'src/pkg/test_util.py',
+        'test_top.py', 'static/css/style.css',
+    ]
+
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        for path in self.FILES:
+            path = join(self.dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').write('')
+        self.index = dirindex.DirectoryIndex(self.dir)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def count(self, *args, **kwargs):
+        return validators.FilePattern(*args, **kwargs).count(self.index)
+
+    def test_globs(self):
+        assert self.count('*.html') == 3
+        assert self.count('src/*.py') == 2
+        assert self.count('**/test_*.py') == 3
+        assert self.count('src/**/*.py') == 3
+        assert self.count('[ai]*.html') == 2
+        assert self.count('[!ai]*.html') == 1
+        assert self.count('*/') == 2
+        assert self.count('**') == len(self.FILES) + 4
+        assert self.count('*.css') == 0
+
+    def test_brackets(self):
+        # A "]" first in a set is part of it, as with fnmatch
+        regexp = dirindex.compile_glob('[]x]y')
+        assert regexp.match(']y') and regexp.match('xy')
+        assert not regexp.match('[]x]y')
+        assert dirindex.compile_glob('[!]]').match('a')
+        assert not dirindex.compile_glob('[!]]').match(']')
+        with pytest.raises(validators.ConfigurationError,
+                           match='Invalid pattern'):
+            validators.FilePattern('[z-a].py')
+
+    def test_regex(self):
+        assert self.count(r'(\w+/)*test_\w+\.py', regex=True) == 3
+        assert self.count(r'[a-z]+\.html', regex=True) == 2
+
+    def test_relative_to_subdirectory(self):
+        pattern = validators.FilePattern('*.py')
+        assert pattern.count(self.index, 'src') == 2
+
+    def test_structure_validator(self):
+        validator = validators.file_structure_validator(dir_tree=[
+            '*.html',
+            '*.js',
+            validators.FilePattern('**/test_*.py', min_count=4),
+            validators.FilePattern('*.html', max_count=2),
+            ('src', ['*.py', validators.FilePattern('*.py', max_count=2)]),
+        ])()
+        message = (
+            'Could not find: *.js, at least 4 of **/test_*.py (found 3), '
+            'at most 2 of *.html (found 3)'
+        )
+        with pytest.raises(validators.ValidationError,
+                           match='^%s$' % re.escape(message)):
+            validator.validate(self.dir)
+        dirindex.forget(self.dir)
@@ -0,0 +1,194 @@
+'''
+Tests for grading with a coordinator and workers, from `supergrader.distributed`.
+'''
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from supergrader import supergrader
+
+from .test_grading import GradingTestBase, without_timings
+
+distributed = supergrader.distributed
+
+TOKEN = 'sesame'
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'supergrader', 'supergrader.py')
+
+
+class FakeWorker:
+    '''
+    Speaks just enough of the protocol to take work and never finish it
+    '''
+    def __init__(self, address, token=TOKEN):
+        self.sock = socket.create_connection(address)
+        self.fd = self.sock.makefile('rwb')
+        self.send({'type': 'hello', 'name': 'fake', 'token': token})
+        self.config = self.receive()
+
+    def send(self, message):
+        self.fd.write(distributed.encode(message))
+        self.fd.flush()
+
+    def receive(self):
+        return distributed.decode(self.fd.readline())
+
+    def take(self, count):
+        assert self.config['type'] == 'config'
+        self.send({'type': 'request', 'max': count})
+        reply = self.receive()
+        assert reply['type'] == 'work'
+        return [path for index, path in reply['directories']]
+
+    def forge(self, index):
+        self.send({'type': 'result', 'index': index,
+                   'info': {'forged': True}, 'grid': []})
+
+    def close(self):
+        self.fd.close()
+        self.sock.close()
+
+
+class TestDistributed(GradingTestBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        args = self.parse_args()
+        supergrader.check_args(args)
+        supergrader.setup_cache(args)
+        self.plan = supergrader.compile_plan(supergrader.get_validator_classes(
+            supergrader.get_profile(args)))
+
+    def start(self, **kwargs):
+        self.coordinator = distributed.Coordinator(
+            self.directories, {'profile': self.profile_name},
+            lambda d, message: supergrader.give_up_result(
+                self.plan, d, message),
+            TOKEN, port=0, **kwargs)
+        return self.coordinator.start()
+
+    def run_workers(self, address, count):
+        def run():
+            worker = distributed.Worker(
+                address, TOKEN, lambda config: self.plan,
+                supergrader.grade_chunk, chunk_size=1)
+            graded.append(worker.run())
+
+        graded = []
+        threads = [threading.Thread(target=run) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        try:
+            return without_timings(list(self.coordinator.iter_results()))
+        finally:
+            self.coordinator.stop()
+            for thread in threads:
+                thread.join()
+            self.graded = sum(graded)
+
+    def test_workers(self):
+        expected = without_timings(self.grade())
+        results = self.run_workers(self.start(), 3)
+        assert results == expected
+        assert self.graded == 4
+
+    def test_dead_worker(self):
+        expected = without_timings(self.grade())
+        address = self.start()
+        fake = FakeWorker(address)
+        assert fake.take(2) == self.directories[:2]
+        fake.close()
+        assert self.run_workers(address, 2) == expected
+
+    def test_expired_lease(self):
+        expected = without_timings(self.grade())
+        address = self.start(lease=0.2)
+        fake = FakeWorker(address)
+        assert fake.take(1) == self.directories[:1]
+        try:
+            assert self.run_workers(address, 1) == expected
+        finally:
+            fake.close()
+
+    def test_bad_token(self):
+        address = self.start()
+        fake = FakeWorker(address, 'open up')
+        try:
+            assert fake.config == {'type': 'error', 'message': 'Bad token'}
+            assert fake.receive() is None
+        finally:
+            fake.close()
+        worker = distributed.Worker(
+            address, 'open up', lambda config: self.plan,
+            supergrader.grade_chunk)
+        with pytest.raises(distributed.RefusedError, match='Bad token'):
+            worker.run()
+        self.coordinator.stop()
+
+    def test_results_need_a_lease(self):
+        expected = without_timings(self.grade())
+        address = self.start()
+        fake = FakeWorker(address)
+        assert fake.take(1) == self.directories[:1]
+        # Neither someone else's directory nor one never handed out counts
+        fake.forge(1)
+        other = FakeWorker(address)
+        other.forge(0)
+        other.forge(len(self.directories))
+        fake.close()
+        other.close()
+        assert self.run_workers(address, 1) == expected
+
+    def test_gives_up(self):
+        address = self.start(retries=0)
+        fake = FakeWorker(address)
+        fake.take(1)
+        fake.close()
+        results = self.run_workers(address, 1)
+        info, grid = results[0]
+        assert info['errors'] == len(self.plan)
+        assert info['messages']['error'][0] == (
+            'Gave up after 1 attempts, the last as its worker disconnected')
+        assert {result for key, result in grid} == {'E'}
+        assert [info['errors'] for info, grid in results[1:]] == [0, 0, 0]
+        assert self.graded == 3
+
+
+class TestDistributedCommands(GradingTestBase):
+    env = dict(os.environ, SUPERGRADER_TOKEN=TOKEN)
+
+    def command(self, *args):
+        return [sys.executable, SCRIPT] + list(args)
+
+    def test_coordinator_and_workers(self):
+        expected = without_timings(self.grade())
+        coordinator = subprocess.Popen(
+            self.command('serve-coordinator', '-p', self.profile_name,
+                         '--no-cache', '-f', 'jsonl', '--bind', '127.0.0.1:0',
+                         *self.directories),
+            cwd=self.dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, env=self.env)
+        try:
+            address = coordinator.stderr.readline().split()[-1]
+            workers = [
+                subprocess.Popen(self.command('worker', address, '--no-cache'),
+                                 cwd=self.dir, env=self.env)
+                for i in range(2)
+            ]
+            output, errors = coordinator.communicate(timeout=60)
+            assert [worker.wait(timeout=60) for worker in workers] == [0, 0]
+        finally:
+            coordinator.kill()
+        assert coordinator.returncode == 0
+
+        records = [json.loads(line) for line in output.splitlines()]
+        assert [record['directory'] for record in records] == \
+            self.directories
+        for record, (info, grid) in zip(records, expected):
+            assert record['successes'] == info['successes']
+            assert record['failures'] == info['failures']
@@ -0,0 +1,178 @@
+'''
+Tests for `filecache` module.
+'''
+import shutil
+import tempfile
+from os.path import join
+
+from supergrader import supergrader
+
+filecache = supergrader.validators.filecache
+validators = supergrader.validators
+
+
+class TestFileCache:
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        self.path = join(self.dir, 'index.html')
+        open(self.path, 'w').write('Hello   World')
+        self.cache = filecache.FileCache(max_size=100)
+        self.sanitize_calls = 0
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def upper(self, text):
+        self.sanitize_calls += 1
+        return text.upper()
+
+    def test_memoizes(self):
+        assert self.cache.read(self.path, self.upper, 'upper') == \
+            'HELLO   WORLD'
+        assert self.cache.read(self.path, self.upper, 'upper') == \
+            'HELLO   WORLD'
+        assert self.sanitize_calls == 1
+        assert self.cache.read(self.path) == 'Hello   World'
+        assert len(self.cache.entries) == 2
+
+    def test_rereads_changed_file(self):
+        self.cache.read(self.path, self.upper, 'upper')
+        open(self.path, 'w').write('Goodbye')
+        assert self.cache.read(self.path, self.upper, 'upper') == 'GOODBYE'
+        assert self.sanitize_calls == 2
+
+    def test_evicts_least_recently_used(self):
+        paths = []
+        for i in range(4):
+            path = join(self.dir, '%i.txt' % i)
+            open(path, 'w').write('x' * 40)
+            paths.append(path)
+        self.cache.read(paths[0])
+        self.cache.read(paths[1])
+        self.cache.read(paths[0])
+        self.cache.read(paths[2])
+        assert self.cache.size <= 100
+        cached_paths = [key[0] for key in self.cache.entries]
+        assert cached_paths == [paths[0], paths[2]]
+
+    def test_too_large_not_cached(self):
+        open(self.path, 'w').write('x' * 101)
+        self.cache.read(self.path)
+        assert not self.cache.entries
+
+
+class TestFileTextValidatorSharing:
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        open(join(self.dir, 'a.txt'), 'w').write('One two  Two three')
+        filecache.default_cache.clear()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_shares_sanitized_contents(self):
+        kwargs = {'path': 'a.txt', 'ignore_case': True, 'exact_count': 2}
+        validators.file_text_validator(text='two', **kwargs)().validate(
+            self.dir)
+        validators.file_text_validator(text='TWO', **kwargs)().validate(
+            self.dir)
+        validators.file_text_validator(
+            text='two', path='a.txt', whole_word_only=True)().validate(
+            self.dir)
+        assert len(filecache.default_cache.entries) == 2
+
+    def test_plan_resets_pattern_groups(self):
+        def compile(text):
+            return supergrader.compile_plan([validators.file_text_validator(
+                text=text, path='a.txt')])[0]
+
+        old = compile('one')
+        assert old.get_pattern_group() == {'one'}
+        new = compile('two')
+        assert new.get_pattern_group() == {'two'}
+
+        # Identity doesn't depend on what other validators were built
+        assert compile('two').identity == new.identity
+
+
+class TestCountAll:
+    TEXT = 'aaa abc bcd <p>x</p><p>y</p> <li></li> abcd'
+
+    def check(self, contents, patterns):
+        expected = {pattern: contents.count(pattern) for pattern in patterns}
+        assert filecache.count_all(contents, patterns) == expected
+
+    def test_independent_patterns(self):
+        self.check(self.TEXT, ['<p>', '<li>', 'x', 'zzz'])
+
+    def test_overlapping_patterns(self):
+        self.check(self.TEXT, ['aa', 'ab', 'bc', 'abcd', 'cd', 'a', '<p>'])
+        self.check('aaaa', ['aa', 'aaa', 'a'])
+
+    def test_empty_pattern(self):
+        self.check(self.TEXT, ['', 'a'])
+
+    def test_words(self):
+        words = self.TEXT.split()
+        self.check(words, ['aaa', 'abc', 'a', 'abcd', 'bcd <p>'])
+
+    def test_validators_count_once(self):
+        cache = filecache.FileCache()
+        tmp = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        path = join(tmp, 'index.html')
+        open(path, 'w').write(self.TEXT)
+        patterns = ['<p>', '<li>', 'abc']
+        assert cache.count(path, '<p>', patterns) == 2
+        cached_file = list(cache.entries.values())[0]
+        assert cached_file.counts == {'<p>': 2, '<li>': 1, 'abc': 2}
+        assert cache.count(path, 'abc', patterns) == 2
+        shutil.rmtree(tmp)
+
+
+class TestStreamCount:
+    TEXT = (
+        'The  quick\tbrown fox\n\n jumps over the lazy dog. aaaa THE end\n'
+        'Abab abab ababab the\t \n'
+    )
+    PATTERNS = ['the', 'aa', 'abab', 'a', ' ', 'fox jumps', 'the lazy', '']
+
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        self.path = join(self.dir, 'big.log')
+        open(self.path, 'w').write(self.TEXT * 3)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def check(self, **flags):
+        validator = validators.file_text_validator(
+            text='', path='big.log', **flags)()
+        contents = validator.sanitize(self.TEXT * 3)
+        for pattern in self.PATTERNS:
+            pattern = validator.sanitize(pattern, is_search=True)
+            expected = contents.count(pattern)
+            for chunk_size in (1, 2, 3, 7, 64, 4096):
+                actual = filecache.stream_count(
+                    self.path, pattern, chunk_size=chunk_size, **flags)
+                assert actual == expected, (pattern, chunk_size)
+
+    def test_plain(self):
+        self.check()
+
+    def test_normalize_whitespace(self):
+        self.check(normalize_whitespace=True)
+
+    def test_ignore_case(self):
+        self.check(normalize_whitespace=True, ignore_case=True)
+
+    def test_whole_word_only(self):
+        self.check(whole_word_only=True)
+        self.check(whole_word_only=True, ignore_case=True)
+
+    def test_validator_streams_large_files(self):
+        filecache.default_cache.clear()
+        validator = validators.file_text_validator(
+            text='the', path='big.log', ignore_case=True, exact_count=12,
+            large_file_size=10)()
+        validator.validate(self.dir)
+        assert not filecache.default_cache.entries
@@ -0,0 +1,204 @@
+'''
+Tests for running student Python with `python_validator` and the
+`forkserver` module.
+'''
+import os
+import sys
+import time
+
+import pytest
+
+from supergrader import supergrader
+
+validators = supergrader.validators
+forkserver = validators.forkserver
+
+PRELOAD = '''
+import os
+with open(%r, 'a') as fd:
+    fd.write('%%i\\n' %% os.getpid())
+'''
+
+TESTS = '''
+import doubler
+
+def test_double():
+    assert doubler.double(2) == 4
+
+def test_negative():
+    assert doubler.double(-1) == -2, 'wrong sign'
+'''
+
+
+def write(path, text):
+    with open(str(path), 'w') as fd:
+        fd.write(text)
+
+
+class TestTailWriter:
+    def test_keeps_tail(self):
+        writer = forkserver.TailWriter(5)
+        writer.write('abc')
+        assert writer.getvalue() == 'abc'
+        for i in range(10):
+            writer.write('0123456789')
+        assert writer.getvalue() == '56789'
+
+
+class TestPythonValidator:
+    def setup_method(self, method):
+        self.modules = set(sys.modules)
+
+    def teardown_method(self, method):
+        for name in set(sys.modules) - self.modules:
+            del sys.modules[name]
+
+    def check(self, directory, **kwargs):
+        validators.python_validator(**kwargs)().validate(str(directory))
+
+    def test_module(self, tmp_path):
+        write(tmp_path / 'sol.py', 'n = int(input())\nprint(n * 2)\n')
+        self.check(tmp_path, module='sol.py', stdin='21\n',
+                   expected_output='42\n')
+        with pytest.raises(validators.ValidationError,
+                           match='stdout line 1 is "4" instead of "42"'):
+            self.check(tmp_path, module='sol.py', stdin='2\n',
+                       expected_output='42\n')
+        with pytest.raises(validators.ValidationError,
+                           match='sol.py raised ValueError'):
+            self.check(tmp_path, module='sol.py', stdin='two\n')
+        with pytest.raises(validators.ValidationError,
+                           match='Expected file does not exist: nope.py'):
+            self.check(tmp_path, module='nope.py')
+
+    def test_exit_status(self, tmp_path):
+        write(tmp_path / 'ok.py', 'import sys\nsys.exit(0)\n')
+        write(tmp_path / 'bad.py', 'import sys\nsys.exit(3)\n')
+        self.check(tmp_path, module='ok.py')
+        with pytest.raises(validators.ValidationError,
+                           match='bad.py exited with status 3'):
+            self.check(tmp_path, module='bad.py')
+
+    def test_check_module(self, tmp_path):
+        write(tmp_path / 'sol.py', 'answer = 41\n')
+
+        def check_module(self, namespace):
+            assert namespace['answer'] == 42, 'answer should be 42'
+
+        with pytest.raises(validators.ValidationError,
+                           match='answer should be 42'):
+            self.check(tmp_path, module='sol.py', check_module=check_module)
+
+    def test_tests(self, tmp_path):
+        profile_dir = tmp_path / 'profile'
+        profile_dir.mkdir()
+        write(profile_dir / 'sgtests_doubler.py', TESTS)
+        write(tmp_path / 'doubler.py', 'def double(n):\n    return abs(n) * 2\n')
+        sys.path.insert(0, str(profile_dir))
+        try:
+            with pytest.raises(validators.ValidationError) as info:
+                self.check(tmp_path, tests='sgtests_doubler')
+        finally:
+            sys.path.remove(str(profile_dir))
+        assert str(info.value) == (
+            '1 of 2 tests failed: test_negative (AssertionError: wrong sign)')
+
+    def test_tests_identity(self, tmp_path):
+        tests = tmp_path / 'sgtests_identity.py'
+        write(tests, TESTS)
+        sys.path.insert(0, str(tmp_path))
+        try:
+            validator = validators.python_validator(tests='sgtests_identity')
+            before = validator().identity
+            assert validator().identity == before
+
+            # Editing the tests means cached results no longer apply
+            write(tests, TESTS + '\ndef test_more():\n    pass\n')
+            assert validator().identity != before
+        finally:
+            sys.path.remove(str(tmp_path))
+
+    def test_timeout(self, tmp_path):
+        write(tmp_path / 'loop.py', 'while True:\n    pass\n')
+        start = time.monotonic()
+        with pytest.raises(validators.ValidationError,
+                           match='Check timed out after 0.5s'):
+            self.check(tmp_path, module='loop.py', timeout=0.5)
+        assert time.monotonic() - start < 5
+
+        # The server carries on after killing a check
+        write(tmp_path / 'sol.py', 'print("hi")\n')
+        self.check(tmp_path, module='sol.py', expected_output='hi\n')
+
+    def test_preload(self, tmp_path):
+        log = tmp_path / 'preload.log'
+        profile_dir = tmp_path / 'profile'
+        profile_dir.mkdir()
+        write(profile_dir / 'sgpreload_heavy.py', PRELOAD % str(log))
+        write(tmp_path / 'sol.py',
+              'import sys\nassert "sgpreload_heavy" in sys.modules\n')
+        sys.path.insert(0, str(profile_dir))
+        try:
+            validator = validators.python_validator(
+                module='sol.py', preload=['sgpreload_heavy'])()
+            for i in range(3):
+                validator.validate(str(tmp_path))
+        finally:
+            sys.path.remove(str(profile_dir))
+
+        # Imported once, by the fork server rather than the grading process
+        pids = log.read_text().split()
+        assert len(pids) == 1
+        assert int(pids[0]) != os.getpid()
+        assert 'sgpreload_heavy' not in sys.modules
+
+    def test_isolated(self, tmp_path):
+        write(tmp_path / 'sol.py', 'open("artifact", "w").close()\n')
+        self.check(tmp_path, module='sol.py')
+        assert not os.path.exists(str(tmp_path / 'artifact'))
+        self.check(tmp_path, module='sol.py', isolate=False)
+        assert os.path.exists(str(tmp_path / 'artifact'))
+
+    def test_grade_async(self, tmp_path):
+        directories = []
+        for i in range(4):
+            directory = tmp_path / str(i)
+            directory.mkdir()
+            write(directory / 'sol.py', 'import time\ntime.sleep(0.3)\n'
+                  'print(%i)\n' % i)
+            directories.append(str(directory))
+        plan = supergrader.compile_plan([
+            validators.python_validator(module='sol.py', expected_regex='^2$'),
+        ])
+        start = time.monotonic()
+        results = supergrader.grade_chunk(directories, plan, concurrency=4)
+        assert [info['successes'] for info, grid in results] == [0, 0, 1, 0]
+
+        # Checks run at the same time, in children of the one server
+        assert time.monotonic() - start < 1.2
+
+    def test_rebuilt_validators_share_checks(self, tmp_path):
+        write(tmp_path / 'sol.py', 'print("hi")\n')
+
+        def build():
+            # As reloading an unchanged profile would
+            return validators.python_validator(
+                module='sol.py', expected_output='hi\n')()
+
+        first = build()
+        first.validate(str(tmp_path))
+        pid = forkserver.get_server().pid
+        count = len(forkserver._checks)
+        second = build()
+        second.validate(str(tmp_path))
+        assert second.check_key == first.check_key
+        assert len(forkserver._checks) == count
+        assert forkserver.get_server().pid == pid
+
+    def test_invalid_configuration(self):
+        with pytest.raises(validators.ConfigurationError,
+                           match='needs a module or tests'):
+            validators.python_validator()()
+        with pytest.raises(validators.ConfigurationError,
+                           match="can't find tests module sgtests_missing"):
+            validators.python_validator(tests='sgtests_missing')()
@@ -0,0 +1,765 @@
+'''
+Tests for grading directories with `supergrader.main` and friends.
+'''
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+from os.path import join
+
+import pytest
+
+from supergrader import supergrader
+
+PROFILE = '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['exit 0'], name='Success Validator'),
+    v.file_structure_validator(dir_tree=['index.html'], name='Has Index'),
+    v.file_text_validator(text='<p>', min_count=2, path='index.html',
+                          name='Two Paragraphs'),
+    ('file_text', {'text': '<h1>', 'path': 'index.html', 'name': 'Header'}),
+]
+'''
+
+
+def write_file(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fd:
+        fd.write(contents)
+
+
+def without_timings(results):
+    '''
+    Timings differ between runs, so drop them to compare results
+    '''
+    for info, grid in results:
+        info.pop('timings', None)
+        info.pop('time', None)
+    return results
+
+
+class GradingTestBase:
+    '''
+    Creates a temporary profile module and a handful of submission
+    directories for each test
+    '''
+    SUBMISSIONS = {
+        'alice': {'index.html': '<h1>Hi</h1><p>one</p><p>two</p>'},
+        'bob': {'index.html': '<p>one</p>'},
+        'carol': {'readme.txt': 'nothing here'},
+        'dave': {'index.html': '<h1>Yo</h1><p>a</p><p>b</p><p>c</p>'},
+    }
+    PROFILE = PROFILE
+    EXTRA_ARGS = ['--no-cache']
+
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        self.cache_dir = join(self.dir, 'cache')
+        os.environ['SUPERGRADER_CACHE'] = self.cache_dir
+        self.profile_name = 'sgtestprofile_%s' % method.__name__
+        write_file(join(self.dir, self.profile_name + '.py'), self.PROFILE)
+        sys.path.insert(0, self.dir)
+        self.directories = []
+        for name, files in sorted(self.SUBMISSIONS.items()):
+            for path, contents in files.items():
+                write_file(join(self.dir, name, path), contents)
+            self.directories.append(join(self.dir, name))
+
+    def teardown_method(self, method):
+        sys.path.remove(self.dir)
+        del os.environ['SUPERGRADER_CACHE']
+        sys.modules.pop(self.profile_name, None)
+        shutil.rmtree(self.dir)
+
+    def parse_args(self, *extra):
+        return supergrader.parse_args(
+            ['-p', self.profile_name] + self.EXTRA_ARGS + list(extra) +
+            self.directories)
+
+    def grade(self, *extra):
+        args = self.parse_args(*extra)
+        supergrader.check_args(args)
+        supergrader.setup_cache(args)
+        profile = supergrader.get_profile(args)
+        validator_classes = supergrader.get_validator_classes(profile)
+        plan = supergrader.compile_plan(validator_classes)
+        return list(supergrader.grade_directories(args, plan))
+
+
+class TestGradeDirectories(GradingTestBase):
+    def test_serial(self):
+        results = self.grade()
+        infos = [info for info, grid in results]
+        assert [info['directory'] for info in infos] == self.directories
+        assert [info['successes'] for info in infos] == [4, 2, 1, 4]
+        assert [info['failures'] for info in infos] == [0, 2, 3, 0]
+        bob_grid = dict(results[1][1])
+        assert bob_grid[(self.directories[1].strip('/'), 'Header')] == 'F'
+
+    def test_parallel_matches_serial(self):
+        assert without_timings(self.grade('--jobs', '3')) == \
+            without_timings(self.grade())
+
+    def test_main_parallel(self, capsys, monkeypatch):
+        # Relative directory names keep the matrix narrow
+        monkeypatch.chdir(self.dir)
+        self.directories = sorted(self.SUBMISSIONS)
+        supergrader.main(self.parse_args('-j', '2'))
+        parallel = capsys.readouterr().out
+        supergrader.main(self.parse_args())
+        assert capsys.readouterr().out == parallel
+
+
+class TestAsyncEngine(GradingTestBase):
+    def test_matches_serial(self):
+        assert without_timings(self.grade('--concurrency', '4')) == \
+            without_timings(self.grade())
+
+    def test_with_jobs(self):
+        assert without_timings(self.grade('-c', '2', '-j', '2')) == \
+            without_timings(self.grade())
+
+
+SLEEP_PROFILE = '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['sleep 0.5'], name='Sleep'),
+    v.shell_validator(command=['test -e index.html'], name='Has Index'),
+]
+'''
+
+
+class TestAsyncOverlap(GradingTestBase):
+    PROFILE = SLEEP_PROFILE
+
+    def test_shell_commands_overlap(self):
+        start = time.monotonic()
+        results = self.grade('--concurrency', '4')
+        elapsed = time.monotonic() - start
+        # Four directories sleeping half a second each, run side by side
+        assert elapsed < 1.5
+        assert [info['failures'] for info, grid in results] == [0, 0, 1, 0]
+        carol_info = results[2][0]
+        assert carol_info['messages']['fail'] == [
+            'Command unsuccessful: test -e index.html',
+        ]
+
+
+COUNTING_PROFILE = '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['echo run >> $0/runs.log; test -e index.html',
+                               '$0'],
+                      name='Counted', get_arguments=lambda self, d: [%r]),
+    v.file_text_validator(text='<p>', min_count=2, path='index.html',
+                          name='Two Paragraphs'),
+]
+'''
+
+
+class CountingTestBase(GradingTestBase):
+    '''
+    Uses a profile whose shell validator logs every time it actually runs
+    '''
+    EXTRA_ARGS = []
+
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.log_dir = join(self.dir, 'logs')
+        os.makedirs(self.log_dir)
+        self.PROFILE = COUNTING_PROFILE % self.log_dir
+        write_file(join(self.dir, self.profile_name + '.py'), self.PROFILE)
+
+    def count_runs(self):
+        with open(join(self.log_dir, 'runs.log')) as fd:
+            return len(fd.readlines())
+
+
+class TestResultCache(CountingTestBase):
+    def test_replays_unchanged_directories(self):
+        first = without_timings(self.grade())
+        assert self.count_runs() == 4
+        assert os.listdir(self.cache_dir)
+
+        # Nothing changed, so nothing is rerun, but results are identical
+        assert without_timings(self.grade()) == first
+        assert self.count_runs() == 4
+
+        # Only the changed directory is rerun
+        write_file(join(self.directories[1], 'index.html'), '<p></p><p>')
+        second = without_timings(self.grade())
+        assert self.count_runs() == 5
+        assert second[1][0]['failures'] == 0
+        assert second[0] == first[0]
+
+    def test_hash_covers_every_entry(self):
+        directory = self.directories[0]
+        digests = [supergrader.cache.hash_directory(directory)]
+        os.mkdir(join(directory, 'static'))
+        digests.append(supergrader.cache.hash_directory(directory))
+        os.symlink('index.html', join(directory, 'home.html'))
+        digests.append(supergrader.cache.hash_directory(directory))
+        os.chmod(join(directory, 'index.html'), 0o755)
+        digests.append(supergrader.cache.hash_directory(directory))
+        assert len(set(digests)) == 4
+        assert supergrader.cache.hash_directory(directory) == digests[-1]
+
+    def test_identical_directories_keep_their_messages(self):
+        supergrader.setup_cache(self.parse_args())
+        twin = join(self.dir, 'twin')
+        shutil.copytree(self.directories[1], twin)
+        plan = supergrader.compile_plan([
+            supergrader.validators.file_structure_validator(
+                dir_tree=[('build', ['app'])]),
+        ])
+        for directory in [self.directories[1], twin]:
+            (info, grid), = supergrader.grade_chunk([directory], plan)
+            assert info['messages']['fail'] == [
+                'Could not find: ' + join(directory, 'build')]
+
+    def test_timeouts_are_not_cached(self):
+        supergrader.setup_cache(self.parse_args())
+        plan = supergrader.compile_plan([
+            supergrader.validators.shell_validator(
+                command=['echo run >> %s/runs.log; sleep 30' % self.log_dir],
+                timeout=0.5),
+        ])
+        for _ in range(2):
+            (info, grid), = supergrader.grade_chunk(self.directories[:1], plan)
+            assert info['failures'] == 1
+        # A loaded machine could have caused the timeout, so it's rerun
+        assert self.count_runs() == 2
+
+    def test_changed_callable_reruns(self):
+        self.grade()
+        assert self.count_runs() == 4
+
+        # Only the lambda differs, but that could change the result
+        write_file(join(self.dir, self.profile_name + '.py'),
+                   self.PROFILE.replace('[%r]' % self.log_dir,
+                                        '[%r][:]' % self.log_dir))
+        sys.modules.pop(self.profile_name)
+        self.grade()
+        assert self.count_runs() == 8
+
+    def test_no_cache(self):
+        self.grade()
+        self.grade('--no-cache')
+        assert self.count_runs() == 8
+
+    def test_eviction(self):
+        self.grade('--cache-size', '0')
+        supergrader._result_cache.evict()
+        assert not any(files for _, _, files in os.walk(self.cache_dir))
+
+
+class TestCompilePlan:
+    validators = supergrader.validators
+
+    def test_builds_validators_once(self):
+        plan = supergrader.compile_plan([
+            self.validators.shell_validator(command=['true', '$DIR', '$0']),
+            ('file_text', {'text': 'Hi', 'path': 'a.txt', 'ignore_case': True}),
+        ])
+        shell, text = plan
+        assert shell.get_command('/some/dir') == ['true', '/some/dir', '$0']
+        assert text.sanitized_text == 'hi'
+
+    def test_identity_includes_callables(self):
+        v = self.validators
+
+        def build(value):
+            return v.shell_validator(command=['true'],
+                                     get_arguments=lambda self, d: [value])
+
+        assert build(1).get_identity() == build(1).get_identity()
+        assert build(1).get_identity() != build(2).get_identity()
+        assert 'get_arguments' in build(1).get_identity()
+
+    def test_identity_includes_private_methods(self):
+        v = self.validators
+
+        class Lenient(v.ShellValidator):
+            command = ['true']
+
+            def _check_result(self, result):
+                pass
+
+        assert Lenient.get_identity() != v.shell_validator(
+            command=['true']).get_identity()
+        assert '_check_result' in Lenient.get_identity()
+
+    def test_hooks_stand_in_for_attributes(self, tmp_path):
+        v = self.validators
+        (tmp_path / 'a.txt').write_text('one two')
+
+        class MyShell(v.ShellValidator):
+            def get_command(self, directory):
+                return ['test -f a.txt']
+
+        class MyTree(v.FileStructureValidator):
+            tree = ['a.txt']
+
+            def get_dir_tree(self):
+                return self.tree
+
+        class MyText(v.FileTextValidator):
+            path = 'a.txt'
+            word = 'one'
+
+            def get_text(self):
+                return self.word
+
+        shell, tree, text = supergrader.compile_plan([MyShell, MyTree, MyText])
+        shell.validate(str(tmp_path))
+        tree.validate(str(tmp_path))
+        text.validate(str(tmp_path))
+
+        # The hooks are called every time, so their results can change
+        tree.tree = ['*.py']
+        with pytest.raises(v.ValidationError, match='Could not find: \\*.py'):
+            tree.validate(str(tmp_path))
+        text.word = 'three'
+        with pytest.raises(v.ValidationError, match='does not contain'):
+            text.validate(str(tmp_path))
+
+    def check_invalid(self, validator_class, message):
+        try:
+            supergrader.compile_plan([validator_class])
+        except self.validators.ConfigurationError as e:
+            assert str(e) == message
+        else:
+            assert False, 'expected ConfigurationError'
+
+    def test_invalid_configuration(self):
+        v = self.validators
+        self.check_invalid(('nonsense', {}), 'Unknown validator: nonsense')
+        self.check_invalid(v.shell_validator(name='Build'),
+                           'Build is missing command')
+        self.check_invalid(v.file_text_validator(text='x'),
+                           'FileTextValidator is missing path')
+        self.check_invalid(v.file_structure_validator(dir_tree=[('a', 3)]),
+                           "FileStructureValidator has invalid dir_tree "
+                           "entry: 3")
+        self.check_invalid(v.shell_validator(command=['true'], requires='A'),
+                           'ShellValidator requires should be a list')
+        self.check_invalid(v.shell_validator(command=['true'], requires=['A']),
+                           'ShellValidator requires unknown A')
+
+    def test_circular_requires(self):
+        v = self.validators
+        with pytest.raises(v.ConfigurationError, match='Circular requires'):
+            supergrader.compile_plan([
+                v.shell_validator(command=['true'], name='A', requires=['B']),
+                v.shell_validator(command=['true'], name='B', requires=['A']),
+            ])
+
+    def test_order(self):
+        v = self.validators
+        plan = supergrader.compile_plan([
+            v.shell_validator(command=['make'], name='Build',
+                              requires=['Has Makefile']),
+            v.shell_validator(command=['true'], name='Lint'),
+            v.file_text_validator(text='all:', path='Makefile',
+                                  name='Has all', requires=['Build']),
+            v.file_structure_validator(dir_tree=['Makefile'],
+                                       name='Has Makefile'),
+            v.file_text_validator(text='x', path='x.txt', name='Has x'),
+        ])
+        assert [validator.get_name() for validator in plan.order] == [
+            'Has Makefile', 'Has x', 'Build', 'Has all', 'Lint',
+        ]
+
+
+REQUIRES_PROFILE = '''
+import validators as v
+
+VALIDATORS = [
+    v.shell_validator(command=['echo run >> %s/runs.log'], name='Counted',
+                      requires=['Two Paragraphs']),
+    v.file_text_validator(text='<p>', min_count=2, path='index.html',
+                          name='Two Paragraphs', requires=['Has Index']),
+    v.file_structure_validator(dir_tree=['index.html'], name='Has Index'),
+]
+'''
+
+
+class TestRequires(CountingTestBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.PROFILE = REQUIRES_PROFILE % self.log_dir
+        write_file(join(self.dir, self.profile_name + '.py'), self.PROFILE)
+
+    def check_skips(self, results):
+        infos = [info for info, grid in results]
+        assert [info['skipped'] for info in infos] == [0, 1, 2, 0]
+        assert self.count_runs() == 2
+
+        # Results are still reported in profile order
+        carol = infos[2]
+        assert [detail['name'] for detail in carol['validators']] == [
+            'Counted', 'Two Paragraphs', 'Has Index',
+        ]
+        assert carol['messages']['skip'] == [
+            'Counted skipped as Two Paragraphs did not pass',
+            'Two Paragraphs skipped as Has Index did not pass',
+        ]
+        assert dict(results[1][1])[
+            (self.directories[1].strip('/'), 'Counted')] == '?'
+
+    def test_skips_dependents(self):
+        self.check_skips(self.grade('--no-cache'))
+
+    def test_skips_dependents_async(self):
+        self.check_skips(self.grade('--no-cache', '-c', '4'))
+
+
+BATCH_PROFILE = '''
+import validators as v
+
+LOG = %r
+CHECK = 'echo run >> ' + LOG + '/runs.log; '
+
+VALIDATORS = [
+    v.batch_shell_validator(
+        command=['sh', '-c', CHECK + 'for d; do test -e $d/index.html || '
+                 'exit 1; done', 'sh', '$DIRS'],
+        name='Exit'),
+    v.batch_shell_validator(
+        command=['sh', '-c', CHECK + 'for d; do if test -e $d/index.html; '
+                 'then printf "$d\\tok\\n"; else '
+                 'printf "$d\\tfail\\tno index\\n"; fi; done', 'sh', '$DIRS'],
+        protocol='lines', name='Lines'),
+]
+'''
+
+
+class TestBatchShellValidator(CountingTestBase):
+    def setup_method(self, method):
+        super().setup_method(method)
+        self.PROFILE = BATCH_PROFILE % self.log_dir
+        write_file(join(self.dir, self.profile_name + '.py'), self.PROFILE)
+
+    def check_results(self, results):
+        expected = ['.', '.', 'F', '.']
+        for name in ['Exit', 'Lines']:
+            assert [dict(grid)[(d.strip('/'), name)]
+                    for d, (info, grid) in zip(self.directories, results)] \
+                == expected
+        assert results[2][0]['messages']['fail'] == [
+            'Command unsuccessful: sh -c %s sh %s' % (
+                self.plan_command, self.directories[2]),
+            'no index',
+        ]
+
+    def grade(self, *extra):
+        results = super().grade(*extra)
+        profile = sys.modules[self.profile_name]
+        self.plan_command = profile.VALIDATORS[0].command[2]
+        return results
+
+    def test_batches(self):
+        self.check_results(self.grade('--no-cache'))
+
+        # Lines runs once, exit once plus bisecting to find carol
+        assert self.count_runs() == 1 + 5
+
+    def test_batches_async(self):
+        self.check_results(self.grade('--no-cache', '-c', '2'))
+        assert self.count_runs() == 1 + 5
+
+    def test_batches_parallel(self):
+        # A chunk each for alice and bob, and carol and dave
+        self.check_results(self.grade('--no-cache', '-j', '2'))
+        assert self.count_runs() == 2 + 4
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_timeout_bisects(self, use_async):
+        # A directory that hangs only fails itself, even though the others
+        # were reported before the batch was killed
+        validator = supergrader.validators.batch_shell_validator(
+            command=['sh', '-c', 'for d; do printf "$d\\tok\\n"; '
+                     'test -e $d/index.html || sleep 30; done', 'sh',
+                     '$DIRS'],
+            protocol='lines', timeout=0.5)()
+        if use_async:
+            errors = asyncio.run(
+                validator.validate_batch_async(self.directories))
+        else:
+            errors = validator.validate_batch(self.directories)
+        assert [str(e) if e else None for e in errors] == [
+            None, None, 'Command timed out after 0.5s: sh -c %s sh %s' % (
+                validator.command[2], self.directories[2]), None,
+        ]
+
+    def test_invalid_output(self):
+        validator = supergrader.validators.batch_shell_validator(
+            command=['echo', '{"a": true, "b": "yes"}', '$DIRS'],
+            protocol='json')()
+        result = subprocess.CompletedProcess(
+            [], 0, b'{"a": true, "b": "yes"}')
+        error, = validator.split_results(result, ['a'])
+        assert str(error) == (
+            'BatchShellValidator output could not be parsed: '
+            'no ok status for b')
+        result.stdout = b'{"a": {"ok": false, "message": "nope"}}'
+        assert [str(e) for e in validator.split_results(result, ['a', 'c'])] \
+            == ['nope', 'BatchShellValidator gave no result for c']
+
+    def test_invalid_configuration(self):
+        v = supergrader.validators
+        with pytest.raises(v.ConfigurationError, match='include \\$DIRS'):
+            v.batch_shell_validator(command=['lint', '$DIR'])()
+        with pytest.raises(v.ConfigurationError, match='unknown protocol'):
+            v.batch_shell_validator(command=['lint', '$DIRS'],
+                                    protocol='xml')()
+
+
+class TestReporters(GradingTestBase):
+    def test_jsonl(self):
+        output = join(self.dir, 'report.jsonl')
+        supergrader.main(self.parse_args('-f', 'jsonl', '-o', output))
+        with open(output) as fd:
+            records = [json.loads(line) for line in fd]
+        assert [r['directory'] for r in records] == self.directories
+        assert records[1]['failures'] == 2
+        assert records[1]['results'] == {
+            'Success Validator': '.',
+            'Has Index': '.',
+            'Two Paragraphs': 'F',
+            'Header': 'F',
+        }
+
+    def test_csv(self):
+        output = join(self.dir, 'report.csv')
+        supergrader.main(self.parse_args('--format', 'csv', '-o', output))
+        with open(output, newline='') as fd:
+            rows = list(csv.reader(fd))
+        assert rows[0] == [
+            'directory', 'successes', 'failures', 'errors', 'skipped',
+            'Success Validator', 'Has Index', 'Two Paragraphs', 'Header',
+            'messages',
+        ]
+        assert rows[3][:9] == [
+            self.directories[2], '1', '3', '0', '0', '.', 'F', 'F', 'F',
+        ]
+        assert len(rows) == 5
+
+    def test_duplicate_names(self):
+        v = supergrader.validators
+        plan = supergrader.compile_plan([
+            v.shell_validator(command=['true']),
+            v.shell_validator(command=['false']),
+            v.shell_validator(command=['true'], name='ShellValidator (2)'),
+        ])
+        assert list(plan.labels.values()) == [
+            'ShellValidator', 'ShellValidator (3)', 'ShellValidator (2)',
+        ]
+        stream = io.StringIO()
+        reporter = supergrader.reporters.CSVReporter(stream)
+        reporter.start(plan)
+        (info, grid), = supergrader.grade_chunk(self.directories[:1], plan)
+        reporter.report(info, grid)
+        rows = list(csv.reader(io.StringIO(stream.getvalue())))
+        assert rows[0][5:8] == list(plan.labels.values())
+        assert rows[1][5:8] == ['.', 'F', '.']
+        assert len(info['timings']) == 3
+
+    def test_streams_each_directory(self):
+        stream = io.StringIO()
+        reporter = supergrader.reporters.JSONLinesReporter(stream)
+        args = self.parse_args()
+        plan = supergrader.compile_plan(supergrader.get_validator_classes(
+            supergrader.get_profile(args)))
+        reporter.start(plan)
+        results = supergrader.grade_directories(args, plan)
+        reporter.report(*next(results))
+        assert stream.getvalue().count('\n') == 1
+
+
+class TestTimings(GradingTestBase):
+    PROFILE = SLEEP_PROFILE
+
+    def test_records_timings(self):
+        results = self.grade()
+        info = results[0][0]
+        assert set(info['timings']) == set(['Sleep', 'Has Index'])
+        assert info['timings']['Sleep']['wall'] >= 0.5
+        assert info['time']['wall'] >= info['timings']['Sleep']['wall']
+
+    def test_leaves_out_queueing(self):
+        # One validator at a time, so the directories queue up for a turn
+        results = self.grade('--concurrency', '1')
+        walls = [info['timings']['Sleep']['wall'] for info, grid in results]
+        assert all(0.5 <= wall < 1.0 for wall in walls)
+
+    def test_report(self, capsys):
+        output = join(self.dir, 'timings.json')
+        supergrader.main(self.parse_args(
+            '-j', '4', '--timings', '--timings-json', output))
+        table = capsys.readouterr().out.split('Validator ')[-1]
+        lines = table.strip().split('\n')
+        assert lines[1].startswith('Sleep ')
+        assert lines[2].startswith('Has Index ')
+        with open(output) as fd:
+            exported = json.load(fd)
+        assert len(exported['timings']) == 8
+        sleep_stats = exported['validators'][0]
+        assert sleep_stats['validator'] == 'Sleep'
+        assert sleep_stats['runs'] == 4
+        assert sleep_stats['p95'] >= 0.5
+        assert sleep_stats['total'] >= 2.0
+
+
+class TestPercentile:
+    def test_percentile(self):
+        values = list(range(1, 21))
+        assert supergrader.timings.percentile(values, 0.95) == 19
+        assert supergrader.timings.percentile(values, 0.5) == 10
+        assert supergrader.timings.percentile([3], 0.95) == 3
+        assert supergrader.timings.percentile([], 0.95) is None
+
+
+class TestResultsStore(CountingTestBase):
+    def test_records_runs(self):
+        db = join(self.dir, 'results.db')
+        supergrader.main(self.parse_args('--no-cache', '--db', db, '-j', '2',
+                                         '-f', 'jsonl'))
+        supergrader.main(self.parse_args('--no-cache', '--db', db,
+                                         '-f', 'jsonl'))
+        results_store = supergrader.store.ResultsStore(db)
+        runs = results_store.connection.execute(
+            'SELECT id, profile FROM runs WHERE finished IS NOT NULL'
+        ).fetchall()
+        assert runs == [(1, self.profile_name), (2, self.profile_name)]
+        history = results_store.history(self.directories[1], 'Two Paragraphs')
+        assert history == [
+            (1, 'Two Paragraphs', 'F',
+             'index.html contains 1 instances of "<p>" (instead of at least 2)'),
+            (2, 'Two Paragraphs', 'F',
+             'index.html contains 1 instances of "<p>" (instead of at least 2)'),
+        ]
+        count, = results_store.connection.execute(
+            'SELECT COUNT(*) FROM results WHERE duration IS NOT NULL'
+        ).fetchone()
+        assert count == 16
+        results_store.close()
+
+    def test_keeps_results_of_failed_run(self):
+        db = join(self.dir, 'results.db')
+
+        def grade(args, plan, directories):
+            yield from supergrader.grade_directories(
+                args, plan, directories[:2])
+            raise KeyboardInterrupt()
+
+        with pytest.raises(KeyboardInterrupt):
+            supergrader.main(self.parse_args('--db', db, '-f', 'jsonl'),
+                             grade)
+        results_store = supergrader.store.ResultsStore(db)
+        assert results_store.connection.execute(
+            'SELECT finished FROM runs').fetchall() == [(None,)]
+        assert len(results_store.history(self.directories[1])) == 2
+        results_store.close()
+
+    def test_replays_from_database(self):
+        db = join(self.dir, 'results.db')
+        supergrader.main(self.parse_args('--db', db, '-f', 'jsonl'))
+        assert self.count_runs() == 4
+
+        # With the on-disk cache gone, results still come from the database
+        shutil.rmtree(self.cache_dir)
+        supergrader.main(self.parse_args('--db', db, '-f', 'jsonl'))
+        assert self.count_runs() == 4
+
+
+class TestBatchedInserts:
+    def test_batches(self):
+        tmp = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        results_store = supergrader.store.ResultsStore(
+            join(tmp, 'results.db'), batch_size=3)
+        results_store.start_run('profile')
+        info = supergrader.new_info('dir')
+        supergrader.record_result(info, 'dir', 'A', '.', None)
+        supergrader.record_result(info, 'dir', 'B', 'F', 'nope')
+        results_store.add(info)
+        assert len(results_store.pending) == 2
+        results_store.add(info)
+        assert results_store.pending == []
+        results_store.finish()
+        assert len(results_store.history('dir')) == 4
+        results_store.close()
+        shutil.rmtree(tmp)
+
+
+class TestCheckpoint(CountingTestBase):
+    def run_jsonl(self, capsys, *extra):
+        supergrader.main(self.parse_args('--no-cache', '-f', 'jsonl', *extra))
+        lines = capsys.readouterr().out.splitlines()
+        records = [json.loads(line) for line in lines]
+        for record in records:
+            record.pop('timings', None)
+            record.pop('time', None)
+        return records
+
+    def test_resume(self, capsys):
+        path = join(self.dir, 'checkpoint.jsonl')
+        expected = self.run_jsonl(capsys, '--checkpoint', path)
+        assert self.count_runs() == 4
+
+        # Simulate being killed part way through writing the third record
+        with open(path) as fd:
+            lines = fd.readlines()
+        assert len(lines) == 4
+        with open(path, 'w') as fd:
+            fd.write(lines[0] + lines[1] + lines[2][:20])
+
+        resumed = self.run_jsonl(capsys, '--checkpoint', path, '--resume')
+        assert self.count_runs() == 6
+        assert resumed == expected
+        completed = supergrader.checkpoint.load(
+            path, json.loads(lines[0])['plan'])
+        assert sorted(completed) == self.directories
+
+        # Nothing left to do
+        self.run_jsonl(capsys, '--checkpoint', path, '--resume')
+        assert self.count_runs() == 6
+
+    def test_interrupted(self, capsys):
+        path = join(self.dir, 'checkpoint.jsonl')
+
+        def grade(args, plan, directories):
+            yield from supergrader.grade_directories(
+                args, plan, directories[:2])
+            raise KeyboardInterrupt()
+
+        with pytest.raises(KeyboardInterrupt):
+            supergrader.main(self.parse_args(
+                '--no-cache', '-f', 'jsonl', '--checkpoint', path), grade)
+        with open(path) as fd:
+            identity = json.loads(fd.readline())['plan']
+        completed = supergrader.checkpoint.load(path, identity)
+        assert sorted(completed) == self.directories[:2]
+
+        self.run_jsonl(capsys, '--checkpoint', path, '--resume')
+        assert self.count_runs() == 4
+
+    def test_changed_profile_regrades(self, capsys):
+        path = join(self.dir, 'checkpoint.jsonl')
+        self.run_jsonl(capsys, '--checkpoint', path)
+        completed = supergrader.checkpoint.load(path, 'another plan')
+        assert completed == {}
+
+    def test_resume_requires_checkpoint(self):
+        with pytest.raises(supergrader.ArgError):
+            supergrader.check_args(self.parse_args('--resume'))
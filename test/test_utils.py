@@ -0,0 +1,92 @@
+'''
+Tests for `utils` module.
+'''
+from supergrader import supergrader
+
+utils = supergrader.utils
+
+
+class TestMatrix:
+    def test_simple(self):
+        grid = {
+            ('alice', 'Has Index'): '.',
+            ('alice', 'Builds'): 'F',
+            ('bob', 'Has Index'): '.',
+            ('bob', 'Builds'): '.',
+        }
+        assert utils.format_matrix(grid).split('\n') == [
+            '      Builds Has Index',
+            'alice F      .',
+            'bob   .      .',
+        ]
+
+    def test_missing_results(self):
+        grid = {('alice', 'A'): '.', ('bob', 'B'): 'E'}
+        assert utils.format_matrix(grid).split('\n') == [
+            '      A B',
+            'alice .',
+            'bob     E',
+        ]
+
+    def test_compressed(self):
+        names = ['Validator number %02i' % i for i in range(12)]
+        grid = {('alice', name): '.' for name in names}
+        grid[('bob', names[3])] = 'F'
+        lines = utils.format_matrix(grid).split('\n')
+        assert lines[:2] == ['00 - Validator number 00',
+                             '01 - Validator number 01']
+        assert lines[12] == '      00 01 02 03 04 05 06 07 08 09 10 11'
+        assert lines[13] == 'alice .  .  .  .  .  .  .  .  .  .  .  .'
+        assert lines[14] == 'bob            F'
+
+    def test_paging(self):
+        names = ['V%03i' % i for i in range(40)]
+        lines = list(utils.iter_matrix_lines(
+            names, ['alice'], [['.'] * 40], max_width=40))
+        assert lines[40] == 'Columns 1-11 of 40'
+        assert all(len(line) <= 40 for line in lines)
+        headers = [line for line in lines if line.startswith('Columns')]
+        assert headers == [
+            'Columns 1-11 of 40', 'Columns 12-22 of 40',
+            'Columns 23-33 of 40', 'Columns 34-40 of 40',
+        ]
+
+    def test_truncates_long_labels(self):
+        long_name = '/very/long/path/' * 10 + 'alice'
+        lines = utils.make_matrix(
+            ['A'], [long_name], [['.']], max_width=40).split('\n')
+        assert lines[1].endswith('/path/alice .')
+        assert all(len(line) <= 40 for line in lines)
+
+    def test_summary_for_large_classes(self):
+        grid = {}
+        for i in range(150):
+            grid[('student%03i' % i, 'Builds')] = 'F' if i % 50 == 0 else '.'
+            grid[('student%03i' % i, 'Has Index')] = '.'
+        lines = utils.format_matrix(grid, max_rows=100).split('\n')
+        assert lines[:4] == [
+            '           Builds Has Index',
+            'student000 F      .',
+            'student050 F      .',
+            'student100 F      .',
+        ]
+        assert lines[4] == '(147 more directories not shown, 0 of them failing)'
+        assert lines[6:] == [
+            'Builds      98.0% (147/150) F:3',
+            'Has Index  100.0% (150/150)',
+        ]
+
+
+class TestCommandTemplate:
+    def test_matches_apply_command_list_template(self):
+        command = ['run', '$DIR', '$0', '$1', '$01', '', '$5', '--flag']
+        template = utils.CommandTemplate(command)
+        for args in ([], ['a'], ['a', 'b']):
+            assert template.apply('/dir', args) == \
+                utils.apply_command_list_template(command, '/dir', args)
+
+    def test_dirs(self):
+        template = utils.CommandTemplate(['lint', '--fast', '$DIRS', '$0'])
+        assert template.apply(None, ['x'], ['a', 'b c']) == \
+            ['lint', '--fast', 'a', 'b c', 'x']
+        assert template.apply(None, []) == ['lint', '--fast', '$0']
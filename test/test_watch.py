@@ -0,0 +1,131 @@
+'''
+Tests for `watch` module.
+'''
+import os
+import shutil
+import tempfile
+import time
+from os.path import join
+
+import pytest
+
+from supergrader import supergrader
+
+from .test_grading import GradingTestBase, write_file
+
+watch = supergrader.watch
+
+
+class TestPollingWatcher:
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        self.directories = [join(self.dir, name) for name in 'abc']
+        for directory in self.directories:
+            os.makedirs(join(directory, 'sub'))
+            open(join(directory, 'sub', 'file.txt'), 'w').write('contents')
+        self.watcher = watch.PollingWatcher(self.directories, interval=0.01)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_no_changes(self):
+        assert self.watcher.poll() == []
+
+    def test_detects_changes(self):
+        open(join(self.directories[2], 'sub', 'file.txt'), 'a').write('more')
+        open(join(self.directories[0], 'new.txt'), 'w').write('new')
+        assert self.watcher.wait() == [self.directories[0],
+                                       self.directories[2]]
+        assert self.watcher.poll() == []
+
+    def test_detects_removal(self):
+        shutil.rmtree(join(self.directories[1], 'sub'))
+        assert self.watcher.poll() == [self.directories[1]]
+
+    def test_sync_ignores_changes(self):
+        open(join(self.directories[1], 'build.o'), 'w').write('artifact')
+        self.watcher.sync()
+        assert self.watcher.poll() == []
+
+
+@pytest.mark.skipif(watch.inotify_simple is None,
+                    reason='inotify_simple is not installed')
+class TestInotifyWatcher:
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp(prefix='tmp_supergrader_test_')
+        self.directories = [join(self.dir, name) for name in 'ab']
+        for directory in self.directories:
+            os.makedirs(join(directory, 'sub'))
+            open(join(directory, 'sub', 'file.txt'), 'w').write('contents')
+        self.archive = join(self.dir, 'c.zip')
+        open(self.archive, 'w').write('zip')
+        self.directories.append(self.archive)
+        self.watcher = watch.InotifyWatcher(self.directories)
+
+    def teardown_method(self, method):
+        self.watcher.inotify.close()
+        shutil.rmtree(self.dir)
+
+    def test_detects_changes(self):
+        open(join(self.directories[1], 'sub', 'file.txt'), 'a').write('more')
+        assert self.watcher.wait() == [self.directories[1]]
+
+        # New subdirectories are watched too
+        os.makedirs(join(self.directories[0], 'new'))
+        self.watcher.wait()
+        open(join(self.directories[0], 'new', 'file.txt'), 'w').write('new')
+        assert self.watcher.wait() == [self.directories[0]]
+
+    def test_archive_replaced(self):
+        # Other files next to the archive don't count
+        open(join(self.dir, 'notes.txt'), 'w').write('notes')
+        for i in range(2):
+            replacement = join(self.dir, 'c.zip.tmp')
+            open(replacement, 'w').write('zip %i' % i)
+            os.replace(replacement, self.archive)
+            assert self.watcher.wait() == [self.archive]
+
+    def test_sync_ignores_changes(self):
+        open(join(self.directories[0], 'build.o'), 'w').write('artifact')
+        self.watcher.sync()
+        open(self.archive, 'a').write('more')
+        assert self.watcher.wait() == [self.archive]
+
+
+class StopWatching(Exception):
+    pass
+
+
+class TestWatchDirectories(GradingTestBase):
+    def test_edits_while_grading_are_regraded(self, monkeypatch):
+        args = self.parse_args('--watch')
+        plan = supergrader.compile_plan(supergrader.get_validator_classes(
+            supergrader.get_profile(args)))
+        watcher = watch.PollingWatcher(self.directories, interval=0.01)
+        monkeypatch.setattr(watch, 'get_watcher', lambda *args: watcher)
+        graded = []
+
+        # Give up rather than wait forever for a change that was missed
+        poll, deadline = watcher.poll, time.monotonic() + 5
+
+        def poll_until_deadline():
+            if time.monotonic() > deadline:
+                raise StopWatching()
+            return poll()
+
+        watcher.poll = poll_until_deadline
+
+        class Reporter:
+            def update(reporter, results):
+                graded.append([info['directory'] for info, grid in results])
+                if len(graded) == 1:
+                    # As if the student saved again before grading finished
+                    write_file(join(self.directories[1], 'index.html'),
+                               '<p>edited</p>')
+                else:
+                    raise StopWatching()
+
+        write_file(join(self.directories[0], 'notes.txt'), 'changed')
+        with pytest.raises(StopWatching):
+            supergrader.watch_directories(args, plan, Reporter())
+        assert graded == [self.directories[:1], self.directories[1:2]]
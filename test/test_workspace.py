@@ -0,0 +1,107 @@
+'''
+Tests for running commands in isolated copies of submissions, with the
+`workspace` module.
+'''
+import os
+import stat
+
+import pytest
+
+from supergrader import supergrader
+
+validators = supergrader.validators
+workspace = validators.workspace
+
+
+def make_submission(path):
+    (path / 'src').mkdir(parents=True)
+    (path / 'src' / 'main.py').write_text('print("hi")')
+    (path / 'run.sh').write_text('#!/bin/sh\n')
+    (path / 'run.sh').chmod(0o755)
+    os.symlink('src/main.py', str(path / 'main.py'))
+    return str(path)
+
+
+class TestWorkspacePool:
+    def test_populate(self, tmp_path):
+        source = make_submission(tmp_path / 'sub')
+        pool = workspace.WorkspacePool(str(tmp_path))
+        path = pool.acquire(source, workspace.get_methods('hardlink'))
+        assert sorted(os.listdir(path)) == ['main.py', 'run.sh', 'src']
+        assert os.readlink(os.path.join(path, 'main.py')) == 'src/main.py'
+        with open(os.path.join(path, 'main.py')) as fd:
+            assert fd.read() == 'print("hi")'
+        assert os.access(os.path.join(path, 'run.sh'), os.X_OK)
+
+        # Cloned rather than copied, where the filesystem allows
+        original = os.stat(os.path.join(source, 'src', 'main.py'))
+        clone = os.stat(os.path.join(path, 'src', 'main.py'))
+        if ('reflink', original.st_dev) in pool.unsupported:
+            assert clone.st_ino == original.st_ino
+
+        # Deleting files in the workspace leaves the submission alone
+        os.unlink(os.path.join(path, 'src', 'main.py'))
+        assert os.path.exists(os.path.join(source, 'src', 'main.py'))
+
+    @pytest.mark.parametrize('isolate', [True, 'copy'])
+    def test_never_hardlinks(self, tmp_path, isolate):
+        # Unless asked to, as appending in place would change the submission
+        source = make_submission(tmp_path / 'sub')
+        pool = workspace.WorkspacePool(str(tmp_path))
+        path = pool.acquire(source, workspace.get_methods(isolate))
+        with open(os.path.join(path, 'run.sh'), 'a') as fd:
+            fd.write('exit 1\n')
+        with open(os.path.join(source, 'run.sh')) as fd:
+            assert fd.read() == '#!/bin/sh\n'
+
+    def test_reuse(self, tmp_path):
+        source = make_submission(tmp_path / 'sub')
+        pool = workspace.WorkspacePool(str(tmp_path), size=1)
+        pool.fill()
+        path = pool.acquire(source)
+        assert pool.free == []
+        locked = os.path.join(path, 'src', 'locked')
+        os.mkdir(locked)
+        open(os.path.join(locked, 'file'), 'w').close()
+        os.chmod(locked, stat.S_IRUSR | stat.S_IXUSR)
+        pool.release(path)
+        assert pool.free == [path]
+        assert os.listdir(path) == []
+
+        # Beyond the pool's size, workspaces are deleted
+        first, second = pool.acquire(source), pool.acquire(source)
+        pool.release(first)
+        pool.release(second)
+        assert pool.free == [first]
+        assert not os.path.exists(second)
+
+
+class TestShellValidatorIsolation:
+    def teardown_method(self, method):
+        workspace.setup()
+
+    @pytest.mark.parametrize('use_async', [False, True])
+    def test_isolated(self, tmp_path, use_async):
+        source = make_submission(tmp_path / 'sub')
+        plan = supergrader.compile_plan([
+            validators.shell_validator(
+                command=['test -f src/main.py && touch artifact && '
+                         'rm run.sh'], name='Build'),
+            validators.shell_validator(
+                command=['test ! -e artifact && test -f run.sh'],
+                name='Clean', requires=['Build']),
+        ])
+        info, grid = supergrader.grade_chunk(
+            [source], plan, concurrency=2 if use_async else 0)[0]
+        assert info['successes'] == 2
+        assert sorted(os.listdir(source)) == ['main.py', 'run.sh', 'src']
+
+    @pytest.mark.parametrize('enabled', [False, True])
+    def test_not_isolated(self, tmp_path, enabled):
+        # Either switched off globally, or for the validator
+        source = make_submission(tmp_path / 'sub')
+        workspace.setup(enabled)
+        validator = validators.shell_validator(
+            command=['touch artifact'], isolate=not enabled)()
+        validator.validate(source)
+        assert os.path.exists(os.path.join(source, 'artifact'))